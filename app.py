@@ -1,89 +1,309 @@
 import json
+import mimetypes
 import os
-import requests
-import base64
-import threading
 import uuid
 import time
 import logging
 import random
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, Response, g, render_template, request, jsonify, send_from_directory
+from werkzeug.middleware.proxy_fix import ProxyFix
 from pathlib import Path
 
 # Import services
-from services.database import GalleryDB
-from services.images import ImageService
+from services.database import open_gallery_db
+from services.images import ImageService, in_pool_worker
+from services.file_index import FileIndex, version_token
+from services.scheduler import JobScheduler, QueueFullError
+from services.cache import GenerationCache
+from services.backends import BackendPool
+from services.events import JobEventBus
+from services.jobs import JobStatus, open_job_store
+from services.dedup import JobDeduplicator
+from services.batches import BatchManager, expand_sweep
+from services.similarity import HASHES, HashIndex
+from services.storage import StorageTiers
+from services.metrics import JOBS_FINISHED, REQUEST_SECONDS, STAGE_SECONDS, registry
 
 # Load configuration
 with open('config.json', 'r') as f:
     config = json.load(f)
 
 app = Flask(__name__)
+# Hand file bodies to the front-end proxy (X-Sendfile) instead of streaming them through Python
+app.config['USE_X_SENDFILE'] = config['app']['use_x_sendfile']
+# Take the client address from X-Forwarded-For set by that many trusted proxies
+trusted_proxies = config['app']['trusted_proxies']
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies, x_proto=trusted_proxies, x_host=trusted_proxies)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Job management for async processing
-jobs = {}
-jobs_lock = threading.Lock()
+# Map quality presets to sampling steps
+QUALITY_STEPS = {'low': 4, 'medium': 10, 'high': 20}
 
-class JobStatus:
-    PENDING = "pending"
-    PROCESSING = "processing"
-    COMPLETED = "completed"
-    FAILED = "failed"
+# Job fields that make up a batch job's spec in its manifest
+BATCH_SPEC_FIELDS = ('prompt', 'size', 'quality', 'seed', 'model')
 
-def create_job(prompt, size, quality='low', seed=None):
-    """Create a new background job"""
+# Precompressed siblings served when the client accepts them: encoding -> file suffix
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+def create_job(prompt, size, quality='low', seed=None, client_id=None, model=None, batch_id=None, message='Queued for processing',
+               parent=None, strength=None, run_seed=None, draft=False, priority=None, batch_index=None, client_address=None):
+    """Create a new background job - with a parent filename it is an edit of that image
+
+    seed is the user's seed; run_seed pins the seed of a job the user left random
+    (progressive runs share one) without making it a user-specified, cacheable seed.
+    A draft job's image is a short-lived preview, kept out of the gallery. The queue
+    priority and the position in its batch are kept so recovery can requeue it as it was.
+    """
     job_id = str(uuid.uuid4())
-    with jobs_lock:
-        jobs[job_id] = {
-            'id': job_id,
-            'status': JobStatus.PENDING,
-            'prompt': prompt,
-            'size': size,
-            'quality': quality,
-            'seed': seed,
-            'progress': 0,
-            'message': 'Queued for processing',
-            'created_at': datetime.now().isoformat(),
-            'result': None,
-            'error': None
-        }
+    job_store.create({
+        'id': job_id,
+        'status': JobStatus.PENDING,
+        'prompt': prompt,
+        'size': size,
+        'quality': quality,
+        'seed': seed,
+        'run_seed': run_seed,
+        'draft': draft,
+        'model': model or config['sd_api']['model'],
+        'client_id': client_id,
+        'client_address': client_address,
+        'batch_id': batch_id,
+        'batch_index': batch_index,
+        'priority': priority,
+        'parent': parent,
+        'strength': strength,
+        'progress': 0,
+        'message': message,
+        'created_at': datetime.now().isoformat(),
+        'result': None,
+        'error': None
+    })
     seed_info = f"seed: {seed}" if seed is not None else "seed: random"
-    logger.info(f"Created job {job_id}: {prompt[:50]}... (size: {size}, quality: {quality}, {seed_info})")
+    logger.debug(f"Created job {job_id}: {prompt[:50]}... (size: {size}, quality: {quality}, {seed_info})")
     return job_id
 
 def get_job(job_id):
     """Get job status"""
-    with jobs_lock:
-        job = jobs.get(job_id, None)
-        if job:
-            logger.debug(f"Job {job_id} status: {job['status']} ({job['progress']}%)")
-        else:
-            logger.warning(f"Job {job_id} not found")
-        return job
+    job = job_store.get(job_id)
+    if job:
+        logger.debug(f"Job {job_id} status: {job['status']} ({job['progress']}%)")
+    else:
+        logger.warning(f"Job {job_id} not found")
+    return job
 
 def update_job(job_id, **updates):
-    """Update job status"""
-    with jobs_lock:
-        if job_id in jobs:
-            jobs[job_id].update(updates)
-            logger.info(f"Job {job_id} updated: {updates}")
-        else:
-            logger.error(f"Attempted to update non-existent job: {job_id}")
+    """Update job status and push the new state to any event stream listeners"""
+    snapshot = job_store.update(job_id, updates)
+    if snapshot is None:
+        logger.error(f"Attempted to update non-existent job: {job_id}")
+        return
+    logger.debug(f"Job {job_id} updated: {updates}")
+    publish_job_update(snapshot, updates)
+    
+    # Identical requests that joined this job follow its progress and share its result
+    for follower in dedup.mirror(job_id, updates):
+        publish_job_update(follower, updates)
+
+def publish_job_update(snapshot, updates):
+    """Metrics, event stream and batch side effects of one applied job update"""
+    # A cancelled job ignores late updates - only count statuses that took effect
+    if updates.get('status') in JobStatus.FINISHED and snapshot['status'] == updates['status']:
+        JOBS_FINISHED.inc(status=updates['status'])
+    
+    if event_bus.has_subscribers(snapshot['id']):
+        event_bus.publish(snapshot['id'], build_job_status(snapshot))
+    
+    if snapshot.get('batch_id') and snapshot['status'] in JobStatus.FINISHED:
+        # Free batch slot - let the feeder queue the next job right away
+        batch_manager.wake()
+
+def build_job_status(job, position=None):
+    """Status payload shared by the polling endpoint and the event stream"""
+    status = {
+        'job_id': job['id'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'message': job['message'],
+        'created_at': job['created_at']
+    }
+    
+    if job['status'] == JobStatus.PENDING:
+        # Queue position and ETA while waiting for a worker
+        status.update(position or scheduler.get_position(job['id']) or {})
+    
+    # Progressive mode links a draft and its refinement
+    for link in ('refinement_job_id', 'draft_job_id'):
+        if job.get(link):
+            status[link] = job[link]
+    
+    if job['status'] == JobStatus.COMPLETED and job['result']:
+        status['result'] = job['result']
+    elif job['status'] == JobStatus.FAILED and job['error']:
+        status['error'] = job['error']
+    
+    return status
+
+def publish_queue_positions():
+    """Scheduler hook - push fresh queue positions to listeners of still-queued jobs"""
+    positions = scheduler.get_positions(event_bus.subscribed_job_ids())
+    for job_id, position in positions.items():
+        job = job_store.get(job_id)
+        if job and job['status'] == JobStatus.PENDING:
+            event_bus.publish(job_id, build_job_status(job, position))
+
+def remove_job(job_id):
+    """Drop a job that was never admitted to the queue"""
+    job_store.remove(job_id)
+
+def job_wanted(job_id):
+    """Whether anyone still waits for a job's output - a cancelled job may have followers"""
+    job = job_store.get(job_id)
+    return job is not None and (job['status'] != JobStatus.CANCELLED or dedup.has_followers(job_id))
+
+def cancel_job(job_id, message='Cancelled'):
+    """Cancel a queued or running job, returning False if it had already finished
 
-def process_image_generation(job_id, prompt, size, quality='low', seed=None):
-    """Background function to process image generation"""
-    logger.info(f"Starting background processing for job {job_id}")
+    Queued work is taken out of the scheduler. A running backend call cannot be
+    interrupted, so its images are discarded when it returns. Work that identical
+    requests joined keeps going for them. Cancelling a draft also cancels its refinement.
+    """
+    job = job_store.get(job_id)
+    if not job or job['status'] in JobStatus.FINISHED:
+        return False
+    if job['status'] == JobStatus.PROCESSING:
+        message = f"{message} - the running generation's result will be discarded"
+    update_job(job_id, status=JobStatus.CANCELLED, message=message)
+    leader_id = dedup.detach(job_id)
+    abandon_if_unwanted(leader_id or job_id)
+    if job.get('refinement_job_id'):
+        cancel_job(job['refinement_job_id'], message='Refinement cancelled with its draft')
+    return True
+
+def abandon_if_unwanted(job_id):
+    """Drop the queued work of a cancelled job once no identical request follows it"""
+    job = job_store.get(job_id)
+    if job and job['status'] == JobStatus.CANCELLED and dedup.release_if_unfollowed(job_id):
+        # No-op once a worker has it - its images are discarded on return instead
+        scheduler.cancel(job_id)
+
+def run_jobs(job_ids):
+    """Scheduler handler - run a batch of compatible queued jobs on a worker thread"""
+    batch = [job for job in map(get_job, job_ids) if job]
+    if not batch:
+        return
+    first = batch[0]
+    process_image_generation([job['id'] for job in batch], first['prompt'], first['size'], first['quality'], first['seed'], first['model'],
+                             first.get('parent'), first.get('strength'), first.get('run_seed'), first.get('draft', False))
+
+def recover_jobs(recovered):
+    """Job store hook - requeue jobs taken over from a worker that stopped"""
+    batches = {}
+    for job in recovered:
+        if job.get('batch_id'):
+            # The batch feeder requeues these a few at a time, like any batch job
+            update_job(job['id'], status=JobStatus.PENDING, progress=0, message='Recovered after restart, waiting in batch')
+            batches.setdefault(job['batch_id'], set()).add(job['id'])
+            continue
+        update_job(job['id'], status=JobStatus.PENDING, progress=0, message='Recovered after restart, requeued')
+        batch_key = get_batch_key(job['prompt'], job['size'], job['quality'], job['seed'], job['model'], job.get('parent'), job.get('strength'),
+                                  job.get('run_seed'))
+        try:
+            scheduler.submit(job['id'], job['client_id'], priority=job.get('priority'), batch_key=batch_key, model=job['model'],
+                             address=job.get('client_address'))
+        except QueueFullError as e:
+            update_job(job['id'], status=JobStatus.FAILED, error=str(e), message=f"Generation failed: {str(e)}")
+    
+    for batch_id, pending in batches.items():
+        recover_batch(batch_id, pending)
+
+def recover_batch(batch_id, pending):
+    """Rebuild a batch from its job records - finished jobs keep their place in the
+    manifest, the pending ones go back to the feeder"""
+    jobs = sorted(job_store.find_batch(batch_id), key=lambda job: job['batch_index'])
+    batch_jobs = [(job['id'], {field: job[field] for field in BATCH_SPEC_FIELDS},
+                   get_batch_key(job['prompt'], job['size'], job['quality'], job['seed'], job['model'])) for job in jobs]
+    batch_manager.restore(batch_id, jobs[0]['client_id'], batch_jobs, pending, created_at=jobs[0]['created_at'])
+
+def update_jobs(job_ids, **updates):
+    """Apply the same update to every job in a batch"""
+    for job_id in job_ids:
+        update_job(job_id, **updates)
+
+def get_batch_key(prompt, size, quality, seed, model, parent=None, strength=None, run_seed=None):
+    """Jobs with the same key can share one n>1 backend call; explicit seeds stay single"""
+    if seed is not None or run_seed is not None:
+        return None
+    return (prompt, size, quality, model, parent, strength)
+
+def cache_params(steps, seed, parent=None, strength=None):
+    """Parameters that make up a generation cache key - edits also depend on their init image"""
+    params = {"steps": steps, "seed": seed}
+    if parent:
+        params.update(parent=parent, strength=strength)
+    return params
+
+def get_cache_key(prompt, size, quality, seed, model, parent=None, strength=None):
+    """Generation cache key - only explicit seeds give deterministic, cacheable output"""
+    if seed is None:
+        return None
+    params = cache_params(QUALITY_STEPS.get(quality, 4), seed, parent, strength)
+    return generation_cache.make_key(prompt, model, size, params)
+
+def get_cached_result(prompt, size, quality, seed, model, parent=None, strength=None):
+    """Look up a previous identical generation, returning a job result or None"""
+    cache_key = get_cache_key(prompt, size, quality, seed, model, parent, strength)
+    if cache_key is None:
+        return None
+    
+    filename = generation_cache.lookup(cache_key)
+    if not filename:
+        return None
+    
+    records = db.get_image_by_filename(filename)
+    if not records:
+        generation_cache.invalidate_filename(filename)
+        return None
+    
+    record = records[0]
+    result = build_job_result(filename, record['prompt'], record['size'], record['quality'], seed, record['parameters']['seed'],
+                              parent, strength)
+    result['cached'] = True
+    return result
+
+def process_image_generation(job_ids, prompt, size, quality='low', seed=None, model=None, parent=None, strength=None, run_seed=None,
+                             draft=False):
+    """Background function to process image generation for one or more compatible jobs
+
+    With a parent filename the jobs are edits: the parent is uploaded to /v1/images/edits,
+    which sd.cpp uses as a reference image for edit-capable models - never as an init image,
+    so an edit runs the quality's full steps and strength (forwarded in the extra args) has
+    no effect there. run_seed fixes the seed of a job the user left random; draft jobs only keep a preview.
+    """
+    count = len(job_ids)
+    logger.debug(f"Starting background processing for jobs {job_ids}")
     try:
-        update_job(job_id, status=JobStatus.PROCESSING, message="Starting generation...", progress=10)
+        update_jobs(job_ids, status=JobStatus.PROCESSING, message="Starting generation...", progress=10)
+        
+        # An identical deterministic job may have finished while this one was queued
+        cached_result = get_cached_result(prompt, size, quality, seed, model, parent, strength)
+        if cached_result:
+            update_jobs(job_ids, status=JobStatus.COMPLETED, progress=100, message="Generation complete (cached)", result=cached_result)
+            logger.debug(f"Jobs {job_ids} served from generation cache")
+            return
+        
+        # Jobs cancelled while waiting for a backend are dropped before the call
+        job_ids = [job_id for job_id in job_ids if job_wanted(job_id)]
+        if not job_ids:
+            logger.debug('Every job of the batch was cancelled, skipping the backend call')
+            return
+        count = len(job_ids)
         
         # Map quality to steps
-        quality_steps = {'low': 4, 'medium': 10, 'high': 20}
-        steps = quality_steps.get(quality, 4)
+        steps = QUALITY_STEPS.get(quality, 4)
         
         # Build embedded parameters - only include seed if specified
         embedded_params = {"steps": steps}
@@ -91,76 +311,205 @@ def process_image_generation(job_id, prompt, size, quality='low', seed=None):
         if seed is not None:
             embedded_params["seed"] = seed
             actual_seed = seed
+        elif run_seed is not None:
+            embedded_params["seed"] = run_seed
+            actual_seed = run_seed
         else:
-            # Generate a random seed and include it in parameters for consistent behavior
-            actual_seed = random.randint(0, 2147483647)
+            # Generate a random seed and include it in parameters for consistent behavior.
+            # sd.cpp uses seed + i for the i-th image of a batch, so leave room for the batch.
+            actual_seed = random.randint(0, 2147483647 - count)
             embedded_params["seed"] = actual_seed
         
+        reference_image = None
+        if parent:
+            # The parent may have moved to the archive tier since it was generated
+            if not storage.ensure_hot(parent):
+                raise FileNotFoundError(f"Parent image {parent} no longer exists")
+            reference_image = output_dir / parent
+            embedded_params["strength"] = strength
+        
         # Build embedded prompt with XML parameters
         embedded_prompt = f'{prompt} <sd_cpp_extra_args>{json.dumps(embedded_params)}</sd_cpp_extra_args>'
         seed_info = f"seed: {actual_seed}" if seed is not None else f"seed: random ({actual_seed})"
-        logger.info(f"Job {job_id}: Using {steps} steps for {quality} quality, {seed_info}")
-        logger.info(f"Job {job_id}: Sending XML parameters: {json.dumps(embedded_params)}")
-        logger.debug(f"Job {job_id}: Full embedded prompt: {embedded_prompt}")
+        logger.debug(f"Jobs {job_ids}: Using {steps} steps for {quality} quality, {seed_info}, batch of {count}")
+        logger.debug(f"Jobs {job_ids}: Sending XML parameters: {json.dumps(embedded_params)}")
+        logger.debug(f"Jobs {job_ids}: Full embedded prompt: {embedded_prompt}")
         
-        # Call SD API with embedded prompt
-        update_job(job_id, message=f"Calling SD API ({quality} quality, {steps} steps)...", progress=20)
-        result = call_sd_api(embedded_prompt, size)
-        update_job(job_id, message="Processing server response...", progress=80)
+        # Call SD API with embedded prompt - one call for the whole batch
+        mode = f", editing {parent}" if parent else ""
+        update_jobs(job_ids, message=f"Calling SD API ({quality} quality, {steps} steps{mode})...", progress=20)
+        image_paths = call_sd_api(embedded_prompt, size, count, model, reference_image)
+        update_jobs(job_ids, message="Processing server response...", progress=80)
         
-        # Extract image data
-        image_data = result['data'][0]
-        b64_image = image_data['b64_json']
-        filename = generate_filename(prompt)  # Use clean prompt for filename
-        filepath = save_image(b64_image, filename)
-        
-        update_job(job_id, message="Saving to database...", progress=90)
-        
-        # Store metadata with all generation parameters
-        db.add_image(filename, prompt, config['sd_api']['model'], size, quality, seed, actual_seed)
-        
-        # Generate thumbnail
-        thumbnail_url = image_service.get_thumbnail_url(filename)
-        
-        # Get file info
-        file_info = get_file_info(filename)
-        file_size = file_info['file_size'] if file_info else 0
-        
-        # Mark as completed
-        update_job(job_id, 
-                  status=JobStatus.COMPLETED, 
-                  progress=100,
-                  message="Generation complete!",
-                  result={
-                      'filename': filename,
-                      'url': f'/images/{filename}',
-                      'thumbnail_url': thumbnail_url,
-                      'prompt': prompt,
-                      'size': size,
-                      'quality': quality,
-                      'seed': actual_seed,
-                      'user_seed': seed,
-                      'file_size': file_size
-                  })
-        logger.info(f"Job {job_id} completed successfully")
+        # Split the batch back out to the individual jobs
+        try:
+            for index, job_id in enumerate(job_ids):
+                if not job_wanted(job_id):
+                    # Cancelled during the call - its image is discarded below
+                    continue
+                if index >= len(image_paths):
+                    update_job(job_id,
+                              status=JobStatus.FAILED,
+                              error="Server returned fewer images than requested",
+                              message="Generation failed: Server returned fewer images than requested")
+                    continue
+                if draft:
+                    complete_draft(job_id, image_paths[index], prompt, size, quality, seed, actual_seed + index, parent, strength)
+                    continue
+                complete_job(job_id, image_paths[index], prompt, size, quality, seed, actual_seed + index, model, parent, strength)
+        finally:
+            # Drop any decoded images that were not moved into place
+            for path in image_paths:
+                path.unlink(missing_ok=True)
                   
     except Exception as e:
-        logger.error(f"Job {job_id} failed with error: {str(e)}")
-        update_job(job_id, 
+        logger.error(f"Jobs {job_ids} failed with error: {str(e)}")
+        update_jobs(job_ids, 
                   status=JobStatus.FAILED, 
                   error=str(e),
                   message=f"Generation failed: {str(e)}")
 
-# Initialize services
-db = GalleryDB(config)
-image_service = ImageService(config)
+def complete_job(job_id, image_path, prompt, size, quality, seed, actual_seed, model, parent=None, strength=None):
+    """Save one decoded image, record it and mark its job completed"""
+    with STAGE_SECONDS.time(stage='disk_write'):
+        filepath = save_image(image_path, generate_filename(prompt))  # Use clean prompt for filename
+    filename = filepath.name
+    with STAGE_SECONDS.time(stage='hash'):
+        duplicate_of = image_service.record_hashes(filename)
+    if duplicate_of:
+        logger.debug(f"Job {job_id} output {filename} is a near-duplicate of {duplicate_of}")
+    
+    update_job(job_id, message="Saving to database...", progress=90)
+    
+    # Store metadata with all generation parameters
+    with STAGE_SECONDS.time(stage='db_insert'):
+        db.add_image(filename, prompt, model, size, quality, seed, actual_seed, parent, strength)
+    
+    # Thumbnail and responsive derivatives render in the background pipeline
+    image_service.schedule_renders(filename)
+    
+    result = build_job_result(filename, prompt, size, quality, seed, actual_seed, parent, strength)
+    result['duplicate_of'] = duplicate_of
+    
+    # Remember deterministic generations for resubmissions
+    cache_key = get_cache_key(prompt, size, quality, seed, model, parent, strength)
+    if cache_key:
+        generation_cache.store(cache_key, filename, result['file_size'])
+    
+    # Mark as completed
+    update_job(job_id, 
+              status=JobStatus.COMPLETED, 
+              progress=100,
+              message="Generation complete!",
+              result=result)
+    logger.debug(f"Job {job_id} completed successfully")
+
+def complete_draft(job_id, image_path, prompt, size, quality, seed, actual_seed, parent=None, strength=None):
+    """Keep a progressive draft as a preview in drafts_dir - no gallery record, hashes,
+    derivatives or cache entry, since its refinement is the image that stays"""
+    prune_drafts()
+    filename = f"{job_id}.png"
+    filepath = drafts_dir / filename
+    os.replace(image_path, filepath)
+    
+    result = {
+        'filename': filename,
+        'url': f"/drafts/{filename}",
+        'thumbnail_url': f"/drafts/{filename}",
+        'thumbnail_pending': False,
+        'prompt': prompt,
+        'size': size,
+        'quality': quality,
+        'seed': actual_seed,
+        'user_seed': seed,
+        'file_size': filepath.stat().st_size,
+        'draft': True
+    }
+    if parent:
+        result.update(parent=parent, strength=strength)
+    update_job(job_id, status=JobStatus.COMPLETED, progress=100, message="Draft complete!", result=result)
+    logger.debug(f"Job {job_id} draft ready")
+
+def prune_drafts():
+    """Delete draft previews older than progressive.draft_ttl_seconds"""
+    cutoff = time.time() - config['progressive']['draft_ttl_seconds']
+    for path in drafts_dir.glob('*.png'):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+def build_job_result(filename, prompt, size, quality, seed, actual_seed, parent=None, strength=None):
+    """Build the job result payload for a stored image"""
+    # Thumbnail URL, or the original while the thumbnail is pending
+    thumbnail = image_service.get_thumbnail(filename)
+    
+    # Get file info
+    file_info = get_file_info(filename)
+    file_size = file_info['file_size'] if file_info else 0
+    
+    result = {
+        'filename': filename,
+        'url': image_url(filename),
+        'thumbnail_url': thumbnail['thumbnail_url'],
+        'thumbnail_pending': thumbnail['thumbnail_pending'],
+        'prompt': prompt,
+        'size': size,
+        'quality': quality,
+        'seed': actual_seed,
+        'user_seed': seed,
+        'file_size': file_size
+    }
+    if parent:
+        result.update(parent=parent, strength=strength)
+    return result
+
+# Initialize services - pool worker processes re-import the main module to run their
+# tasks and must not start a second app, so they skip this and the cache warm-up
+if not in_pool_worker():
+    db = open_gallery_db(config)
+    file_index = FileIndex(config)
+    hash_index = HashIndex(config)
+    image_service = ImageService(config, file_index, hash_index)
+    storage = StorageTiers(config, file_index, image_service)
+    file_index.start()
+    storage.start()
+    db.start_stats(storage.original_sizes)
+    generation_cache = GenerationCache(config, storage)
+    backend_pool = BackendPool(config)
+    backend_pool.start()
+    event_bus = JobEventBus(config)
+    job_store = open_job_store(config)
+    dedup = JobDeduplicator(config, job_store)
+    scheduler = JobScheduler(config, run_jobs, backend_pool.capacity, on_queue_change=publish_queue_positions,
+                             model_capacity=backend_pool.model_capacity())
+    scheduler.start()
+    batch_manager = BatchManager(config, get_job, update_job)
+    batch_manager.start(scheduler)
+
+    # Ensure output directory exists
+    output_dir = Path(config['files']['output_dir'])
+    output_dir.mkdir(exist_ok=True)
+    drafts_dir = Path(config['files']['drafts_dir'])
+    drafts_dir.mkdir(exist_ok=True)
 
-# Ensure output directory exists
-output_dir = Path(config['files']['output_dir'])
-output_dir.mkdir(exist_ok=True)
+def warm_generation_cache():
+    """Seed the generation cache from gallery records with user-specified seeds"""
+    for image in reversed(db.get_all_images()):
+        parameters = image.get('parameters')
+        if not parameters or parameters.get('user_seed') is None:
+            continue
+        file_info = get_file_info(image['filename'])
+        if not file_info:
+            continue
+        params = cache_params(parameters['steps'], parameters['user_seed'], image.get('parent'), parameters.get('strength'))
+        cache_key = generation_cache.make_key(image['prompt'], image['model'], image['size'], params)
+        generation_cache.store(cache_key, image['filename'], file_info['file_size'])
 
 def generate_filename(prompt):
-    """Generate a short, readable filename from prompt and timestamp"""
+    """Generate a short, readable base name from prompt and timestamp - save_image picks
+    the free .png name for it"""
     # Clean and truncate prompt
     clean_prompt = ''.join(c for c in prompt if c.isalnum() or c.isspace())
     words = clean_prompt.split()[:3]  # First 3 words
@@ -169,51 +518,95 @@ def generate_filename(prompt):
     # Simple timestamp
     timestamp = datetime.now().strftime("%m%d_%H%M")
     
-    return f"{prompt_part}_{timestamp}.png"
+    return f"{prompt_part}_{timestamp}"
 
 def get_file_info(filename):
-    """Get live filesystem data for a file"""
-    file_path = output_dir / filename
-    if not file_path.exists():
+    """Get filesystem data for a file from the metadata index - no stat() per call"""
+    info = storage.lookup(filename)
+    if not info:
         return None
     
-    stat = file_path.stat()
     return {
-        'file_size': stat.st_size,
-        'created_at': datetime.fromtimestamp(stat.st_ctime).strftime('%Y-%m-%d %H:%M:%S'),
-        'modified_at': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
+        'file_size': info.size,
+        'created_at': datetime.fromtimestamp(info.ctime).strftime('%Y-%m-%d %H:%M:%S'),
+        'modified_at': datetime.fromtimestamp(info.mtime).strftime('%Y-%m-%d %H:%M:%S')
     }
 
-def call_sd_api(prompt, size=None, count=None):
-    """Call the Stable Diffusion API with server's actual supported parameters"""
+def image_url(filename):
+    """Versioned URL of an original - cacheable forever by the browser"""
+    info = storage.lookup(filename)
+    return f"/images/{filename}?v={version_token(info)}" if info else f"/images/{filename}"
+
+def call_sd_api(prompt, size=None, count=None, model=None, reference_image=None):
+    """Call the Stable Diffusion API with server's actual supported parameters
+
+    The call goes to the least-loaded healthy backend serving the model. The response
+    is streamed: each b64_json image is decoded chunk by chunk into a temp file in
+    output_dir. Returns the temp file paths in response order. With a reference_image
+    path it is an edit call to /v1/images/edits, the image streamed from disk.
+    """
     payload = {
-        "model": config['sd_api']['model'],
+        "model": model or config['sd_api']['model'],
         "prompt": prompt,
         "size": size or config['sd_api']['default_size'],
         "n": count or config['sd_api']['default_count'],
         "response_format": config['sd_api']['response_format']
     }
     
-    try:
-        response = requests.post(
-            config['sd_api']['url'],
-            json=payload,
-            headers={'Content-Type': 'application/json'},
-            timeout=config['sd_api']['timeout_seconds']
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        raise Exception(f"SD API Error: {str(e)}")
-
-def save_image(b64_data, filename):
-    """Save base64 image data to file"""
-    image_data = base64.b64decode(b64_data)
-    filepath = output_dir / filename
-    with open(filepath, 'wb') as f:
-        f.write(image_data)
+    return backend_pool.generate(payload, output_dir, reference_image)
+
+def save_image(image_path, base_name):
+    """Move a decoded image into place under the first free name for base_name
+
+    Batched jobs finish within the same minute - never overwrite an existing image. The
+    name is claimed with a hard link, which fails if it exists, so workers in this or
+    another process saving the same prompt at once each get their own name.
+    """
+    suffix = 1
+    while True:
+        filename = f"{base_name}.png" if suffix == 1 else f"{base_name}_{suffix}.png"
+        suffix += 1
+        filepath = output_dir / filename
+        # Archived originals hold their name too
+        if storage.exists(filename):
+            continue
+        try:
+            os.link(image_path, filepath)
+        except FileExistsError:
+            continue
+        break
+    os.unlink(image_path)
+    file_index.record(filepath)
     return filepath
 
+if not in_pool_worker():
+    warm_generation_cache()
+
+def backend_gauge(field):
+    """Per-backend value from the pool stats, labelled by backend URL"""
+    return lambda: {(backend['url'],): int(backend[field]) for backend in backend_pool.get_stats()['backends']}
+
+# Live state read when /metrics is scraped
+registry.gauge('sdcpp_queue_depth', 'Jobs waiting in the scheduler queue', lambda: scheduler.get_stats()['queued'])
+registry.gauge('sdcpp_workers_busy', 'Scheduler workers running a backend call', lambda: scheduler.get_stats()['active'])
+registry.gauge('sdcpp_backend_in_flight', 'Generations outstanding per backend', backend_gauge('outstanding'), ('backend',))
+registry.gauge('sdcpp_backend_healthy', 'Backend passed its last health check', backend_gauge('healthy'), ('backend',))
+registry.gauge('sdcpp_event_subscribers', 'Open job event streams', lambda: event_bus.get_stats()['subscribers'])
+registry.gauge('sdcpp_gallery_images', 'Images in the gallery', lambda: db.get_stats()['total'])
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    """Latency histogram by route template - streaming responses count until headers"""
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method, status=response.status_code)
+    return response
+
 @app.route('/')
 def index():
     """Main page"""
@@ -221,45 +614,325 @@ def index():
                          max_prompt_length=config['files']['max_prompt_length'],
                          polling_config=config['polling'])
 
+def parse_generation_params(data):
+    """Validate one generation request, returning (params, error)"""
+    prompt = (data.get('prompt') or '').strip()
+    
+    if not prompt:
+        return None, 'Prompt is required'
+    
+    if len(prompt) > config['files']['max_prompt_length']:
+        return None, 'Prompt too long'
+    
+    params = {
+        'prompt': prompt,
+        'size': data.get('size', config['sd_api']['default_size']),
+        'quality': data.get('quality', 'low'),
+        'seed': data.get('seed'),  # None if not specified
+        'model': data.get('model', config['sd_api']['model'])
+    }
+    
+    if params['model'] not in backend_pool.models():
+        return None, f"Unknown model: {params['model']}"
+    
+    return params, None
+
+def parse_edit_params(data, parent):
+    """Validate an edit request against its parent gallery record, returning (params, error)
+
+    Prompt, size and model default to the parent's; strength comes from the request or
+    the preset for its mode (edits.strength_presets). It is recorded and forwarded, but
+    sd.cpp only applies it to an init image, which its edits endpoint does not set.
+    """
+    presets = config['edits']['strength_presets']
+    mode = data.get('mode') or config['edits']['default_mode']
+    if mode not in presets:
+        return None, f"Unknown edit mode: {mode}"
+    
+    strength = data.get('strength', presets[mode])
+    if isinstance(strength, bool) or not isinstance(strength, (int, float)) or not 0 < strength <= 1:
+        return None, 'Strength must be a number in (0, 1]'
+    
+    defaults = {'prompt': parent['prompt'], 'size': parent.get('size'), 'model': parent.get('model')}
+    params, error = parse_generation_params({**defaults, **{key: value for key, value in data.items() if value is not None}})
+    if error:
+        return None, error
+    
+    params.update(parent=parent['filename'], strength=strength)
+    return params, None
+
+def get_dedup_key(params, client_id, progressive):
+    """Identical active submissions share one job. Without a seed only the same client's
+    resubmission (a double tap) matches - other clients expect an image of their own."""
+    if params['seed'] is None and request.headers.get('X-Client-Id') != client_id:
+        # Users behind one address are not one client - no double-tap matching without a browser id
+        return None
+    owner = client_id if params['seed'] is None else None
+    return (owner, params['prompt'], params['size'], params['quality'], params['seed'], params['model'],
+            params.get('parent'), params.get('strength'), progressive)
+
+def get_client_id():
+    """Identify the caller for round-robin fairness in the queue - the per-browser id the
+    frontend sends, else the client address"""
+    return request.headers.get('X-Client-Id') or get_client_address()
+
+def get_client_address():
+    """The caller's network address (through any trusted proxies) - queue caps are per
+    address, since the browser id is whatever the client chooses to send"""
+    return request.remote_addr
+
+def queue_generation(params, client_id, priority=None, dedup_key=None):
+    """Create a job for validated params and hand it to the worker pool - or attach it
+    to an identical active job (dedup_key)
+
+    Returns (body, status code, headers) for the route to send.
+    """
+    prompt = params['prompt']
+    size_param = params['size']
+    quality_param = params['quality']
+    seed_param = params['seed']
+    model_param = params['model']
+    parent = params.get('parent')
+    strength = params.get('strength')
+    
+    # Create background job
+    client_address = get_client_address()
+    job_id = create_job(prompt, size_param, quality_param, seed_param, client_id, model_param, parent=parent, strength=strength,
+                        run_seed=params.get('run_seed'), draft=params.get('draft', False), priority=priority,
+                        client_address=client_address)
+    
+    # Deterministic resubmissions are answered straight from the generation cache
+    cached_result = get_cached_result(prompt, size_param, quality_param, seed_param, model_param, parent, strength)
+    if cached_result:
+        update_job(job_id, status=JobStatus.COMPLETED, progress=100, message="Generation complete (cached)", result=cached_result)
+        return {
+            'job_id': job_id,
+            'status': JobStatus.COMPLETED,
+            'message': 'Served from cache',
+            'result': cached_result
+        }, 200, {}
+    
+    # Fast-fail while every backend for the model is drained instead of queueing doomed work
+    if not backend_pool.is_available(model_param):
+        update_job(job_id, status=JobStatus.FAILED, error='SD backend unavailable', message='Generation failed: SD backend unavailable')
+        retry_after = backend_pool.retry_after_seconds(model_param)
+        return {'error': 'SD backend unavailable, try again shortly'}, 503, {'Retry-After': str(retry_after)}
+    
+    # An identical request is already running or queued - follow it instead of doing the work twice
+    leader_id = dedup.join(dedup_key, job_id)
+    if leader_id:
+        logger.debug(f"Job {job_id} follows identical job {leader_id}")
+        return {
+            'job_id': job_id,
+            'status': get_job(job_id)['status'],
+            'message': 'Joined an identical request in progress',
+            'deduplicated_with': leader_id
+        }, 200, {}
+    
+    # Hand it to the worker pool
+    batch_key = get_batch_key(prompt, size_param, quality_param, seed_param, model_param, parent, strength, params.get('run_seed'))
+    try:
+        scheduler.submit(job_id, client_id, priority=priority, batch_key=batch_key, model=model_param, address=client_address)
+    except QueueFullError as e:
+        # Fails any identical request that joined in the meantime along with it
+        update_job(job_id, status=JobStatus.FAILED, error=str(e), message=f"Generation failed: {str(e)}")
+        remove_job(job_id)
+        return {'error': str(e)}, 429, {'Retry-After': str(scheduler.retry_after_seconds())}
+    
+    # Return job ID immediately
+    return {
+        'job_id': job_id,
+        'status': 'pending',
+        'message': 'Generation queued',
+        **(scheduler.get_position(job_id) or {})
+    }, 200, {}
+
+def queue_progressive(params, client_id, dedup_key=None):
+    """Progressive mode: a fast draft now, then the requested quality as a lower-priority refinement
+
+    Both runs share one seed, so the refinement is the draft's picture with more steps. A seed
+    picked here is a run_seed: the jobs stay random for the gallery record and the cache.
+    Returns the draft's (body, status code, headers) with the refinement job id added.
+    """
+    progressive_config = config['progressive']
+    draft_quality = progressive_config['draft_quality']
+    if QUALITY_STEPS.get(params['quality'], 4) <= QUALITY_STEPS[draft_quality]:
+        return queue_generation(params, client_id, dedup_key=dedup_key)
+    
+    if params['seed'] is None:
+        params = dict(params, run_seed=random.randint(0, 2147483647))
+    body, status_code, headers = queue_generation(dict(params, quality=draft_quality, draft=True), client_id, dedup_key=dedup_key)
+    if status_code != 200:
+        return body, status_code, headers
+    
+    # A resubmission follows the earlier draft and refinement, whatever seed was picked here
+    refinement_key = dedup_key + ('refinement',) if dedup_key else None
+    refinement, refinement_status, _ = queue_generation(params, client_id, priority=progressive_config['refinement_priority'],
+                                                        dedup_key=refinement_key)
+    if refinement_status != 200:
+        # The draft still stands on its own
+        logger.warning(f"Refinement of job {body['job_id']} not queued: {refinement['error']}")
+        return body, status_code, headers
+    
+    update_job(body['job_id'], refinement_job_id=refinement['job_id'])
+    update_job(refinement['job_id'], draft_job_id=body['job_id'])
+    body['refinement_job_id'] = refinement['job_id']
+    return body, status_code, headers
+
+def cancel_superseded_refinements(client_id):
+    """The client moved on - drop its refinements that have not started, so they never use the GPU"""
+    message = 'Refinement cancelled - superseded by a newer request'
+    for job_id in scheduler.queued_jobs(client_id):
+        job = job_store.get(job_id)
+        if not job or not job.get('draft_job_id'):
+            continue
+        # The client's own resubmissions follow it; another client's identical seeded request keeps it alive
+        for follower_id in dedup.followers(job_id):
+            follower = job_store.get(follower_id)
+            if follower and follower['client_id'] == client_id:
+                cancel_job(follower_id, message)
+        if cancel_job(job_id, message):
+            logger.debug(f"Cancelled superseded refinement {job_id}")
+
+def submit_generation(params, client_id, progressive):
+    """Queue a validated generation or edit for the client - shared by the submit routes"""
+    # Only a browser's own id says who moved on - an address can be shared by many users
+    if config['progressive']['cancel_superseded'] and request.headers.get('X-Client-Id') == client_id:
+        cancel_superseded_refinements(client_id)
+    dedup_key = get_dedup_key(params, client_id, progressive)
+    if progressive:
+        body, status_code, headers = queue_progressive(params, client_id, dedup_key)
+    else:
+        body, status_code, headers = queue_generation(params, client_id, dedup_key=dedup_key)
+    return jsonify(body), status_code, headers
+
 @app.route('/generate', methods=['POST'])
 def generate():
-    """Start async image generation and return job ID"""
+    """Start async image generation and return job ID
+
+    With "progressive": true a fast draft is queued first and the requested quality
+    follows as a refinement job (refinement_job_id in the response).
+    """
     try:
-        data = request.json
-        prompt = data.get('prompt', '').strip()
-        
-        if not prompt:
-            return jsonify({'error': 'Prompt is required'}), 400
+        params, error = parse_generation_params(request.json)
+        if error:
+            return jsonify({'error': error}), 400
         
-        if len(prompt) > config['files']['max_prompt_length']:
-            return jsonify({'error': 'Prompt too long'}), 400
+        return submit_generation(params, get_client_id(), bool(request.json.get('progressive')))
         
-        # Get generation parameters
-        size_param = data.get('size', config['sd_api']['default_size'])
-        quality_param = data.get('quality', 'low')
-        seed_param = data.get('seed')  # None if not specified
-        
-        # Create background job
-        job_id = create_job(prompt, size_param, quality_param, seed_param)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/generate/edit', methods=['POST'])
+def generate_edit():
+    """Start an async edit of a gallery image and return job ID
+
+    JSON: {"filename", "mode": "refine" | "variation", "strength", "prompt", "quality",
+    "seed", "size", "model", "progressive"} - only filename is required. The image in output_dir is
+    streamed to the backend's /v1/images/edits as a reference image (image[]) - a full-cost
+    generation guided by it, so refine and variation differ only in the strength recorded.
+    """
+    try:
+        data = request.json
+        filename = data.get('filename') or ''
+        records = db.get_image_by_filename(filename) if filename else []
+        if not records or not storage.exists(filename):
+            return jsonify({'error': 'Image not found'}), 404
         
-        # Start background processing
-        thread = threading.Thread(
-            target=process_image_generation, 
-            args=(job_id, prompt, size_param, quality_param, seed_param)
-        )
-        thread.daemon = True
-        thread.start()
+        params, error = parse_edit_params(data, records[0])
+        if error:
+            return jsonify({'error': error}), 400
         
-        # Return job ID immediately
-        return jsonify({
-            'job_id': job_id,
-            'status': 'pending',
-            'message': 'Generation started'
-        })
+        return submit_generation(params, get_client_id(), bool(data.get('progressive')))
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/generate/batch', methods=['POST'])
+def generate_batch():
+    """Queue a batch of generations and return one batch ID
+
+    Accepts a JSONL body (one job object per line, Content-Type application/x-ndjson),
+    or JSON with either {"jobs": [...]} or {"sweep": {"prompt", "seeds" | "seed_range" |
+    "count", "qualities", "sizes", "models"}}.
+    """
+    try:
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            lines = request.get_data(as_text=True).splitlines()
+            specs = [json.loads(line) for line in lines if line.strip()]
+        else:
+            data = request.json
+            specs = expand_sweep(data['sweep']) if 'sweep' in data else data.get('jobs', [])
+    except (ValueError, TypeError, KeyError) as e:
+        return jsonify({'error': f'Invalid batch: {str(e)}'}), 400
+    
+    if not specs:
+        return jsonify({'error': 'Batch is empty'}), 400
+    
+    if len(specs) > batch_manager.max_jobs:
+        return jsonify({'error': f'Batch too large (max {batch_manager.max_jobs} jobs)'}), 400
+    
+    # Validate everything before creating any job
+    validated = []
+    for index, spec in enumerate(specs):
+        params, error = parse_generation_params(spec)
+        if error:
+            return jsonify({'error': f'Job {index}: {error}'}), 400
+        validated.append(params)
+    
+    client_id = get_client_id()
+    batch_id = str(uuid.uuid4())
+    batch_jobs = []
+    for index, params in enumerate(validated):
+        job_id = create_job(params['prompt'], params['size'], params['quality'], params['seed'],
+                            f"batch:{batch_id}", params['model'], batch_id, message='Waiting in batch',
+                            priority=batch_manager.priority, batch_index=index, client_address=get_client_address())
+        cached_result = get_cached_result(params['prompt'], params['size'], params['quality'], params['seed'], params['model'])
+        if cached_result:
+            update_job(job_id, status=JobStatus.COMPLETED, progress=100, message="Generation complete (cached)", result=cached_result)
+        batch_key = get_batch_key(params['prompt'], params['size'], params['quality'], params['seed'], params['model'])
+        batch_jobs.append((job_id, params, batch_key))
+    
+    batch_manager.create(batch_id, f"batch:{batch_id}", batch_jobs)
+    logger.info(f"Batch {batch_id} submitted by {client_id}")
+    
+    return jsonify({
+        'batch_id': batch_id,
+        'total': len(batch_jobs),
+        'job_ids': [job_id for job_id, _, _ in batch_jobs],
+        'status_url': f'/generate/batch/{batch_id}',
+        'manifest_url': f'/generate/batch/{batch_id}/manifest'
+    })
+
+@app.route('/generate/batch/<batch_id>', methods=['GET'])
+def get_batch_status(batch_id):
+    """Aggregate progress of a batch"""
+    status = batch_manager.get_status(batch_id)
+    if not status:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify(status)
+
+@app.route('/generate/batch/<batch_id>/manifest', methods=['GET'])
+def get_batch_manifest(batch_id):
+    """Per-job results of a batch in submission order"""
+    manifest = batch_manager.get_manifest(batch_id)
+    if not manifest:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify(manifest)
+
+@app.route('/generate/cancel/<job_id>', methods=['POST'])
+def cancel_generation(job_id):
+    """Cancel a queued or running job - queued work never reaches a backend, a running
+    call's images are discarded"""
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if not cancel_job(job_id):
+        return jsonify({'error': 'Job already finished', **build_job_status(job)}), 409
+    
+    return jsonify(build_job_status(get_job(job_id)))
+
 @app.route('/generate/status/<job_id>', methods=['GET'])
 def get_generation_status(job_id):
     """Get the status of a generation job"""
@@ -270,51 +943,226 @@ def get_generation_status(job_id):
         logger.warning(f"Status check for unknown job: {job_id}")
         return jsonify({'error': 'Job not found'}), 404
     
-    response = {
-        'job_id': job_id,
-        'status': job['status'],
-        'progress': job['progress'],
-        'message': job['message'],
-        'created_at': job['created_at']
-    }
+    return jsonify(build_job_status(job))
+
+SSE_KEEP_ALIVE = ": keep-alive\n\n"
+
+def format_sse(event):
+    """One Server-Sent Events message"""
+    return f"data: {json.dumps(event)}\n\n"
+
+def status_changed(last, current):
+    """Whether a re-read job status differs from what the stream last sent"""
+    return (current['status'], current['progress'], current['message']) != (last['status'], last['progress'], last['message'])
+
+@app.route('/generate/events/<job_id>')
+def stream_generation_events(job_id):
+    """Server-Sent Events stream of a job's state transitions and queue position
+
+    Sends the current state first, then every change until the job finishes.
+    Idle streams block on their subscription and only wake for heartbeats.
+    """
+    # Subscribe before reading the snapshot so no transition is missed in between
+    subscription = event_bus.subscribe(job_id)
+    job = get_job(job_id)
+    if not job:
+        event_bus.unsubscribe(subscription)
+        return jsonify({'error': 'Job not found'}), 404
     
-    if job['status'] == JobStatus.COMPLETED and job['result']:
-        response['result'] = job['result']
-        logger.debug(f"Job {job_id}: Returning completed result")
-    elif job['status'] == JobStatus.FAILED and job['error']:
-        response['error'] = job['error']
-        logger.debug(f"Job {job_id}: Returning error: {job['error']}")
+    def stream(last):
+        try:
+            yield format_sse(last)
+            while last['status'] not in JobStatus.FINISHED:
+                events = subscription.wait(event_bus.heartbeat_seconds)
+                if not events:
+                    # The job may be running in another web worker - check the shared store
+                    job = get_job(job_id)
+                    if not job:
+                        return
+                    current = build_job_status(job)
+                    if not status_changed(last, current):
+                        # Comment line keeps proxies from closing an idle connection
+                        yield SSE_KEEP_ALIVE
+                        continue
+                    events = [current]
+                for event in events:
+                    yield format_sse(event)
+                    last = event
+        finally:
+            event_bus.unsubscribe(subscription)
+    
+    response = Response(stream(build_job_status(job)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/system/stats')
+def api_system_stats():
+    """API endpoint for scheduler and backend runtime statistics"""
+    return jsonify({
+        'scheduler': scheduler.get_stats(),
+        'backend': backend_pool.get_stats(),
+        'cache': generation_cache.get_stats(),
+        'events': event_bus.get_stats(),
+        'jobs': job_store.get_stats(),
+        'dedup': dedup.get_stats(),
+        'batches': batch_manager.get_stats(),
+        'file_index': file_index.get_stats(),
+        'similarity': hash_index.get_stats(),
+        'storage': storage.get_stats()
+    })
+
+def send_generated_file(directory, filename, mimetype=None):
+    """Serve a generated file with range and conditional request support
+
+    Generated files never change in place, so a request whose ?v= matches the file's
+    current version is cacheable forever; anything else must revalidate. A .br/.gz
+    sibling is sent instead when one exists and the client accepts that encoding.
+    """
+    path = Path(directory) / filename
+    info = file_index.lookup(path)
+    if info is None:
+        return send_from_directory(directory, filename)  # 404
+    
+    mimetype = mimetype or mimetypes.guess_type(filename)[0]
+    sent_name, encoding, has_variants = filename, None, False
+    for encoding_name, suffix in PRECOMPRESSED:
+        if file_index.exists(path.with_name(path.name + suffix)):
+            has_variants = True
+            if encoding is None and encoding_name in request.accept_encodings:
+                sent_name, encoding = filename + suffix, encoding_name
     
-    return jsonify(response)
+    # Without a max_age the response is sent as no-cache, so clients revalidate
+    versioned = request.args.get('v') == version_token(info)
+    max_age = config['files']['immutable_max_age_seconds'] if versioned else None
+    response = send_from_directory(directory, sent_name, mimetype=mimetype, max_age=max_age)
+    if versioned:
+        response.cache_control.immutable = True
+    if encoding:
+        response.content_encoding = encoding
+    if has_variants:
+        response.vary.add('Accept-Encoding')
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/images/<filename>')
 def serve_image(filename):
-    """Serve generated images"""
-    return send_from_directory(output_dir, filename)
+    """Serve generated images - archived originals are promoted back on first request"""
+    storage.record_access(output_dir / filename)
+    storage.ensure_hot(filename)
+    return send_generated_file(output_dir, filename)
+
+@app.route('/drafts/<filename>')
+def serve_draft(filename):
+    """Serve a progressive draft preview - unique per job, gone after the draft TTL"""
+    return send_from_directory(drafts_dir, filename, max_age=config['progressive']['draft_ttl_seconds'])
 
 @app.route('/thumbs/<filename>')
 def serve_thumbnail(filename):
     """Serve thumbnail images"""
     thumbs_dir = Path(config['files']['thumbs_dir'])
-    return send_from_directory(thumbs_dir, filename)
+    storage.record_access(thumbs_dir / filename)
+    return send_generated_file(thumbs_dir, filename)
+
+@app.route('/derivatives/<size_name>/<filename>')
+def serve_derivative(size_name, filename):
+    """Serve a responsive derivative - explicit format by extension, or negotiated
+    from the Accept header when the original .png name is requested"""
+    derivatives_dir = Path(config['files']['derivatives_dir']) / size_name
+    if not filename.endswith('.png'):
+        storage.record_access(derivatives_dir / filename)
+        return send_generated_file(derivatives_dir, filename)
+    
+    negotiated = image_service.negotiate_derivative(size_name, filename, request.accept_mimetypes)
+    if negotiated:
+        path, mimetype = negotiated
+        storage.record_access(path)
+        response = send_generated_file(derivatives_dir, path.name, mimetype=mimetype)
+    else:
+        storage.record_access(output_dir / filename)
+        storage.ensure_hot(filename)
+        response = send_generated_file(output_dir, filename)
+    response.vary.add('Accept')
+    return response
 
 @app.route('/gallery')
 def gallery():
     """Gallery page"""
     return render_template('gallery.html')
 
+def gallery_validators():
+    """Current gallery ETag and Last-Modified - metadata plus derived images"""
+    db_token, db_modified = db.validators()
+    etag = f"{db_token}-{image_service.change_token}"
+    return etag, max(db_modified, image_service.last_modified)
+
+def gallery_not_modified():
+    """304 response when the client's copy matches the current gallery state"""
+    etag, last_modified = gallery_validators()
+    if request.if_none_match:
+        if request.if_none_match.contains(etag):
+            return app.response_class(status=304)
+    elif request.if_modified_since and request.if_modified_since >= last_modified:
+        return app.response_class(status=304)
+    return None
+
+def with_gallery_validators(response):
+    """Attach ETag/Last-Modified so clients revalidate instead of refetching"""
+    etag, last_modified = gallery_validators()
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/api/gallery')
 def api_gallery():
-    """API endpoint for gallery data - combines AI metadata with live file info"""
-    page = int(request.args.get('page', 1))
-    per_page = int(request.args.get('per_page', config['gallery']['items_per_page']))
+    """API endpoint for gallery data - combines AI metadata with live file info
+
+    Pass ?after=<timestamp,id> (empty for the first page) for keyset pagination;
+    page/per_page offset pagination is kept for older clients.
+    """
+    not_modified = gallery_not_modified()
+    if not_modified:
+        return not_modified
+    
+    try:
+        gallery_data = load_gallery_page(request.args)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    return with_gallery_validators(jsonify(gallery_data))
+
+def load_gallery_page(args):
+    """One gallery page for the query args, enriched for display - raises ValueError on a bad cursor"""
+    per_page = int(args.get('per_page', config['gallery']['items_per_page']))
     
-    gallery_data = db.get_paginated_images(page, per_page)
+    if 'after' in args:
+        gallery_data = db.get_images_after(args['after'] or None, per_page)
+    else:
+        page = int(args.get('page', 1))
+        gallery_data = db.get_paginated_images(page, per_page)
     
-    # Enrich with thumbnail URLs and live file info
-    for image in gallery_data['images']:
-        image['thumbnail_url'] = image_service.get_thumbnail_url(image['filename'])
-        image['image_url'] = f"/images/{image['filename']}"
+    enrich_gallery_images(gallery_data['images'])
+    return gallery_data
+
+def search_gallery(args):
+    """Prompt search page for the query args, enriched like a gallery page - raises ValueError on a bad cursor"""
+    per_page = int(args.get('per_page', config['gallery']['items_per_page']))
+    filters = {key: args.get(key) for key in ('model', 'size', 'quality', 'date_from', 'date_to')}
+    results = db.search_images(args.get('q', ''), filters, args.get('after') or None, per_page)
+    enrich_gallery_images(results['images'])
+    return results
+
+def enrich_gallery_images(images):
+    """Add thumbnail URLs and live file info - missing thumbnails are queued, not rendered inline"""
+    for image in images:
+        image.update(image_service.get_thumbnail(image['filename']))
+        image.update(image_service.get_variants(image['filename'], image.get('size')))
+        image['image_url'] = image_url(image['filename'])
         
         # Add live filesystem data
         file_info = get_file_info(image['filename'])
@@ -322,14 +1170,69 @@ def api_gallery():
             image.update(file_info)  # Add file_size, created_at, modified_at
         else:
             image['file_exists'] = False
+
+@app.route('/api/gallery/search')
+def api_gallery_search():
+    """Search prompts - ?q=words (prefix matched, all required) with optional
+    model/size/quality/date_from/date_to filters; returns facet counts for the matches
+    and pages with ?after=<next_cursor>
+    """
+    not_modified = gallery_not_modified()
+    if not_modified:
+        return not_modified
     
-    return jsonify(gallery_data)
+    try:
+        results = search_gallery(request.args)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    return with_gallery_validators(jsonify(results))
+
+@app.route('/api/gallery/similar/<filename>')
+def api_gallery_similar(filename):
+    """Images that look like filename - ?max_distance=<bits>&limit=<n>&hash=phash|dhash"""
+    hash_name = request.args.get('hash', 'phash')
+    if hash_name not in HASHES:
+        return jsonify({'error': f"hash must be one of {', '.join(HASHES)}"}), 400
+    max_distance = request.args.get('max_distance', type=int)
+    limit = request.args.get('limit', config['gallery']['items_per_page'], type=int)
+    
+    matches = image_service.find_similar(filename, max_distance, limit, hash_name)
+    if matches is None:
+        return jsonify({'error': 'Image not indexed'}), 404
+    
+    return jsonify({
+        'filename': filename,
+        'similar': [{
+            'filename': match,
+            'distance': distance,
+            'image_url': image_url(match),
+            'thumbnail_url': image_service.get_thumbnail_url(match)
+        } for match, distance in matches]
+    })
+
+@app.route('/api/gallery/duplicates')
+def api_gallery_duplicates():
+    """Dedup report - groups of near-identical images, ?max_distance=<bits>"""
+    groups = hash_index.duplicate_groups(request.args.get('max_distance', type=int))
+    return jsonify({
+        'groups': groups,
+        'redundant_files': sum(len(group) - 1 for group in groups)
+    })
 
 @app.route('/api/gallery/stats')
 def api_gallery_stats():
     """API endpoint for gallery statistics"""
+    not_modified = gallery_not_modified()
+    if not_modified:
+        return not_modified
+    
     stats = db.get_stats()
-    return jsonify(stats)
+    return with_gallery_validators(jsonify(stats))
+
+# Take over orphaned jobs last - recovery runs them through every function and service above
+if not in_pool_worker():
+    job_store.start(on_recover=recover_jobs)
 
 if __name__ == '__main__':
     app.run(
@@ -0,0 +1,174 @@
+"""
+ASGI entry point - asyncio serving mode
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+or  python asgi.py
+
+Job status, the SSE event stream and the gallery API are served by async routes,
+so thousands of waiting clients share one event loop instead of a thread each.
+SD backend calls run on the same loop through an async HTTP client. Blocking work
+(database reads, file stats, thumbnail scheduling) goes to a small fixed executor,
+and every other route falls through to the Flask app.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from email.utils import format_datetime, parsedate_to_datetime
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+# Importing the Flask module loads config and starts the shared services
+import app as webapp
+from services.jobs import JobStatus
+from services.metrics import REQUEST_SECONDS
+
+config = webapp.config
+executor = ThreadPoolExecutor(max_workers=config['app']['async_executor_threads'], thread_name_prefix='asgi-io')
+
+
+async def run_blocking(function, *args):
+    """Run blocking work on the fixed executor"""
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+@asynccontextmanager
+async def lifespan(_):
+    webapp.backend_pool.start_async(asyncio.get_running_loop())
+    yield
+    await webapp.backend_pool.aclose()
+    executor.shutdown(wait=False)
+
+
+async def generation_status(request):
+    """Get the status of a generation job"""
+    job = await run_blocking(webapp.get_job, request.path_params['job_id'])
+    if not job:
+        return JSONResponse({'error': 'Job not found'}, status_code=404)
+    return JSONResponse(await run_blocking(webapp.build_job_status, job))
+
+
+async def generation_events(request):
+    """Server-Sent Events stream of a job's state transitions and queue position"""
+    job_id = request.path_params['job_id']
+    # Subscribe before reading the snapshot so no transition is missed in between
+    subscription = webapp.event_bus.subscribe(job_id, asyncio.get_running_loop())
+    job = await run_blocking(webapp.get_job, job_id)
+    if not job:
+        webapp.event_bus.unsubscribe(subscription)
+        return JSONResponse({'error': 'Job not found'}, status_code=404)
+
+    async def stream(last):
+        try:
+            yield webapp.format_sse(last)
+            while last['status'] not in JobStatus.FINISHED:
+                events = await subscription.wait(webapp.event_bus.heartbeat_seconds)
+                if not events:
+                    # The job may be running in another web worker - check the shared store
+                    job = await run_blocking(webapp.get_job, job_id)
+                    if not job:
+                        return
+                    current = await run_blocking(webapp.build_job_status, job)
+                    if not webapp.status_changed(last, current):
+                        yield webapp.SSE_KEEP_ALIVE
+                        continue
+                    events = [current]
+                for event in events:
+                    yield webapp.format_sse(event)
+                    last = event
+        finally:
+            webapp.event_bus.unsubscribe(subscription)
+
+    first = await run_blocking(webapp.build_job_status, job)
+    return StreamingResponse(stream(first), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def gallery_not_modified(request):
+    """True when the client's copy matches the current gallery state"""
+    etag, last_modified = webapp.gallery_validators()
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or f'"{etag}"' in tags
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(if_modified_since) >= last_modified
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def with_gallery_validators(response):
+    """Attach ETag/Last-Modified so clients revalidate instead of refetching"""
+    etag, last_modified = webapp.gallery_validators()
+    response.headers['ETag'] = f'"{etag}"'
+    response.headers['Last-Modified'] = format_datetime(last_modified, usegmt=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+async def api_gallery(request):
+    """Gallery page - same query parameters and payload as the Flask route"""
+    if gallery_not_modified(request):
+        return with_gallery_validators(Response(status_code=304))
+    try:
+        gallery_data = await run_blocking(webapp.load_gallery_page, request.query_params)
+    except ValueError:
+        return JSONResponse({'error': 'Invalid cursor'}, status_code=400)
+    return with_gallery_validators(JSONResponse(gallery_data))
+
+
+async def api_gallery_search(request):
+    """Prompt search - same query parameters and payload as the Flask route"""
+    if gallery_not_modified(request):
+        return with_gallery_validators(Response(status_code=304))
+    try:
+        results = await run_blocking(webapp.search_gallery, request.query_params)
+    except ValueError:
+        return JSONResponse({'error': 'Invalid cursor'}, status_code=400)
+    return with_gallery_validators(JSONResponse(results))
+
+
+async def api_gallery_stats(request):
+    """Gallery statistics"""
+    if gallery_not_modified(request):
+        return with_gallery_validators(Response(status_code=304))
+    stats = await run_blocking(webapp.db.get_stats)
+    return with_gallery_validators(JSONResponse(stats))
+
+
+def timed_route(path, endpoint):
+    """Route whose latency lands in the same histogram, under the same label, as Flask's"""
+    route = path.replace('{', '<').replace('}', '>')
+
+    async def handler(request):
+        started = time.perf_counter()
+        response = await endpoint(request)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method, status=response.status_code)
+        return response
+
+    return Route(path, handler)
+
+
+app = Starlette(
+    routes=[
+        timed_route('/generate/status/{job_id}', generation_status),
+        timed_route('/generate/events/{job_id}', generation_events),
+        timed_route('/api/gallery', api_gallery),
+        timed_route('/api/gallery/search', api_gallery_search),
+        timed_route('/api/gallery/stats', api_gallery_stats),
+        # Everything else - generation, batches, images, pages - stays on Flask
+        Mount('/', WSGIMiddleware(webapp.app, workers=config['app']['async_executor_threads']))
+    ],
+    lifespan=lifespan
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host=config['app']['host'], port=config['app']['port'])
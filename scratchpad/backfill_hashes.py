@@ -0,0 +1,50 @@
+"""
+Perceptual-hash existing images for similar-image lookups and dedup reports
+Bulk backfill across all CPU cores - run from the project root:
+    python -m scratchpad.backfill_hashes
+"""
+import json
+import os
+from services.database import open_gallery_db
+from services.images import ImageService
+from services.similarity import HashIndex
+
+
+def main():
+    # Load configuration
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+
+    # Initialize services
+    hash_index = HashIndex(config)
+    image_service = ImageService(config, hash_index=hash_index)
+    db = open_gallery_db(config)
+
+    filenames = sorted({image['filename'] for image in db.get_all_images()})
+    missing = [name for name in filenames if name not in hash_index]
+
+    print(f"Hashing {len(missing)} of {len(filenames)} images on {os.cpu_count()} cores...")
+
+    hashed = 0
+    failed = 0
+
+    for filename, error in image_service.backfill_hashes(missing):
+        if error:
+            print(f"✗ Failed to hash: {filename} ({error})")
+            failed += 1
+        else:
+            hashed += 1
+
+    print(f"\nHash backfill complete!")
+    print(f"- Hashed: {hashed} images")
+    print(f"- Failed: {failed} images")
+    print(f"- Skipped (already indexed): {len(filenames) - len(missing)} images")
+
+    groups = hash_index.duplicate_groups()
+    if groups:
+        print(f"- Near-duplicate groups: {len(groups)} ({sum(len(group) - 1 for group in groups)} redundant files)")
+
+
+# Pool workers re-import this module - only the launching process runs the backfill
+if __name__ == '__main__':
+    main()
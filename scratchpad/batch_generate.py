@@ -0,0 +1,91 @@
+"""
+Run a batch of generations against a running app and save the manifest
+Either a JSONL prompt file (one {"prompt", "size", "quality", "seed", "model"} per line)
+or a sweep over seeds and quality levels for one prompt:
+
+    python scratchpad/batch_generate.py prompts.jsonl --output manifest.json
+    python scratchpad/batch_generate.py --prompt "a red fox" --seeds 1-8 --qualities low,high
+"""
+import argparse
+import json
+import sys
+import time
+
+import requests
+
+
+def parse_seeds(value):
+    """'1-8' -> seed_range, '1,5,9' -> explicit seeds"""
+    if '-' in value:
+        start, end = (int(part) for part in value.split('-', 1))
+        return {'seed_range': {'start': start, 'count': end - start + 1}}
+    return {'seeds': [int(part) for part in value.split(',')]}
+
+
+def submit(args):
+    url = f"{args.server}/generate/batch"
+    if args.jsonl:
+        with open(args.jsonl, 'rb') as f:
+            return requests.post(url, data=f.read(), headers={'Content-Type': 'application/x-ndjson'})
+
+    sweep = {'prompt': args.prompt}
+    if args.seeds:
+        sweep.update(parse_seeds(args.seeds))
+    else:
+        sweep['count'] = args.count
+    if args.qualities:
+        sweep['qualities'] = args.qualities.split(',')
+    if args.sizes:
+        sweep['sizes'] = args.sizes.split(',')
+    return requests.post(url, json={'sweep': sweep})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch image generation')
+    parser.add_argument('jsonl', nargs='?', help='JSONL file with one job per line')
+    parser.add_argument('--prompt', help='sweep a single prompt instead of reading a file')
+    parser.add_argument('--seeds', help="seed sweep: range '1-8' or list '1,5,9'")
+    parser.add_argument('--count', type=int, default=1, help='random-seed images when no --seeds')
+    parser.add_argument('--qualities', help="comma separated, e.g. 'low,medium,high'")
+    parser.add_argument('--sizes', help="comma separated, e.g. '512x512,768x768'")
+    parser.add_argument('--server', default='http://localhost:5000')
+    parser.add_argument('--output', help='manifest file (default: <batch_id>.json)')
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between progress checks')
+    args = parser.parse_args()
+
+    if not args.jsonl and not args.prompt:
+        parser.error('give a JSONL file or --prompt')
+
+    response = submit(args)
+    batch = response.json()
+    if not response.ok:
+        print(f"✗ Batch rejected: {batch.get('error')}")
+        sys.exit(1)
+
+    batch_id = batch['batch_id']
+    print(f"Batch {batch_id}: {batch['total']} job(s) queued")
+
+    while True:
+        status = requests.get(f"{args.server}{batch['status_url']}").json()
+        counts = status['counts']
+        print(f"\r{status['progress']:3d}% - {counts['completed']} done, {counts['failed']} failed, "
+              f"{counts['processing']} running, {counts['pending']} waiting", end='', flush=True)
+        if status['done']:
+            break
+        time.sleep(args.interval)
+    print()
+
+    manifest = requests.get(f"{args.server}{batch['manifest_url']}").json()
+    output = args.output or f"{batch_id}.json"
+    with open(output, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    failed = [job for job in manifest['jobs'] if job['status'] != 'completed']
+    print(f"✓ Manifest written to {output}")
+    if failed:
+        print(f"✗ {len(failed)} job(s) failed")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
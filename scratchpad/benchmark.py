@@ -0,0 +1,402 @@
+"""
+Benchmarks - end-to-end load test and gallery/imaging micro-benchmarks
+Run from the project root:
+    python -m scratchpad.benchmark load --duration 60 --generators 8 --gallery-readers 4
+    python -m scratchpad.benchmark micro --sizes 1000 10000 100000
+
+load starts sd_stub_server.py and app.py (asgi.py with --asgi) in a scratch
+directory, drives concurrent generate+poll and gallery traffic, and reports
+p50/p95/p99 latency and throughput per operation, plus the server's own
+generation stage timings from /metrics.
+
+micro builds galleries of each size on each storage backend and times pagination,
+stats and search, plus thumbnail rendering of realistic originals.
+
+Both print fixed-layout tables so runs can be compared; --json also saves the numbers.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import requests
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+from scratchpad.sd_stub_server import make_realistic_png  # noqa: E402
+from services.database import open_gallery_db  # noqa: E402
+from services.images import ImageService  # noqa: E402
+
+PROMPT_WORDS = 'cat dog boat sunset castle forest neon city portrait dragon ocean mountain river robot garden'.split()
+SIZES = ('256x256', '512x512', '768x768', '1024x1024')
+QUALITIES = ('low', 'medium', 'high')
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def summarize(samples, elapsed):
+    """Latency percentiles in ms and rate per second"""
+    return {
+        'count': len(samples),
+        'per_second': round(len(samples) / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 2),
+        'max_ms': round(max(samples) * 1000, 2)
+    }
+
+
+def print_table(title, columns, rows):
+    widths = [max(len(str(column)), *(len(str(row.get(column, ''))) for row in rows)) for column in columns]
+    print(f"\n{title}")
+    print('  '.join(str(column).ljust(width) for column, width in zip(columns, widths)))
+    print('  '.join('-' * width for width in widths))
+    for row in rows:
+        print('  '.join(str(row.get(column, '')).ljust(width) for column, width in zip(columns, widths)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_config(workdir, backend_url=None):
+    """config.json.sample with every file and directory moved under workdir"""
+    config = json.loads((REPO / 'config.json.sample').read_text())
+    for key, value in config['files'].items():
+        if key.endswith('_dir'):
+            config['files'][key] = str(workdir / value)
+    for section, key in (('gallery', 'db_file'), ('gallery', 'sqlite_file'), ('jobs', 'sqlite_file'),
+                         ('batch', 'manifest_dir'), ('storage', 'archive_dir'), ('storage', 'state_db'),
+                         ('similarity', 'index_file')):
+        config[section][key] = str(workdir / config[section][key])
+    if backend_url:
+        config['sd_api']['backends'] = [{'url': backend_url, 'model': 'bench', 'weight': 1, 'concurrency': 1}]
+        config['sd_api']['model'] = 'bench'
+    return config
+
+
+def fake_records(count, seed=0):
+    """Gallery records spread over the past year, newest last"""
+    rng = random.Random(seed)
+    start = datetime.now() - timedelta(days=365)
+    step = timedelta(days=365) / max(count, 1)
+    for index in range(count):
+        quality = rng.choice(QUALITIES)
+        yield {
+            'id': index + 1,
+            'filename': f"bench_{index:06d}.png",
+            'prompt': ' '.join(rng.sample(PROMPT_WORDS, 4)),
+            'model': 'bench',
+            'size': rng.choice(SIZES),
+            'quality': quality,
+            'generation_timestamp': (start + step * index).isoformat(),
+            'parameters': {'steps': {'low': 4, 'medium': 10, 'high': 20}[quality], 'seed': rng.randrange(2 ** 31),
+                           'user_seed': None, 'method': 'Euler'}
+        }
+
+
+def seed_gallery(config, count, sample_png):
+    """Fill a gallery with count records; every file is a hard link to one sample image"""
+    output_dir = Path(config['files']['output_dir'])
+    output_dir.mkdir(parents=True, exist_ok=True)
+    records = list(fake_records(count))
+    db = open_gallery_db(config)
+    if config['gallery']['backend'] == 'sqlite':
+        db.import_records(records)
+    else:
+        db.images.insert_multiple(records)
+
+    for record in records:
+        target = output_dir / record['filename']
+        if not target.exists():
+            os.link(sample_png, target)
+
+
+# Load test
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.samples[name].append(seconds)
+
+    def error(self, name):
+        with self._lock:
+            self.errors[name] += 1
+
+
+def generator_client(index, base_url, deadline, recorder, args):
+    """Submit a generation, poll it to completion, repeat"""
+    session = requests.Session()
+    headers = {'X-Client-Id': f"bench-{index}"}
+    rng = random.Random(index)
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            response = session.post(f"{base_url}/generate", headers=headers, json={
+                'prompt': ' '.join(rng.sample(PROMPT_WORDS, 3)), 'size': args.size, 'quality': args.quality})
+        except requests.RequestException:
+            recorder.error('generate')
+            time.sleep(1)
+            continue
+        recorder.record('generate', time.perf_counter() - started)
+        if response.status_code != 200:
+            recorder.error('generate')
+            time.sleep(float(response.headers.get('Retry-After', 1)))
+            continue
+
+        job_id = response.json()['job_id']
+        status = None
+        # Jobs submitted before the deadline may finish after it
+        while time.monotonic() < deadline + args.drain_seconds:
+            time.sleep(args.poll_interval)
+            polled = time.perf_counter()
+            try:
+                status = session.get(f"{base_url}/generate/status/{job_id}").json()['status']
+            except (requests.RequestException, ValueError, KeyError):
+                recorder.error('status')
+                continue
+            recorder.record('status', time.perf_counter() - polled)
+            if status in ('completed', 'failed'):
+                break
+        if status == 'completed':
+            recorder.record('job', time.perf_counter() - started)
+        else:
+            recorder.error('job')
+
+
+def gallery_client(index, base_url, deadline, recorder):
+    """Page through the gallery, checking stats every few pages"""
+    session = requests.Session()
+    cursor = ''
+    requests_made = 0
+    while time.monotonic() < deadline:
+        name, url, params = 'gallery', f"{base_url}/api/gallery", {'after': cursor, 'per_page': 20}
+        if requests_made % 5 == 4:
+            name, url, params = 'gallery_stats', f"{base_url}/api/gallery/stats", {}
+        started = time.perf_counter()
+        try:
+            response = session.get(url, params=params)
+            response.raise_for_status()
+        except requests.RequestException:
+            recorder.error(name)
+            time.sleep(0.5)
+            continue
+        recorder.record(name, time.perf_counter() - started)
+        if name == 'gallery':
+            cursor = response.json().get('next_cursor') or ''
+        requests_made += 1
+
+
+def wait_until_up(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def stage_timings(base_url):
+    """Mean seconds per generation stage, from the server's /metrics"""
+    text = requests.get(f"{base_url}/metrics").text
+    sums = dict(re.findall(r'sdcpp_generation_stage_seconds_sum\{stage="(\w+)"\} (\S+)', text))
+    counts = dict(re.findall(r'sdcpp_generation_stage_seconds_count\{stage="(\w+)"\} (\S+)', text))
+    return [{'stage': stage, 'count': int(float(counts[stage])),
+             'mean_ms': round(float(sums[stage]) / float(counts[stage]) * 1000, 2)}
+            for stage in sorted(sums) if float(counts.get(stage, 0))]
+
+
+def run_load(args):
+    workdir = Path(tempfile.mkdtemp(prefix='sdcpp-bench-'))
+    stub_port, app_port = free_port(), free_port()
+    base_url = f"http://127.0.0.1:{app_port}"
+    config = make_config(workdir, f"http://127.0.0.1:{stub_port}/v1/images/generations")
+    config['app'].update({'host': '127.0.0.1', 'port': app_port, 'debug': False})
+    (workdir / 'config.json').write_text(json.dumps(config, indent=2))
+
+    if args.gallery_size:
+        sample_png = workdir / 'sample.png'
+        sample_png.write_bytes(make_realistic_png(512, 512, 0))
+        seed_gallery(config, args.gallery_size, sample_png)
+
+    log_file = open(workdir / 'server.log', 'w')
+    processes = []
+    try:
+        processes.append(subprocess.Popen([
+            sys.executable, str(REPO / 'scratchpad' / 'sd_stub_server.py'), '--port', str(stub_port),
+            '--delay', str(args.stub_delay), '--step-seconds', str(args.step_seconds),
+            '--jitter', str(args.jitter), '--payload', 'realistic', '--quiet'], stdout=log_file, stderr=subprocess.STDOUT))
+        server = 'asgi.py' if args.asgi else 'app.py'
+        processes.append(subprocess.Popen([sys.executable, str(REPO / server)], cwd=workdir,
+                                          stdout=log_file, stderr=subprocess.STDOUT))
+        wait_until_up(f"{base_url}/api/system/stats", 60)
+        print(f"Running {server} against the stub for {args.duration}s: {args.generators} generators, "
+              f"{args.gallery_readers} gallery readers (work dir {workdir})")
+
+        recorder = Recorder()
+        deadline = time.monotonic() + args.duration
+        threads = [threading.Thread(target=generator_client, args=(index, base_url, deadline, recorder, args))
+                   for index in range(args.generators)]
+        threads += [threading.Thread(target=gallery_client, args=(index, base_url, deadline, recorder))
+                    for index in range(args.gallery_readers)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        rows = [{'operation': name, **summarize(samples, elapsed), 'errors': recorder.errors.get(name, 0)}
+                for name, samples in sorted(recorder.samples.items())]
+        stages = stage_timings(base_url)
+        print_table(f"Latency over {elapsed:.1f}s", ['operation', 'count', 'per_second', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'errors'], rows)
+        print_table('Server generation stages (mean)', ['stage', 'count', 'mean_ms'], stages)
+        completed = len(recorder.samples.get('job', []))
+        print(f"\nThroughput: {completed} jobs in {elapsed:.1f}s = {completed / elapsed:.2f} jobs/s")
+        return {'mode': 'load', 'server': server, 'elapsed_seconds': round(elapsed, 2), 'operations': rows,
+                'stages': stages, 'jobs_per_second': round(completed / elapsed, 3), 'options': vars(args)}
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+        log_file.close()
+        if args.keep:
+            print(f"Kept {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Micro-benchmarks
+
+def time_op(function, setup=None, min_runs=3, max_runs=50, budget_seconds=2.0):
+    """Run function repeatedly (after one warm-up) within a time budget; returns the timings"""
+    if setup:
+        setup()
+    function()
+    timings = []
+    spent = 0.0
+    while len(timings) < min_runs or (len(timings) < max_runs and spent < budget_seconds):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+        spent += timings[-1]
+    return timings
+
+
+def micro_row(operation, backend, size, timings):
+    return {
+        'operation': operation, 'backend': backend, 'images': size, 'runs': len(timings),
+        'p50_ms': round(percentile(timings, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(timings, 0.95) * 1000, 3),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3)
+    }
+
+
+def run_micro(args):
+    workdir = Path(tempfile.mkdtemp(prefix='sdcpp-micro-'))
+    sample_png = workdir / 'sample.png'
+    sample_png.write_bytes(make_realistic_png(512, 512, 0))
+    rows = []
+    try:
+        for backend in args.backends:
+            for size in args.sizes:
+                config = make_config(workdir / f"{backend}-{size}")
+                config['gallery']['backend'] = backend
+                print(f"Building {size} image {backend} gallery...", flush=True)
+                seed_gallery(config, size, sample_png)
+                db = open_gallery_db(config)
+                db.reconcile_stats()
+                last_page = max(1, size // 20)
+
+                for operation, function in (
+                        ('get_paginated_images page 1', lambda: db.get_paginated_images(1, 20)),
+                        ('get_paginated_images last page', lambda: db.get_paginated_images(last_page, 20)),
+                        ('get_images_after first page', lambda: db.get_images_after(None, 20)),
+                        ('get_stats', db.get_stats),
+                        ('reconcile_stats', db.reconcile_stats),
+                        ('search_images', lambda: db.search_images('boat sun', {'quality': 'high'}, None, 20))):
+                    rows.append(micro_row(operation, backend, size, time_op(function, budget_seconds=args.budget)))
+                    print(f"  {operation}: {rows[-1]['p50_ms']} ms", flush=True)
+
+        # Thumbnail rendering does not depend on gallery size - time it per source resolution
+        config = make_config(workdir / 'thumbs')
+        Path(config['files']['output_dir']).mkdir(parents=True)
+        image_service = ImageService(config)
+        for edge in (512, 1024):
+            filename = f"source_{edge}.png"
+            (image_service.output_dir / filename).write_bytes(make_realistic_png(edge, edge, edge))
+            thumb_path = image_service.thumbs_dir / filename
+            timings = time_op(lambda: image_service.generate_thumbnail(filename),
+                              setup=lambda: thumb_path.unlink(missing_ok=True), budget_seconds=args.budget)
+            rows.append(micro_row(f"generate_thumbnail {edge}x{edge}", '-', '-', timings))
+
+        print_table('Micro-benchmarks', ['operation', 'backend', 'images', 'runs', 'p50_ms', 'p95_ms', 'mean_ms'], rows)
+        return {'mode': 'micro', 'results': rows, 'options': vars(args)}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--json', help='also write the results to this file')
+    parser = argparse.ArgumentParser(description='Load test and micro-benchmarks against a stub SD backend')
+    modes = parser.add_subparsers(dest='mode', required=True)
+
+    load = modes.add_parser('load', parents=[common], help='end-to-end load test of app.py against the stub server')
+    load.add_argument('--duration', type=float, default=30, help='seconds of traffic')
+    load.add_argument('--generators', type=int, default=4, help='clients submitting and polling generations')
+    load.add_argument('--gallery-readers', type=int, default=4, help='clients paging through the gallery')
+    load.add_argument('--poll-interval', type=float, default=0.5, help='seconds between status polls')
+    load.add_argument('--drain-seconds', type=float, default=60, help='how long to wait for jobs still running at the end')
+    load.add_argument('--size', default='512x512')
+    load.add_argument('--quality', default='low', choices=QUALITIES)
+    load.add_argument('--gallery-size', type=int, default=1000, help='records to pre-load into the gallery')
+    load.add_argument('--stub-delay', type=float, default=0.2, help='stub fixed seconds per call')
+    load.add_argument('--step-seconds', type=float, default=0.05, help='stub seconds per step per 512x512 image')
+    load.add_argument('--jitter', type=float, default=0.1, help='stub call time variation')
+    load.add_argument('--asgi', action='store_true', help='run asgi.py instead of app.py')
+    load.add_argument('--keep', action='store_true', help='keep the scratch directory and server log')
+
+    micro = modes.add_parser('micro', parents=[common], help='gallery and thumbnail micro-benchmarks')
+    micro.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='gallery sizes')
+    micro.add_argument('--backends', nargs='+', default=['sqlite', 'tinydb'], choices=['sqlite', 'tinydb'])
+    micro.add_argument('--budget', type=float, default=2.0, help='seconds to spend timing each operation')
+
+    args = parser.parse_args()
+    results = run_load(args) if args.mode == 'load' else run_micro(args)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+        print(f"\nWrote {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,50 +1,52 @@
 """
-Generate thumbnails for existing images
+Generate thumbnails and responsive derivatives for existing images
+Bulk backfill across all CPU cores - run from the project root:
+    python -m scratchpad.generate_thumbs
 """
 import json
-from pathlib import Path
+import os
+from services.database import open_gallery_db
 from services.images import ImageService
 
-# Load configuration
-with open('config.json', 'r') as f:
-    config = json.load(f)
-
-# Initialize image service
-image_service = ImageService(config)
-
-# Load gallery database
-with open(config['gallery']['db_file'], 'r') as f:
-    db_data = json.load(f)
-
-print("Generating thumbnails for existing images...")
-
-generated = 0
-skipped = 0
-
-for entry in db_data['images'].values():
-    filename = entry['filename']
-    
-    # Check if thumbnail already exists
-    thumb_path = Path(config['files']['thumbs_dir']) / filename
-    if thumb_path.exists():
-        print(f"✓ Thumbnail exists: {filename}")
-        skipped += 1
-        continue
-    
-    # Generate thumbnail
-    result = image_service.generate_thumbnail(filename)
-    if result:
-        print(f"✓ Generated thumbnail: {filename}")
-        generated += 1
-    else:
-        print(f"✗ Failed to generate thumbnail: {filename}")
-
-print(f"\nThumbnail generation complete!")
-print(f"- Generated: {generated} thumbnails")
-print(f"- Skipped (already existed): {skipped} thumbnails")
-print(f"- Total images processed: {len(db_data['images'])}")
-
-# Cleanup any orphaned thumbnails
-cleaned = image_service.cleanup_thumbnails()
-if cleaned > 0:
-    print(f"- Cleaned up: {cleaned} orphaned thumbnails")
\ No newline at end of file
+
+def main():
+    # Load configuration
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+
+    # Initialize services
+    image_service = ImageService(config)
+    db = open_gallery_db(config)
+
+    filenames = sorted({image['filename'] for image in db.get_all_images()})
+    # Images with a thumbnail may still lack WebP/AVIF derivatives
+    missing = [name for name in filenames if image_service.needs_renders(name)]
+
+    print(f"Rendering thumbnails and derivatives for {len(missing)} of {len(filenames)} images on {os.cpu_count()} cores...")
+
+    generated = 0
+    failed = 0
+
+    for filename, error in image_service.backfill_thumbnails(missing):
+        if error:
+            print(f"✗ Failed to render: {filename} ({error})")
+            failed += 1
+        else:
+            print(f"✓ Rendered: {filename}")
+            generated += 1
+
+    print(f"\nThumbnail generation complete!")
+    print(f"- Rendered: {generated} images")
+    print(f"- Failed: {failed} images")
+    print(f"- Skipped (everything already existed): {len(filenames) - len(missing)} images")
+    print(f"- Total images processed: {len(filenames)}")
+
+    # Cleanup any orphaned thumbnails
+    cleaned = image_service.cleanup_thumbnails()
+    if cleaned > 0:
+        print(f"- Cleaned up: {cleaned} orphaned thumbnails")
+
+
+# Pool workers re-import this module - only the launching process runs the backfill
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+One-time migration of the TinyDB gallery (gallery.json) into the SQLite backend
+Safe to re-run: records are imported with their original ids and existing ids are skipped
+"""
+import json
+import os
+from tinydb import TinyDB
+from services.database import SQLiteGalleryDB
+
+# Load configuration
+with open('config.json', 'r') as f:
+    config = json.load(f)
+
+db_file = config['gallery']['db_file']
+sqlite_file = config['gallery']['sqlite_file']
+
+if not os.path.exists(db_file):
+    print(f"No TinyDB gallery found at {db_file}, nothing to migrate")
+    raise SystemExit(0)
+
+# Read every TinyDB document, using the document id when a record has no id of its own
+source = TinyDB(db_file).table('images')
+records = []
+for document in source.all():
+    record = dict(document)
+    record.setdefault('id', document.doc_id)
+    records.append(record)
+
+print(f"Found {len(records)} images in {db_file}")
+
+# Duplicate ids in old data would be silently dropped - give them fresh ids instead
+seen_ids = set()
+next_id = max((record['id'] for record in records), default=0) + 1
+for record in sorted(records, key=lambda x: x.get('generation_timestamp', '')):
+    if record['id'] in seen_ids:
+        print(f"Re-numbering duplicate id {record['id']} ({record['filename']}) -> {next_id}")
+        record['id'] = next_id
+        next_id += 1
+    seen_ids.add(record['id'])
+
+gallery = SQLiteGalleryDB(config)
+imported = gallery.import_records(records)
+
+print(f"\nMigration complete!")
+print(f"- Imported {imported} new entries")
+print(f"- Skipped (already migrated): {len(records) - imported}")
+print(f"- Total images in database: {gallery.count_images()}")
+print(f"- Database saved to: {sqlite_file}")
+print("Set gallery.backend to \"sqlite\" in config.json to switch over")
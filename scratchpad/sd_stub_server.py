@@ -0,0 +1,183 @@
+"""
+Local stub of the sd.cpp server for exercising the SD client without a GPU
+Mimics GET /v1/models, POST /v1/images/generations and the multipart
+POST /v1/images/edits from server-main.cpp, including the single generation
+mutex and the n clamp (1-8).
+
+    python scratchpad/sd_stub_server.py --port 4242 --delay 0.5 --fail-rate 0.2
+
+Latency model: delay + step_seconds x steps x images x (pixels / 512x512), with
++/- jitter; edits cost the same as generations - the server uses image[] as a
+reference image, not an init image, so strength saves no steps. --payload realistic returns noisy
+PNGs about the size real outputs compress to; the default solid-colour images are tiny.
+
+Point an sd_api.backends url at http://127.0.0.1:4242/v1/images/generations
+"""
+import argparse
+import base64
+import io
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+# Mirrors sd_ctx_mutex - the real server runs one generation at a time
+generation_lock = threading.Lock()
+
+
+# Realistic payloads are expensive to encode - keep a few per size and reuse them
+REALISTIC_POOL_SIZE = 8
+_realistic_pool = {}
+_pool_lock = threading.Lock()
+
+
+def make_png(width, height, seed):
+    """Deterministic solid-colour PNG for a seed"""
+    rng = random.Random(seed)
+    colour = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), colour).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def make_realistic_png(width, height, seed):
+    """Gradient plus noise PNG - compresses about as badly as a real generation"""
+    key = (width, height, seed % REALISTIC_POOL_SIZE)
+    with _pool_lock:
+        if key not in _realistic_pool:
+            rng = random.Random(seed)
+            base = Image.linear_gradient('L').resize((width, height)).rotate(rng.randrange(360))
+            channels = []
+            for _ in range(3):
+                # Coarse texture for structure, a little fine grain for entropy
+                texture = Image.effect_noise((width // 4, height // 4), 50).resize((width, height), Image.Resampling.BICUBIC)
+                channel = Image.blend(base, texture, 0.5)
+                channels.append(Image.blend(channel, Image.effect_noise((width, height), 30), 0.1))
+            buffer = io.BytesIO()
+            Image.merge('RGB', channels).save(buffer, 'PNG')
+            _realistic_pool[key] = buffer.getvalue()
+        return _realistic_pool[key]
+
+
+def generation_seconds(options, steps, count, width, height):
+    """Simulated compute time for one call"""
+    seconds = options.delay + options.step_seconds * steps * count * (width * height) / (512 * 512)
+    return max(0.0, seconds * random.uniform(1 - options.jitter, 1 + options.jitter))
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def parse_multipart(body, content_type):
+    """{field name: bytes} of a multipart/form-data body"""
+    match = re.search(r'boundary=("?)([^";]+)\1', content_type or '')
+    if not match:
+        raise ValueError('missing boundary')
+    fields = {}
+    for part in body.split(b'--' + match.group(2).encode('ascii'))[1:-1]:
+        headers, _, value = part[2:].partition(b'\r\n\r\n')
+        name = re.search(rb'name="([^"]+)"', headers)
+        if name:
+            fields[name.group(1).decode('utf-8')] = value[:-2]  # trailing CRLF before the boundary
+    return fields
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like cpp-httplib
+    options = None
+
+    def log_message(self, format, *args):
+        if not self.options.quiet:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/v1/models':
+            self.send_json(200, {'data': [{'id': 'sd-cpp-local', 'object': 'model', 'owned_by': 'local'}]})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def read_edit_request(self, body):
+        """Multipart edit form as the same dict shape as a generation request"""
+        fields = parse_multipart(body, self.headers.get('Content-Type'))
+        image = fields.pop('image[]', None) or fields.pop('image', None)
+        if not image or not image.startswith(PNG_SIGNATURE):
+            raise ValueError('image required')
+        return {name: value.decode('utf-8') for name, value in fields.items()}
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if self.path not in ('/v1/images/generations', '/v1/images/edits'):
+            self.send_json(404, {'error': 'not found'})
+            return
+
+        if random.random() < self.options.fail_rate:
+            self.send_json(500, {'error': 'server_error', 'message': 'stub injected failure'})
+            return
+
+        try:
+            request = self.read_edit_request(body) if self.path == '/v1/images/edits' else json.loads(body)
+        except ValueError as e:
+            self.send_json(400, {'error': f'invalid request: {e}'})
+            return
+
+        if not request.get('prompt'):
+            self.send_json(400, {'error': 'prompt required'})
+            return
+
+        count = min(max(int(request.get('n', 1)), 1), 8)
+        width, height = (int(part) for part in request.get('size', '512x512').split('x'))
+        seed = random.randrange(2 ** 31)
+        steps = 20
+        if '<sd_cpp_extra_args>' in request['prompt']:
+            extra = json.loads(request['prompt'].split('<sd_cpp_extra_args>')[1].split('</sd_cpp_extra_args>')[0])
+            seed = extra.get('seed', seed)
+            steps = extra.get('steps', steps)
+
+        render = make_realistic_png if self.options.payload == 'realistic' else make_png
+        with generation_lock:
+            time.sleep(generation_seconds(self.options, steps, count, width, height))
+            images = [render(width, height, seed + index) for index in range(count)]
+
+        self.send_json(200, {
+            'created': datetime.now().isoformat(),
+            'data': [{'b64_json': base64.b64encode(image).decode('ascii')} for image in images],
+            'output_format': 'png'
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub sd.cpp server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4242)
+    parser.add_argument('--delay', type=float, default=0.5, help='fixed seconds per generation call')
+    parser.add_argument('--step-seconds', type=float, default=0.0,
+                        help='seconds per sampling step for one 512x512 image, scaled by pixels and n')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+/- fraction of random variation in call time')
+    parser.add_argument('--payload', choices=('solid', 'realistic'), default='solid', help='generated image content')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of calls answered with 500')
+    parser.add_argument('--quiet', action='store_true')
+    options = parser.parse_args()
+
+    StubHandler.options = options
+    server = ThreadingHTTPServer((options.host, options.port), StubHandler)
+    print(f"Stub SD server on http://{options.host}:{options.port} (delay {options.delay}s, "
+          f"{options.step_seconds}s/step, {options.payload} payloads, fail rate {options.fail_rate})")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
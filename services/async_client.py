@@ -0,0 +1,97 @@
+"""
+asyncio HTTP client for the sd.cpp server (ASGI serving mode)
+Same retry, breaker and streaming-decode behaviour as SDClient, but the wait on
+the backend is an awaitable on the event loop instead of a blocked socket read.
+Requires httpx - only imported when the app runs under asgi.py.
+"""
+import asyncio
+import time
+
+import httpx
+
+from services.metrics import STAGE_SECONDS
+from services.sd_client import BaseSDClient, SDBackendError, SDRequestError, BackendUnavailableError, _RetryableStatus
+from services.streaming import B64ImageStreamDecoder
+
+
+class AsyncSDClient(BaseSDClient):
+    def __init__(self, config, url, breaker=None):
+        super().__init__(config, url, breaker)
+        # One keep-alive connection pool for every in-flight generation
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+        )
+
+    async def generate(self, payload, target_dir, reference_image=None):
+        """POST a generation request and stream the images into temp files in target_dir;
+        with a reference_image path, an edit against /v1/images/edits"""
+        started = time.perf_counter()
+
+        async def consume(response):
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage='backend_call')
+            decoder = B64ImageStreamDecoder(target_dir)
+            try:
+                with STAGE_SECONDS.time(stage='decode'):
+                    # Base64 decoding and file writes run on a thread - the loop also
+                    # serves every SSE stream and must not stall on a large response
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        await asyncio.to_thread(decoder.feed, chunk)
+                    return await asyncio.to_thread(decoder.close)
+            except Exception:
+                decoder.abort()
+                raise
+
+        if reference_image is None:
+            return await self._call(consume, self.url, json=payload)
+        with self.edit_body(payload, reference_image) as body:
+            return await self._call(consume, self.edits_url, content=body.async_stream(), headers=body.headers())
+
+    async def _call(self, consume, url, **request_args):
+        """Run one backend call with retries, feeding the streamed response to consume()"""
+        if not self.breaker.allow():
+            raise BackendUnavailableError('SD backend unavailable, try again shortly')
+
+        self._record_call()
+
+        attempt = 0
+        while True:
+            try:
+                async with self.client.stream('POST', url, **request_args) as response:
+                    if response.status_code >= 500 and attempt < self.max_retries:
+                        raise _RetryableStatus(response.status_code)
+                    if response.status_code >= 400:
+                        self._raise_for_status(response.status_code)
+                    result = await consume(response)
+                self.breaker.record_success()
+                return result
+
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError, _RetryableStatus) as e:
+                if attempt >= self.max_retries:
+                    self._record_failure()
+                    raise SDBackendError(f"SD API Error: {e}")
+                attempt += 1
+                await asyncio.sleep(self._next_retry_delay(attempt, e))
+
+            except SDBackendError:
+                raise
+
+            except httpx.HTTPError as e:
+                self._record_failure()
+                raise SDBackendError(f"SD API Error: {e}")
+
+            except Exception:
+                # Malformed body - count it against the backend
+                self._record_failure()
+                raise
+
+    def _raise_for_status(self, status_code):
+        # 4xx means the backend is alive but rejected the request
+        if status_code < 500:
+            self.breaker.record_success()
+            raise SDRequestError(f"SD API Error: backend returned {status_code}")
+        self._record_failure()
+        raise SDBackendError(f"SD API Error: backend returned {status_code}")
+
+    async def aclose(self):
+        await self.client.aclose()
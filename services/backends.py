@@ -0,0 +1,191 @@
+"""
+Pool of sd.cpp backends
+Each server runs one generation at a time (sd_ctx_mutex), so throughput comes from
+running several. Jobs are routed to the healthy backend serving the requested model
+with the fewest outstanding requests relative to its weight; backends that fail
+health probes or trip their circuit breaker are drained until they recover.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+import requests
+
+from services.sd_client import SDClient, SDBackendError, SDRequestError, BackendUnavailableError
+
+logger = logging.getLogger(__name__)
+
+
+def backend_configs(sd_config):
+    """sd_api.backends, or a single sd_api.url (serving sd_api.model) as a one-backend pool"""
+    if 'backends' in sd_config:
+        return sd_config['backends']
+    return [{'url': sd_config['url'], 'model': sd_config['model'], 'weight': 1, 'concurrency': 1}]
+
+
+class Backend:
+    """One sd.cpp server with its own client, breaker and concurrency limit"""
+
+    def __init__(self, config, backend_config):
+        self.url = backend_config['url']
+        self.model = backend_config['model']
+        self.weight = backend_config['weight']
+        self.concurrency = backend_config['concurrency']
+        self.client = SDClient(config, self.url)
+        # Set in ASGI mode - shares the blocking client's breaker
+        self.async_client = None
+        self.healthy = True
+        self.outstanding = 0
+
+    @property
+    def available(self):
+        return self.healthy and not self.client.breaker.is_open()
+
+    def load(self):
+        """Outstanding requests scaled by weight - lower is preferred"""
+        return (self.outstanding + 1) / self.weight
+
+
+class BackendPool:
+    def __init__(self, config):
+        self.config = config
+        sd_config = config['sd_api']
+        self.backends = [Backend(config, backend_config) for backend_config in backend_configs(sd_config)]
+        self.health_interval = sd_config['health_check_interval_seconds']
+        self.probe_timeout = sd_config['connect_timeout_seconds']
+        self._cond = threading.Condition()
+        self._prober = None
+        self._loop = None
+
+    @property
+    def capacity(self):
+        """Total concurrent generations across all backends - the scheduler's worker count"""
+        return sum(backend.concurrency for backend in self.backends)
+
+    def model_capacity(self):
+        """Concurrent generations per model - the scheduler dispatches no more than that"""
+        capacity = {}
+        for backend in self.backends:
+            capacity[backend.model] = capacity.get(backend.model, 0) + backend.concurrency
+        return capacity
+
+    def models(self):
+        """Models served by at least one configured backend"""
+        return sorted({backend.model for backend in self.backends})
+
+    def start(self):
+        """Start the background health prober"""
+        self._prober = threading.Thread(target=self._probe_loop, name='sd-health-probe')
+        self._prober.daemon = True
+        self._prober.start()
+        logger.info(f"Backend pool started with {len(self.backends)} backend(s), capacity {self.capacity}")
+
+    def start_async(self, loop):
+        """Route backend calls through asyncio clients on loop (ASGI serving mode)"""
+        from services.async_client import AsyncSDClient
+
+        for backend in self.backends:
+            backend.async_client = AsyncSDClient(self.config, backend.url, backend.client.breaker)
+        self._loop = loop
+        logger.info('Backend calls now run on the asyncio event loop')
+
+    async def aclose(self):
+        self._loop = None
+        for backend in self.backends:
+            if backend.async_client:
+                await backend.async_client.aclose()
+
+    def is_available(self, model):
+        """Whether any backend serving model can currently take work"""
+        return any(backend.available for backend in self.backends if backend.model == model)
+
+    def retry_after_seconds(self, model):
+        """Shortest wait until a drained backend for model may be tried again"""
+        waits = [backend.client.breaker.retry_after_seconds() for backend in self.backends
+                 if backend.model == model and backend.client.breaker.is_open()]
+        return min(waits, default=self.health_interval)
+
+    def generate(self, payload, target_dir, reference_image=None):
+        """Run a generation on the least-loaded backend for payload['model'], failing over
+        to another backend when one goes down mid-call. reference_image makes it an edit."""
+        tried = set()
+        while True:
+            backend = self._acquire(payload['model'], tried)
+            try:
+                return self._generate_on(backend, payload, target_dir, reference_image)
+            except SDRequestError:
+                # The backend rejected the request - another one would too
+                raise
+            except SDBackendError as e:
+                tried.add(backend)
+                logger.warning(f"Backend {backend.url} failed ({e}), trying another")
+                if not any(candidate.model == payload['model'] and candidate not in tried for candidate in self.backends):
+                    raise
+            finally:
+                self._release(backend)
+
+    def _generate_on(self, backend, payload, target_dir, reference_image):
+        loop = self._loop
+        if loop is None:
+            return backend.client.generate(payload, target_dir, reference_image)
+        # Socket I/O happens on the event loop; the worker only waits for the result
+        return asyncio.run_coroutine_threadsafe(backend.async_client.generate(payload, target_dir, reference_image), loop).result()
+
+    def _acquire(self, model, exclude):
+        """Reserve a slot on the best backend, waiting while all candidates are busy"""
+        with self._cond:
+            while True:
+                candidates = [backend for backend in self.backends
+                              if backend.model == model and backend not in exclude and backend.available]
+                if not candidates:
+                    raise BackendUnavailableError(f"No SD backend available for model {model}")
+                free = [backend for backend in candidates if backend.outstanding < backend.concurrency]
+                if free:
+                    backend = min(free, key=Backend.load)
+                    backend.outstanding += 1
+                    return backend
+                self._cond.wait()
+
+    def _release(self, backend):
+        with self._cond:
+            backend.outstanding -= 1
+            self._cond.notify_all()
+
+    def _probe_loop(self):
+        while True:
+            for backend in self.backends:
+                self._probe(backend)
+            with self._cond:
+                # Wake workers waiting on a backend that just came back
+                self._cond.notify_all()
+            time.sleep(self.health_interval)
+
+    def _probe(self, backend):
+        """GET /v1/models - drain the backend on failure, restore it on success"""
+        try:
+            response = backend.client.session.get(backend.client.models_url, timeout=self.probe_timeout)
+            healthy = response.ok
+        except requests.RequestException:
+            healthy = False
+
+        if healthy != backend.healthy:
+            logger.warning(f"Backend {backend.url} {'recovered' if healthy else 'failed health check, draining'}")
+        backend.healthy = healthy
+
+    def get_stats(self):
+        """Per-backend load, health and call counters"""
+        with self._cond:
+            return {
+                'capacity': self.capacity,
+                'available': sum(1 for backend in self.backends if backend.available),
+                'async': self._loop is not None,
+                'backends': [{
+                    **(backend.async_client or backend.client).get_stats(),
+                    'model': backend.model,
+                    'weight': backend.weight,
+                    'concurrency': backend.concurrency,
+                    'outstanding': backend.outstanding,
+                    'healthy': backend.healthy
+                } for backend in self.backends]
+            }
@@ -0,0 +1,234 @@
+"""
+Batch generation runs
+A batch is a list of job specs (from a JSONL upload or an expanded seed/quality sweep).
+All jobs are created up front, then a feeder trickles them into the scheduler a few at
+a time - grouped by batch key so compatible jobs land together and share backend calls -
+without flooding the queue ahead of interactive users. Finished batches write a manifest.
+"""
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+from services.jobs import JobStatus
+from services.scheduler import QueueFullError
+
+logger = logging.getLogger(__name__)
+
+
+def expand_sweep(sweep):
+    """Expand {"prompt", "seeds" | "seed_range" | "count", "qualities", "sizes", "models"}
+    into individual job specs - the cartesian product of every listed dimension"""
+    prompt = sweep.get('prompt', '')
+    if 'seeds' in sweep:
+        seeds = list(sweep['seeds'])
+    elif 'seed_range' in sweep:
+        seeds = list(range(sweep['seed_range']['start'], sweep['seed_range']['start'] + sweep['seed_range']['count']))
+    else:
+        # Random seeds - identical specs, so they coalesce into batched backend calls
+        seeds = [None] * sweep.get('count', 1)
+
+    specs = []
+    for quality, size, model, seed in itertools.product(sweep.get('qualities', [None]), sweep.get('sizes', [None]),
+                                                        sweep.get('models', [None]), seeds):
+        spec = {'prompt': prompt, 'seed': seed}
+        for key, value in (('quality', quality), ('size', size), ('model', model)):
+            if value is not None:
+                spec[key] = value
+        specs.append(spec)
+    return specs
+
+
+class BatchRun:
+    def __init__(self, batch_id, client_id, jobs, created_at=None):
+        self.id = batch_id
+        self.client_id = client_id
+        self.created_at = created_at or datetime.now().isoformat()
+        # jobs: list of (job_id, spec, batch_key) in submission order
+        self.job_ids = [job_id for job_id, _, _ in jobs]
+        self.specs = {job_id: spec for job_id, spec, _ in jobs}
+        self.batch_keys = {job_id: batch_key for job_id, _, batch_key in jobs}
+        # Group compatible jobs so neighbours can be coalesced by the scheduler
+        first_seen = {}
+        for job_id in self.job_ids:
+            first_seen.setdefault(self.batch_keys[job_id] or job_id, len(first_seen))
+        self.to_submit = deque(sorted(self.job_ids, key=lambda job_id: first_seen[self.batch_keys[job_id] or job_id]))
+        self.in_flight = set()
+        self.finished_at = None
+
+
+class BatchManager:
+    def __init__(self, config, get_job, update_job):
+        self.config = config
+        batch_config = config['batch']
+        self.max_jobs = batch_config['max_jobs']
+        self.max_in_flight = batch_config['max_in_flight']
+        self.priority = batch_config['priority']
+        self.feed_interval = batch_config['feed_interval_seconds']
+        self.manifest_dir = Path(batch_config['manifest_dir'])
+        self.manifest_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = config['jobs']['ttl_seconds']
+        self.get_job = get_job
+        self.update_job = update_job
+        self.scheduler = None
+        self._cond = threading.Condition()
+        self._batches = {}
+
+    def start(self, scheduler):
+        """Start feeding batch jobs into the scheduler"""
+        self.scheduler = scheduler
+        feeder = threading.Thread(target=self._feed_loop, name='batch-feeder')
+        feeder.daemon = True
+        feeder.start()
+
+    def create(self, batch_id, client_id, jobs):
+        """Register a batch of already created jobs - list of (job_id, spec, batch_key)"""
+        with self._cond:
+            self._batches[batch_id] = BatchRun(batch_id, client_id, jobs)
+            self._cond.notify()
+        logger.info(f"Created batch {batch_id} with {len(jobs)} job(s)")
+        return batch_id
+
+    def restore(self, batch_id, client_id, jobs, pending, created_at=None):
+        """Re-register a batch taken over from a stopped worker - jobs is the whole batch
+        in its original order, only the ids in pending are fed to the scheduler again"""
+        batch = BatchRun(batch_id, client_id, jobs, created_at)
+        batch.to_submit = deque(job_id for job_id in batch.to_submit if job_id in pending)
+        with self._cond:
+            self._batches[batch_id] = batch
+            self._cond.notify()
+        logger.info(f"Recovered batch {batch_id} with {len(batch.to_submit)} of {len(jobs)} job(s) left")
+        return batch_id
+
+    def wake(self):
+        """Re-check in-flight jobs now instead of at the next feed interval"""
+        with self._cond:
+            self._cond.notify()
+
+    def get_status(self, batch_id):
+        """Aggregate progress over every job in the batch, or None if unknown"""
+        with self._cond:
+            batch = self._batches.get(batch_id)
+            if batch is None:
+                return None
+            job_ids = list(batch.job_ids)
+            created_at, finished_at = batch.created_at, batch.finished_at
+
+        counts = {status: 0 for status in JobStatus.ACTIVE + JobStatus.FINISHED}
+        progress = 0
+        for job in map(self.get_job, job_ids):
+            if job:
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+                progress += job['progress']
+
+        return {
+            'batch_id': batch_id,
+            'total': len(job_ids),
+            'counts': counts,
+            'progress': round(progress / len(job_ids)) if job_ids else 100,
+            'done': finished_at is not None,
+            'created_at': created_at,
+            'finished_at': finished_at
+        }
+
+    def get_manifest(self, batch_id):
+        """Per-job results in the original order - live while running, from disk once written"""
+        with self._cond:
+            batch = self._batches.get(batch_id)
+        if batch is not None:
+            return self._build_manifest(batch)
+
+        path = self.manifest_path(batch_id)
+        if path.exists():
+            with open(path, 'r') as f:
+                return json.load(f)
+        return None
+
+    def manifest_path(self, batch_id):
+        return self.manifest_dir / f"{batch_id}.json"
+
+    def _build_manifest(self, batch):
+        entries = []
+        for index, job_id in enumerate(batch.job_ids):
+            job = self.get_job(job_id) or {}
+            result = job.get('result') or {}
+            entries.append({
+                'index': index,
+                'job_id': job_id,
+                **batch.specs[job_id],
+                'status': job.get('status'),
+                'filename': result.get('filename'),
+                'url': result.get('url'),
+                'actual_seed': result.get('seed'),
+                'cached': result.get('cached', False),
+                'error': job.get('error')
+            })
+        return {
+            'batch_id': batch.id,
+            'created_at': batch.created_at,
+            'finished_at': batch.finished_at,
+            'jobs': entries
+        }
+
+    def _feed_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.feed_interval)
+                batches = list(self._batches.values())
+            for batch in batches:
+                try:
+                    self._feed(batch)
+                except Exception:
+                    logger.exception(f"Feeding batch {batch.id} failed")
+            self._expire()
+
+    def _feed(self, batch):
+        """Top the batch up to max_in_flight queued/running jobs"""
+        if batch.finished_at:
+            return
+        for job_id in list(batch.in_flight):
+            job = self.get_job(job_id)
+            if not job or job['status'] in JobStatus.FINISHED:
+                batch.in_flight.discard(job_id)
+
+        while batch.to_submit and len(batch.in_flight) < self.max_in_flight:
+            job_id = batch.to_submit[0]
+            job = self.get_job(job_id)
+            if job and job['status'] == JobStatus.PENDING:
+                try:
+                    self.scheduler.submit(job_id, batch.client_id, priority=job.get('priority', self.priority),
+                                          batch_key=batch.batch_keys[job_id], model=job['model'],
+                                          address=job.get('client_address'))
+                except QueueFullError:
+                    # Queue is busy - try again on the next tick
+                    break
+                batch.in_flight.add(job_id)
+                self.update_job(job_id, message='Queued for processing')
+            batch.to_submit.popleft()
+
+        if not batch.to_submit and not batch.in_flight:
+            batch.finished_at = datetime.now().isoformat()
+            with open(self.manifest_path(batch.id), 'w') as f:
+                json.dump(self._build_manifest(batch), f, indent=2)
+            logger.info(f"Batch {batch.id} finished, manifest written to {self.manifest_path(batch.id)}")
+
+    def _expire(self):
+        """Forget finished batches after the job TTL - their manifest stays on disk"""
+        cutoff = datetime.fromtimestamp(time.time() - self.ttl_seconds).isoformat()
+        with self._cond:
+            for batch_id in [batch_id for batch_id, batch in self._batches.items()
+                             if batch.finished_at and batch.finished_at < cutoff]:
+                del self._batches[batch_id]
+
+    def get_stats(self):
+        with self._cond:
+            running = [batch for batch in self._batches.values() if not batch.finished_at]
+            return {
+                'running': len(running),
+                'waiting_jobs': sum(len(batch.to_submit) for batch in running),
+                'in_flight_jobs': sum(len(batch.in_flight) for batch in running)
+            }
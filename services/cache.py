@@ -0,0 +1,100 @@
+"""
+Content-addressed generation cache
+Maps a hash of (prompt, model, size, generation parameters) to an existing output file.
+Only deterministic requests (explicit seed) are cacheable.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+
+class GenerationCache:
+    def __init__(self, config, storage):
+        self.config = config
+        cache_config = config['cache']
+        self.enabled = cache_config['enabled']
+        self.max_entries = cache_config['max_entries']
+        self.max_bytes = cache_config['max_size_mb'] * 1024 * 1024
+        # Cached files may have moved to the archive tier - ask storage, which reads the file index
+        self.storage = storage
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (filename, file_size), most recently used last
+        self._total_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @staticmethod
+    def make_key(prompt, model, size, params):
+        """Hash the normalized request - params are the embedded sd.cpp parameters"""
+        normalized = {
+            'prompt': ' '.join(prompt.split()),
+            'model': model,
+            'size': size.lower(),
+            'params': params
+        }
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def lookup(self, key):
+        """Get the cached filename for a key, or None on a miss"""
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and not self.storage.exists(entry[0]):
+                # File was removed behind our back
+                self._drop(key)
+                entry = None
+
+            if entry is None:
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def store(self, key, filename, file_size):
+        """Remember the output file for a key, evicting least recently used entries"""
+        if not self.enabled:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (filename, file_size)
+            self._total_bytes += file_size
+
+            while self._entries and (len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self._evictions += 1
+
+    def invalidate_filename(self, filename):
+        """Forget any entries pointing at a deleted file"""
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[0] == filename]:
+                self._drop(key)
+
+    def get_stats(self):
+        """Get hit/miss counters and current occupancy"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'size_mb': round(self._total_bytes / (1024 * 1024), 2),
+                'max_size_mb': self.config['cache']['max_size_mb'],
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_rate': round(self._hits / lookups, 3) if lookups else None
+            }
+
+    def _drop(self, key):
+        filename, file_size = self._entries.pop(key)
+        self._total_bytes -= file_size
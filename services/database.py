@@ -1,29 +1,61 @@
 """
-Database service for image metadata storage using TinyDB
+Database service for image metadata storage
+Pluggable backends: TinyDB (simple JSON file) or SQLite (indexed, WAL mode)
 Simple, lightweight, config-driven approach
 """
 import json
-from datetime import datetime
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
 from tinydb import TinyDB, Query
 from pathlib import Path
 import os
 
-class GalleryDB:
+from services.search import FACETS, PromptIndex, date_bounds, facet_counts, fts_query, matches_filters
+from services.stats import GalleryStats
+
+logger = logging.getLogger(__name__)
+
+
+def open_gallery_db(config):
+    """Create the gallery backend selected by config['gallery']['backend']"""
+    backend = config['gallery']['backend']
+    if backend == 'sqlite':
+        return SQLiteGalleryDB(config)
+    if backend == 'tinydb':
+        return GalleryDB(config)
+    raise ValueError(f"Unknown gallery backend: {backend}")
+
+
+class BaseGalleryDB:
+    """Behaviour shared by every gallery backend"""
+
     def __init__(self, config):
         self.config = config
-        self.db_path = config['gallery']['db_file']
-        self.db = TinyDB(self.db_path)
-        self.images = self.db.table('images')
-    
-    def add_image(self, filename, prompt, model=None, size=None, quality='low', seed=None, actual_seed=None):
-        """Add AI-specific metadata with generation parameters"""
-        
+        self.output_dir = Path(config['files']['output_dir'])
+        self.stats = GalleryStats()
+        self.touch()
+
+    def touch(self):
+        """Record a gallery change - drives ETag/Last-Modified without querying storage"""
+        self.change_token = f"{time.time_ns():x}"
+        self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+
+    def validators(self):
+        """(change token, Last-Modified) of the gallery for conditional requests"""
+        return self.change_token, self.last_modified
+
+    def build_metadata(self, filename, prompt, model=None, size=None, quality='low', seed=None, actual_seed=None,
+                       parent=None, strength=None):
+        """Build AI-specific metadata with generation parameters; edits link to their parent image"""
+
         # Map quality to steps for display
         quality_steps = {'low': 4, 'medium': 10, 'high': 20}
         steps = quality_steps.get(quality, 4)
-        
+
         metadata = {
-            'id': len(self.images) + 1,
             'filename': filename,  # Reference to file only
             # AI Generation Parameters (what we actually control)
             'prompt': prompt,
@@ -39,35 +71,135 @@ class GalleryDB:
                 'method': 'Euler'     # Fixed by server
             }
         }
-        
-        return self.images.insert(metadata)
-    
+        if parent:
+            # Edits: the gallery image sent as the reference image, and the strength requested
+            metadata['parent'] = parent
+            metadata['parameters']['strength'] = strength
+        return metadata
+
+    def get_stats(self):
+        """Get gallery statistics - maintained incrementally, no scan per request"""
+        return self.stats.snapshot()
+
+    def start_stats(self, file_sizes=None):
+        """Build the stats once, then reconcile them in the background every
+        gallery.stats_reconcile_seconds to catch changes made outside this process.
+        file_sizes returns {filename: bytes} for every original; by default output_dir is scanned."""
+        if file_sizes:
+            self._file_sizes = file_sizes
+        self.reconcile_stats()
+        worker = threading.Thread(target=self._reconcile_loop, name='gallery-stats')
+        worker.daemon = True
+        worker.start()
+
+    def _reconcile_loop(self):
+        while True:
+            time.sleep(self.config['gallery']['stats_reconcile_seconds'])
+            try:
+                self.reconcile_stats()
+            except Exception:
+                logger.exception('Gallery stats reconciliation failed')
+
+    def _file_sizes(self):
+        """One directory listing of output_dir"""
+        file_sizes = {}
+        if self.output_dir.exists():
+            with os.scandir(self.output_dir) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        file_sizes[entry.name] = entry.stat().st_size
+        return file_sizes
+
+    def reconcile_stats(self):
+        """Rebuild stats from all records and the current file sizes"""
+        self.stats.begin_rebuild()
+        file_sizes = self._file_sizes()
+        all_images = self.get_all_images()
+        records = [(self._stats_key(record), record, file_sizes.get(record['filename']))
+                   for record in all_images]
+        self._refresh_search(all_images)
+        if self.stats.finish_rebuild(records):
+            logger.info('Gallery stats drifted from storage, reconciled')
+            self.touch()
+
+    def _record_added(self, key, record):
+        """Count a new record, with one stat() of its file"""
+        try:
+            file_size = (self.output_dir / record['filename']).stat().st_size
+        except OSError:
+            file_size = None
+        self.stats.record_added(key, record, file_size)
+
+    def _refresh_search(self, records):
+        """Hook for backends whose search index can drift from storage"""
+
+    @staticmethod
+    def make_cursor(image):
+        """Keyset cursor for an image: 'generation_timestamp,id'"""
+        return f"{image.get('generation_timestamp', '')},{image['id']}"
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """Split a 'generation_timestamp,id' cursor, raising ValueError if malformed"""
+        timestamp, _, image_id = cursor.rpartition(',')
+        return timestamp, int(image_id)
+
+
+class GalleryDB(BaseGalleryDB):
+    """TinyDB backend - whole gallery lives in one JSON file"""
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.db_path = config['gallery']['db_file']
+        self.db = TinyDB(self.db_path)
+        self.images = self.db.table('images')
+        self._search_lock = threading.Lock()
+        self._prompt_index = None  # built on first search
+        self._search_records = {}
+
+    def add_image(self, filename, prompt, model=None, size=None, quality='low', seed=None, actual_seed=None,
+                  parent=None, strength=None):
+        """Add AI-specific metadata with generation parameters"""
+        metadata = {'id': len(self.images) + 1}
+        metadata.update(self.build_metadata(filename, prompt, model, size, quality, seed, actual_seed, parent, strength))
+        doc_id = self.images.insert(metadata)
+        self._record_added(doc_id, metadata)
+        with self._search_lock:
+            if self._prompt_index is not None:
+                self._prompt_index.add(doc_id, metadata['prompt'])
+                self._search_records[doc_id] = metadata
+        self.touch()
+        return doc_id
+
+    def _stats_key(self, record):
+        return record.doc_id
+
     def get_all_images(self, limit=None):
         """Get all images, newest generation first"""
         all_images = self.images.all()
         # Sort by generation timestamp, newest first
         sorted_images = sorted(all_images, key=lambda x: x.get('generation_timestamp', ''), reverse=True)
-        
+
         if limit:
             return sorted_images[:limit]
         return sorted_images
-    
+
     def get_image_by_filename(self, filename):
         """Get image metadata by filename"""
         Image = Query()
         return self.images.search(Image.filename == filename)
-    
+
     def get_paginated_images(self, page=1, per_page=None):
         """Get images with pagination"""
         if not per_page:
             per_page = self.config['gallery']['items_per_page']
-        
+
         all_images = self.get_all_images()
         total = len(all_images)
-        
+
         start = (page - 1) * per_page
         end = start + per_page
-        
+
         return {
             'images': all_images[start:end],
             'total': total,
@@ -76,33 +208,350 @@ class GalleryDB:
             'has_next': end < total,
             'has_prev': page > 1
         }
-    
+
+    def get_images_after(self, cursor=None, per_page=None):
+        """Get the page of images following a keyset cursor (full scan on TinyDB)"""
+        if not per_page:
+            per_page = self.config['gallery']['items_per_page']
+
+        ordered = sorted(self.images.all(), key=lambda x: (x.get('generation_timestamp', ''), x['id']), reverse=True)
+        if cursor:
+            position = self.parse_cursor(cursor)
+            ordered = [img for img in ordered if (img.get('generation_timestamp', ''), img['id']) < position]
+
+        page_images = ordered[:per_page]
+        has_next = len(ordered) > per_page
+        return {
+            'images': page_images,
+            'total': len(self.images),
+            'per_page': per_page,
+            'has_next': has_next,
+            'next_cursor': self.make_cursor(page_images[-1]) if has_next else None
+        }
+
     def delete_image(self, filename):
         """Remove image metadata"""
         Image = Query()
-        return self.images.remove(Image.filename == filename)
-    
-    def get_stats(self):
-        """Get gallery statistics - combine DB metadata with live filesystem data"""
-        all_images = self.images.all()
-        
-        if not all_images:
-            return {'total': 0, 'total_size': 0}
-        
-        # Get file sizes from filesystem (live data)
-        total_size = 0
-        valid_files = 0
-        output_dir = Path(self.config['files']['output_dir'])
-        
-        for img in all_images:
-            file_path = output_dir / img['filename']
-            if file_path.exists():
-                total_size += file_path.stat().st_size
-                valid_files += 1
-        
+        removed = self.images.remove(Image.filename == filename)
+        self.stats.record_removed(removed)
+        with self._search_lock:
+            if self._prompt_index is not None:
+                self._prompt_index.remove(removed)
+                for doc_id in removed:
+                    self._search_records.pop(doc_id, None)
+        self.touch()
+        return removed
+
+    def _refresh_search(self, records):
+        """Rebuild the prompt index from a full read (startup, reconciliation)"""
+        prompt_index = PromptIndex()
+        for record in records:
+            prompt_index.add(record.doc_id, record['prompt'])
+        with self._search_lock:
+            self._prompt_index = prompt_index
+            self._search_records = {record.doc_id: record for record in records}
+
+    def search_images(self, query='', filters=None, cursor=None, per_page=None):
+        """Prompt search with facet/date filters over the in-process inverted index"""
+        filters = filters or {}
+        if not per_page:
+            per_page = self.config['gallery']['items_per_page']
+
+        if self._prompt_index is None:
+            self._refresh_search(self.images.all())
+        with self._search_lock:
+            matched = [self._search_records[doc_id] for doc_id in self._prompt_index.search(query)]
+        matched = [record for record in matched if matches_filters(record, filters)]
+
+        ordered = sorted(matched, key=lambda x: (x.get('generation_timestamp', ''), x['id']), reverse=True)
+        if cursor:
+            position = self.parse_cursor(cursor)
+            ordered = [img for img in ordered if (img.get('generation_timestamp', ''), img['id']) < position]
+
+        page_images = [dict(img) for img in ordered[:per_page]]
+        has_next = len(ordered) > per_page
         return {
-            'total': len(all_images),
-            'valid_files': valid_files,  # Files that still exist
-            'total_size': total_size,
-            'total_size_mb': round(total_size / (1024 * 1024), 2)
-        }
\ No newline at end of file
+            'images': page_images,
+            'total': len(matched),
+            'facets': facet_counts(matched),
+            'per_page': per_page,
+            'has_next': has_next,
+            'next_cursor': self.make_cursor(page_images[-1]) if has_next else None
+        }
+
+
+class SQLiteGalleryDB(BaseGalleryDB):
+    """SQLite backend - WAL mode, indexed by timestamp and filename, atomic ids,
+    FTS5 prompt index kept in step by triggers"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT NOT NULL,
+            prompt TEXT NOT NULL,
+            model TEXT,
+            size TEXT,
+            quality TEXT,
+            generation_timestamp TEXT NOT NULL,
+            parameters TEXT,
+            extra TEXT,
+            parent TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_images_timestamp ON images (generation_timestamp DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_images_filename ON images (filename);
+        CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5 (prompt, content='images', content_rowid='id');
+        CREATE TRIGGER IF NOT EXISTS images_fts_insert AFTER INSERT ON images BEGIN
+            INSERT INTO images_fts (rowid, prompt) VALUES (new.id, new.prompt);
+        END;
+        CREATE TRIGGER IF NOT EXISTS images_fts_delete AFTER DELETE ON images BEGIN
+            INSERT INTO images_fts (images_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+        END;
+        CREATE TRIGGER IF NOT EXISTS images_fts_update AFTER UPDATE OF prompt ON images BEGIN
+            INSERT INTO images_fts (images_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+            INSERT INTO images_fts (rowid, prompt) VALUES (new.id, new.prompt);
+        END;
+    """
+    COLUMNS = ('id', 'filename', 'prompt', 'model', 'size', 'quality', 'generation_timestamp', 'parameters', 'extra', 'parent')
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.db_path = config['gallery']['sqlite_file']
+        self._local = threading.local()
+        # Shared change token - other web workers write to the same file
+        self.validator_cache_seconds = config['gallery']['validator_cache_seconds']
+        self._validator_lock = threading.Lock()
+        self._shared_token = None
+        self._shared_modified = self.last_modified
+        self._validators_expire = 0
+        with self._connect() as conn:
+            has_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'images_fts'").fetchone()
+            conn.executescript(self.SCHEMA)
+            if not has_fts:
+                # Galleries created before search existed - index their prompts once
+                conn.execute("INSERT INTO images_fts (images_fts) VALUES ('rebuild')")
+            if 'parent' not in {row['name'] for row in conn.execute('PRAGMA table_info(images)')}:
+                # Galleries created before img2img edits
+                conn.execute('ALTER TABLE images ADD COLUMN parent TEXT')
+
+    def _connect(self):
+        """One connection per thread; WAL lets readers proceed during writes"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def touch(self):
+        super().touch()
+        # Our own write - re-read the shared token on the next request
+        self._validators_expire = 0
+
+    def validators(self):
+        """Change token including the shared file's state, so a write by any worker shows
+        up here within validator_cache_seconds. Ids are never reused, so max(id) and the
+        row count change with every insert and delete."""
+        with self._validator_lock:
+            now = time.monotonic()
+            if now >= self._validators_expire:
+                max_id, count = self._connect().execute('SELECT COALESCE(MAX(id), 0), COUNT(*) FROM images').fetchone()
+                shared = f"{max_id:x}.{count:x}"
+                if shared != self._shared_token:
+                    if self._shared_token is not None:
+                        self._shared_modified = datetime.now(timezone.utc).replace(microsecond=0)
+                    self._shared_token = shared
+                self._validators_expire = now + self.validator_cache_seconds
+            return f"{self._shared_token}.{self.change_token}", max(self.last_modified, self._shared_modified)
+
+    def _to_record(self, row):
+        """Convert a row back into the same dict shape the TinyDB backend returns"""
+        record = {key: row[key] for key in self.COLUMNS if key not in ('parameters', 'extra')}
+        if row['quality'] is None:
+            del record['quality']
+        if row['parent'] is None:
+            del record['parent']
+        if row['parameters']:
+            record['parameters'] = json.loads(row['parameters'])
+        if row['extra']:
+            record.update(json.loads(row['extra']))
+        return record
+
+    def _insert(self, conn, record, keep_id=False):
+        known = set(self.COLUMNS)
+        extra = {key: value for key, value in record.items() if key not in known}
+        values = (
+            record['id'] if keep_id else None,
+            record['filename'],
+            record['prompt'],
+            record.get('model'),
+            record.get('size'),
+            record.get('quality'),
+            record.get('generation_timestamp', ''),
+            json.dumps(record['parameters']) if record.get('parameters') else None,
+            json.dumps(extra) if extra else None,
+            record.get('parent')
+        )
+        verb = 'INSERT OR IGNORE' if keep_id else 'INSERT'
+        placeholders = ', '.join('?' * len(self.COLUMNS))
+        cursor = conn.execute(f"{verb} INTO images ({', '.join(self.COLUMNS)}) VALUES ({placeholders})", values)
+        return cursor.lastrowid if cursor.rowcount else None
+
+    def add_image(self, filename, prompt, model=None, size=None, quality='low', seed=None, actual_seed=None,
+                  parent=None, strength=None):
+        """Add AI-specific metadata with generation parameters, returning the new id"""
+        metadata = self.build_metadata(filename, prompt, model, size, quality, seed, actual_seed, parent, strength)
+        conn = self._connect()
+        with conn:
+            image_id = self._insert(conn, metadata)
+        self._record_added(image_id, metadata)
+        self.touch()
+        return image_id
+
+    def _stats_key(self, record):
+        return record['id']
+
+    def import_records(self, records):
+        """Bulk insert existing records keeping their ids; already imported ids are skipped"""
+        conn = self._connect()
+        imported = 0
+        with conn:
+            for record in records:
+                if self._insert(conn, record, keep_id=True):
+                    imported += 1
+        self.touch()
+        return imported
+
+    def get_all_images(self, limit=None):
+        """Get all images, newest generation first"""
+        sql = 'SELECT * FROM images ORDER BY generation_timestamp DESC, id DESC'
+        params = ()
+        if limit:
+            sql += ' LIMIT ?'
+            params = (limit,)
+        return [self._to_record(row) for row in self._connect().execute(sql, params)]
+
+    def get_image_by_filename(self, filename):
+        """Get image metadata by filename"""
+        rows = self._connect().execute('SELECT * FROM images WHERE filename = ?', (filename,))
+        return [self._to_record(row) for row in rows]
+
+    def count_images(self):
+        """Total number of gallery records"""
+        return self._connect().execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+    def get_paginated_images(self, page=1, per_page=None):
+        """Get images with offset pagination"""
+        if not per_page:
+            per_page = self.config['gallery']['items_per_page']
+
+        total = self.count_images()
+        start = (page - 1) * per_page
+        rows = self._connect().execute(
+            'SELECT * FROM images ORDER BY generation_timestamp DESC, id DESC LIMIT ? OFFSET ?',
+            (per_page, start)
+        )
+
+        return {
+            'images': [self._to_record(row) for row in rows],
+            'total': total,
+            'page': page,
+            'per_page': per_page,
+            'has_next': start + per_page < total,
+            'has_prev': page > 1
+        }
+
+    def get_images_after(self, cursor=None, per_page=None):
+        """Get the page of images following a keyset cursor - cost independent of depth"""
+        if not per_page:
+            per_page = self.config['gallery']['items_per_page']
+
+        if cursor:
+            timestamp, image_id = self.parse_cursor(cursor)
+            rows = self._connect().execute(
+                'SELECT * FROM images WHERE (generation_timestamp, id) < (?, ?) '
+                'ORDER BY generation_timestamp DESC, id DESC LIMIT ?',
+                (timestamp, image_id, per_page + 1)
+            )
+        else:
+            rows = self._connect().execute(
+                'SELECT * FROM images ORDER BY generation_timestamp DESC, id DESC LIMIT ?',
+                (per_page + 1,)
+            )
+
+        page_images = [self._to_record(row) for row in rows]
+        has_next = len(page_images) > per_page
+        page_images = page_images[:per_page]
+        return {
+            'images': page_images,
+            'total': self.count_images(),
+            'per_page': per_page,
+            'has_next': has_next,
+            'next_cursor': self.make_cursor(page_images[-1]) if has_next else None
+        }
+
+    def search_images(self, query='', filters=None, cursor=None, per_page=None):
+        """Prompt full-text search (FTS5) with facet/date filters and facet counts"""
+        filters = filters or {}
+        if not per_page:
+            per_page = self.config['gallery']['items_per_page']
+
+        conditions, params = [], []
+        match = fts_query(query)
+        if match:
+            conditions.append('id IN (SELECT rowid FROM images_fts WHERE images_fts MATCH ?)')
+            params.append(match)
+        for facet in FACETS:
+            if filters.get(facet):
+                conditions.append(f'{facet} = ?')
+                params.append(filters[facet])
+        date_from, date_to = date_bounds(filters)
+        if date_from:
+            conditions.append('generation_timestamp >= ?')
+            params.append(date_from)
+        if date_to:
+            conditions.append('generation_timestamp <= ?')
+            params.append(date_to)
+        where = ' AND '.join(conditions) or '1'
+
+        conn = self._connect()
+        total = conn.execute(f'SELECT COUNT(*) FROM images WHERE {where}', params).fetchone()[0]
+        facets = {
+            facet: dict(conn.execute(
+                f'SELECT {facet}, COUNT(*) FROM images WHERE {where} AND {facet} IS NOT NULL '
+                f'GROUP BY {facet} ORDER BY COUNT(*) DESC', params).fetchall())
+            for facet in FACETS
+        }
+
+        page_where, page_params = where, list(params)
+        if cursor:
+            timestamp, image_id = self.parse_cursor(cursor)
+            page_where += ' AND (generation_timestamp, id) < (?, ?)'
+            page_params += [timestamp, image_id]
+        rows = conn.execute(
+            f'SELECT * FROM images WHERE {page_where} ORDER BY generation_timestamp DESC, id DESC LIMIT ?',
+            page_params + [per_page + 1]
+        )
+
+        page_images = [self._to_record(row) for row in rows]
+        has_next = len(page_images) > per_page
+        page_images = page_images[:per_page]
+        return {
+            'images': page_images,
+            'total': total,
+            'facets': facets,
+            'per_page': per_page,
+            'has_next': has_next,
+            'next_cursor': self.make_cursor(page_images[-1]) if has_next else None
+        }
+
+    def delete_image(self, filename):
+        """Remove image metadata, returning the removed ids"""
+        conn = self._connect()
+        with conn:
+            removed = [row['id'] for row in conn.execute('SELECT id FROM images WHERE filename = ?', (filename,))]
+            conn.execute('DELETE FROM images WHERE filename = ?', (filename,))
+        self.stats.record_removed(removed)
+        self.touch()
+        return removed
@@ -0,0 +1,105 @@
+"""
+Deduplication of identical in-flight generation requests
+The first job for a request key leads; identical submissions made while it is still
+active become followers that never reach the scheduler. Every update of the leader
+is mirrored onto its followers, so they track its progress and share its result
+from one backend call.
+"""
+import threading
+
+from services.jobs import JobStatus
+
+# Job fields followers copy from their leader
+MIRRORED_FIELDS = ('status', 'progress', 'message', 'result', 'error')
+
+
+class JobDeduplicator:
+    def __init__(self, config, job_store):
+        self.enabled = config['jobs']['deduplicate_identical']
+        self.job_store = job_store
+        # Held while followers are attached or updated, so a joining follower
+        # never misses, or is overwritten by, a concurrent leader update
+        self._lock = threading.Lock()
+        self._leaders = {}  # request key -> leader job id
+        self._keys = {}  # leader job id -> request key
+        self._followers = {}  # leader job id -> follower job ids
+        self._leader_of = {}  # follower job id -> leader job id
+        self._deduplicated = 0
+
+    def join(self, key, job_id):
+        """Register job_id under key - returns the active leader it now follows, or None
+        if it leads (and must be queued)"""
+        if not self.enabled or key is None:
+            return None
+        with self._lock:
+            leader_id = self._leaders.get(key)
+            leader = self.job_store.get(leader_id) if leader_id else None
+            if leader is None or leader['status'] in (JobStatus.COMPLETED, JobStatus.FAILED):
+                self._leaders[key] = job_id
+                self._keys[job_id] = key
+                return None
+            self._followers.setdefault(leader_id, []).append(job_id)
+            self._leader_of[job_id] = leader_id
+            self._deduplicated += 1
+            # A cancelled leader still runs for its followers - they see it as running
+            state = {field: leader[field] for field in MIRRORED_FIELDS}
+            if leader['status'] == JobStatus.CANCELLED:
+                state.update(status=JobStatus.PROCESSING if leader['progress'] else JobStatus.PENDING)
+            self.job_store.update(job_id, state)
+            return leader_id
+
+    def mirror(self, job_id, updates):
+        """Copy a leader's update onto its followers, returning their new snapshots.
+        Cancelling a job is not mirrored; a final status dissolves the group."""
+        mirrored = {field: updates[field] for field in MIRRORED_FIELDS if field in updates}
+        if not mirrored or updates.get('status') == JobStatus.CANCELLED:
+            return []
+        with self._lock:
+            follower_ids = list(self._followers.get(job_id, ()))
+            if not follower_ids and job_id not in self._keys:
+                return []
+            snapshots = [snapshot for snapshot in (self.job_store.update(follower_id, mirrored) for follower_id in follower_ids)
+                         if snapshot]
+            if updates.get('status') in JobStatus.FINISHED:
+                self._dissolve(job_id)
+        return snapshots
+
+    def has_followers(self, job_id):
+        with self._lock:
+            return bool(self._followers.get(job_id))
+
+    def followers(self, job_id):
+        with self._lock:
+            return list(self._followers.get(job_id, ()))
+
+    def detach(self, job_id):
+        """Remove a follower from its group - returns the leader id, or None if job_id is no follower"""
+        with self._lock:
+            leader_id = self._leader_of.pop(job_id, None)
+            if leader_id is not None:
+                self._followers[leader_id].remove(job_id)
+            return leader_id
+
+    def release_if_unfollowed(self, job_id):
+        """Stop accepting followers for a leader nobody follows - False if someone does"""
+        with self._lock:
+            if self._followers.get(job_id):
+                return False
+            self._dissolve(job_id)
+            return True
+
+    def _dissolve(self, leader_id):
+        key = self._keys.pop(leader_id, None)
+        if key is not None and self._leaders.get(key) == leader_id:
+            del self._leaders[key]
+        for follower_id in self._followers.pop(leader_id, ()):
+            self._leader_of.pop(follower_id, None)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'active_leaders': len(self._keys),
+                'followers': len(self._leader_of),
+                'deduplicated': self._deduplicated
+            }
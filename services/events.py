@@ -0,0 +1,109 @@
+"""
+Job event bus for push progress updates
+Publishers (job updates, queue movement) hand events to per-job subscribers;
+each subscriber is a small bounded buffer a streaming response blocks on, so idle
+listeners cost nothing until something actually changes.
+"""
+import asyncio
+import threading
+from collections import deque
+
+
+class Subscription:
+    """One listener's pending events - oldest are dropped if the client falls behind"""
+
+    def __init__(self, job_id, max_buffered):
+        self.job_id = job_id
+        self._events = deque(maxlen=max_buffered)
+        self._cond = threading.Condition()
+
+    def push(self, event):
+        with self._cond:
+            self._events.append(event)
+            self._cond.notify()
+
+    def wait(self, timeout):
+        """Block until events arrive or timeout passes; returns the drained events"""
+        with self._cond:
+            if not self._events:
+                self._cond.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+
+class AsyncSubscription(Subscription):
+    """Subscription awaited on an asyncio event loop - pushes from worker threads
+    wake the loop instead of a blocked thread"""
+
+    def __init__(self, job_id, max_buffered, loop):
+        super().__init__(job_id, max_buffered)
+        self._loop = loop
+        self._ready = asyncio.Event()
+
+    def push(self, event):
+        with self._cond:
+            self._events.append(event)
+        self._loop.call_soon_threadsafe(self._ready.set)
+
+    async def wait(self, timeout):
+        """Wait until events arrive or timeout passes; returns the drained events"""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._ready.clear()
+        with self._cond:
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+
+class JobEventBus:
+    def __init__(self, config):
+        self.config = config
+        events_config = config['events']
+        self.heartbeat_seconds = events_config['heartbeat_seconds']
+        self.max_buffered = events_config['max_buffered_events']
+        self._lock = threading.Lock()
+        self._subscribers = {}  # job_id -> set of Subscription
+
+    def subscribe(self, job_id, loop=None):
+        """Listen for a job's events - pass the running loop to get an awaitable subscription"""
+        if loop is None:
+            subscription = Subscription(job_id, self.max_buffered)
+        else:
+            subscription = AsyncSubscription(job_id, self.max_buffered, loop)
+        with self._lock:
+            self._subscribers.setdefault(job_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            listeners = self._subscribers.get(subscription.job_id)
+            if listeners:
+                listeners.discard(subscription)
+                if not listeners:
+                    del self._subscribers[subscription.job_id]
+
+    def has_subscribers(self, job_id):
+        with self._lock:
+            return job_id in self._subscribers
+
+    def subscribed_job_ids(self):
+        with self._lock:
+            return list(self._subscribers)
+
+    def publish(self, job_id, event):
+        """Deliver an event to everyone listening on job_id"""
+        with self._lock:
+            listeners = list(self._subscribers.get(job_id, ()))
+        for subscription in listeners:
+            subscription.push(event)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'jobs_watched': len(self._subscribers),
+                'subscribers': sum(len(listeners) for listeners in self._subscribers.values())
+            }
@@ -0,0 +1,152 @@
+"""
+In-process file metadata index
+Size/mtime/ctime of every file in the watched directories (originals, thumbnails,
+derivatives), built with one os.scandir pass per directory. The render pipeline
+records its own writes; a polling watcher rescans a directory when its mtime moves,
+which catches files added or removed by anything else. Lookups are dict reads -
+no filesystem calls on the request path, which matters on network storage.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+FileInfo = namedtuple('FileInfo', ['size', 'mtime', 'ctime'])
+
+
+def _info(stat):
+    return FileInfo(stat.st_size, stat.st_mtime, stat.st_ctime)
+
+
+def stat_info(path):
+    """FileInfo straight from the filesystem, or None if path does not exist"""
+    try:
+        return _info(os.stat(path))
+    except OSError:
+        return None
+
+
+def version_token(info):
+    """Short URL version of a file - changes whenever the file is rewritten"""
+    return hashlib.blake2s(f"{info.size}:{info.mtime}".encode(), digest_size=6).hexdigest()
+
+
+class FileIndex:
+    def __init__(self, config):
+        self.config = config
+        self.rescan_seconds = config['files']['index_rescan_seconds']
+        self._lock = threading.Lock()
+        self._dirs = {}        # directory -> {filename: FileInfo}
+        self._dir_mtimes = {}  # directory -> mtime at last scan
+        self._scans = 0
+        self._fallbacks = 0
+
+    def watch(self, directory):
+        """Index a directory now and keep it current - it may not exist yet"""
+        directory = Path(directory)
+        with self._lock:
+            if directory in self._dirs:
+                return
+        self._scan(directory)
+
+    def start(self):
+        """Start the polling watcher"""
+        watcher = threading.Thread(target=self._watch_loop, name='file-index-watcher')
+        watcher.daemon = True
+        watcher.start()
+        logger.info(f"File index watching {len(self._dirs)} directories, {self.file_count()} files")
+
+    def lookup(self, path):
+        """FileInfo for path, or None if it does not exist"""
+        path = Path(path)
+        files = self._dirs.get(path.parent)
+        if files is not None:
+            return files.get(path.name)
+
+        # Not a watched directory - fall back to the filesystem
+        self._fallbacks += 1
+        return stat_info(path)
+
+    def exists(self, path):
+        return self.lookup(path) is not None
+
+    def record(self, path):
+        """Refresh one entry after writing (or deleting) the file"""
+        path = Path(path)
+        info = stat_info(path)
+        with self._lock:
+            files = self._dirs.get(path.parent)
+            if files is None:
+                return
+            if info is None:
+                files.pop(path.name, None)
+            else:
+                files[path.name] = info
+
+    def discard(self, path):
+        path = Path(path)
+        with self._lock:
+            files = self._dirs.get(path.parent)
+            if files is not None:
+                files.pop(path.name, None)
+
+    def list(self, directory):
+        """{filename: FileInfo} of a watched directory, or None if it is not watched"""
+        with self._lock:
+            files = self._dirs.get(Path(directory))
+            return None if files is None else dict(files)
+
+    def directory_size(self, directory):
+        """Total bytes in a watched directory, or None if it is not watched"""
+        with self._lock:
+            files = self._dirs.get(Path(directory))
+            return None if files is None else sum(info.size for info in files.values())
+
+    def file_count(self):
+        with self._lock:
+            return sum(len(files) for files in self._dirs.values())
+
+    def _scan(self, directory):
+        """Rebuild one directory's entries with a single scandir pass"""
+        files = {}
+        try:
+            dir_mtime = directory.stat().st_mtime
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    # Dot-prefixed names are in-progress temp files
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        files[entry.name] = _info(entry.stat())
+        except FileNotFoundError:
+            dir_mtime = None
+        with self._lock:
+            self._dirs[directory] = files
+            self._dir_mtimes[directory] = dir_mtime
+            self._scans += 1
+
+    def _watch_loop(self):
+        while True:
+            time.sleep(self.rescan_seconds)
+            with self._lock:
+                directories = list(self._dirs)
+            for directory in directories:
+                try:
+                    # Creating, renaming or deleting a file bumps the directory mtime
+                    current = directory.stat().st_mtime
+                except FileNotFoundError:
+                    current = None
+                if current != self._dir_mtimes.get(directory):
+                    self._scan(directory)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'directories': len(self._dirs),
+                'files': sum(len(files) for files in self._dirs.values()),
+                'scans': self._scans,
+                'fallback_stats': self._fallbacks
+            }
@@ -1,79 +1,427 @@
 """
 Image processing service for thumbnail generation and optimization
 Mobile-first, performance-focused approach
+Thumbnails and responsive WebP/AVIF derivatives are rendered in a background
+process pool, never on the request path
 """
+import multiprocessing
 import os
-from PIL import Image, ImageOps
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from PIL import Image, ImageOps, features
 from pathlib import Path
 
+from services.file_index import stat_info, version_token
+from services.metrics import STAGE_SECONDS
+from services.similarity import hash_for_backfill, hash_file
+
+
+# Derivative formats we know how to encode: config name -> (Pillow format, mimetype)
+DERIVATIVE_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'avif': ('AVIF', 'image/avif'),
+}
+
+
+# Imported once by the forkserver, so each worker starts with Pillow and NumPy loaded
+WORKER_PRELOAD = ['services.images', 'services.storage']
+# Name prefix of our pool's worker processes - other multiprocessing children (a server's
+# own worker processes, say) must still start the app
+POOL_WORKER_PREFIX = 'ImagePoolWorker'
+
+
+class _PoolWorkerName:
+    """Process mixin: the name travels to the child before it re-imports the main module"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = f"{POOL_WORKER_PREFIX}-{self.name}"
+
+
+# Workers come from a forkserver (spawn where there is none) - a fork of the
+# multithreaded server could inherit a lock another thread held and deadlock
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    class _PoolProcess(_PoolWorkerName, multiprocessing.context.ForkServerProcess):
+        pass
+
+    class _PoolContext(multiprocessing.context.ForkServerContext):
+        Process = _PoolProcess
+else:
+    class _PoolProcess(_PoolWorkerName, multiprocessing.context.SpawnProcess):
+        pass
+
+    class _PoolContext(multiprocessing.context.SpawnContext):
+        Process = _PoolProcess
+
+
+def process_pool(max_workers):
+    """Process pool that is safe to start from the multithreaded server"""
+    context = _PoolContext()
+    if context.get_start_method() == 'forkserver':
+        context.set_forkserver_preload(WORKER_PRELOAD)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+
+def in_pool_worker():
+    """Whether this process is one of our pool workers - they re-import the main module,
+    which must not start a second app there"""
+    return multiprocessing.current_process().name.startswith(POOL_WORKER_PREFIX)
+
+
+def _format_supported(fmt):
+    """Whether this Pillow build can encode the given derivative format"""
+    try:
+        return fmt in DERIVATIVE_FORMATS and bool(features.check(fmt))
+    except ValueError:
+        return False
+
+
+def _to_rgb(img):
+    """Flatten transparency onto white - outputs are displayed on light backgrounds"""
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+        return background
+    return img
+
+
+def _save_atomic(image, path, **save_args):
+    """Write to a temp file then rename, so readers never see a partial file"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    image.save(temp_path, **save_args)
+    os.replace(temp_path, path)
+
+
+def render_thumbnail(source_path, thumb_path, thumb_size):
+    """Render one thumbnail - module level so it can run in a worker process"""
+    source_path = Path(source_path)
+    thumb_path = Path(thumb_path)
+
+    if not source_path.exists():
+        raise FileNotFoundError(f"Source image not found: {source_path.name}")
+
+    # Open and process image
+    with Image.open(source_path) as img:
+        img = _to_rgb(img)
+
+        # Generate thumbnail with smart cropping
+        thumbnail = ImageOps.fit(
+            img,
+            thumb_size,
+            Image.Resampling.LANCZOS,
+            centering=(0.5, 0.5)
+        )
+
+        # Save optimized thumbnail
+        _save_atomic(thumbnail, thumb_path, format='JPEG', quality=85, optimize=True, progressive=True)
+
+    return str(thumb_path)
+
+
+def render_derivatives(source_path, targets):
+    """Render resized copies of one image - targets are (path, max_edge, crop, format, quality)"""
+    source_path = Path(source_path)
+
+    if not source_path.exists():
+        raise FileNotFoundError(f"Source image not found: {source_path.name}")
+
+    with Image.open(source_path) as img:
+        img = _to_rgb(img)
+        img.load()
+
+        for path, max_edge, crop, fmt, quality in targets:
+            if crop:
+                resized = ImageOps.fit(img, (max_edge, max_edge), Image.Resampling.LANCZOS, centering=(0.5, 0.5))
+            else:
+                # Fit within max_edge, never upscale
+                resized = img.copy()
+                resized.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+            _save_atomic(resized, Path(path), format=DERIVATIVE_FORMATS[fmt][0], quality=quality)
+
+
+def render_image_set(source_path, thumb_path, thumb_size, targets):
+    """Render the legacy thumbnail (if given) and any derivative targets for one image"""
+    if thumb_path:
+        render_thumbnail(source_path, thumb_path, thumb_size)
+    if targets:
+        render_derivatives(source_path, targets)
+
+
+def _backfill_one(args):
+    """Process pool entry point for bulk backfill - returns (filename, error)"""
+    filename, source_path, thumb_path, thumb_size, targets = args
+    try:
+        render_image_set(source_path, thumb_path, thumb_size, targets)
+        return filename, None
+    except Exception as e:
+        return filename, str(e)
+
+
 class ImageService:
-    def __init__(self, config):
+    def __init__(self, config, file_index=None, hash_index=None):
         self.config = config
         self.output_dir = Path(config['files']['output_dir'])
         self.thumbs_dir = Path(config['files']['thumbs_dir'])
+        self.derivatives_dir = Path(config['files']['derivatives_dir'])
         self.thumb_size = tuple(config['gallery']['thumbnail_size'])
+        self.thumbnail_workers = config['gallery']['thumbnail_workers']
+        
+        # Responsive derivatives: named sizes x formats this Pillow build can encode
+        derivatives = config['gallery']['derivatives']
+        self.derivative_sizes = derivatives['sizes']
+        self.derivative_quality = derivatives['quality']
+        self.derivative_formats = [fmt for fmt in derivatives['formats'] if _format_supported(fmt)]
+        for fmt in set(derivatives['formats']) - set(self.derivative_formats):
+            print(f"Derivative format '{fmt}' is not supported by this Pillow build, skipping")
+        
+        # Background render pipeline - pool is created on first use
+        self._pool = None
+        self._pending = {}  # filename -> render start, for the thumbnail span
+        self._failed = set()  # Not retried on every gallery view; backfill retries them
+        self._lock = threading.Lock()
+        # Set by the storage tiers - filename -> archived original, so renders need no restore
+        self.locate_original = None
+        self.touch()
         
         # Ensure directories exist
         self.output_dir.mkdir(exist_ok=True)
         self.thumbs_dir.mkdir(parents=True, exist_ok=True)
+        self.derivatives_dir.mkdir(parents=True, exist_ok=True)
+        
+        # Optional metadata index - existence checks become dict lookups
+        self.file_index = file_index
+        if file_index:
+            for directory in self._render_dirs():
+                file_index.watch(directory)
+        
+        # Optional perceptual hash index - similar-image lookups and dedup
+        self.hash_index = hash_index
+    
+    def _render_dirs(self):
+        """Every directory the gallery reads from"""
+        return [self.output_dir] + self.derivative_dirs()
+    
+    def derivative_dirs(self):
+        """Directories of rendered copies - thumbnails and each derivative size"""
+        return [self.thumbs_dir] + [self.derivatives_dir / size_name for size_name in self.derivative_sizes]
+    
+    def _exists(self, path):
+        if self.file_index:
+            return self.file_index.exists(path)
+        return path.exists()
+    
+    def _source_path(self, filename):
+        """Original to render from - the hot copy, or the archived one read in place"""
+        path = self.output_dir / filename
+        if self._exists(path):
+            return path
+        return self.locate_original(filename) if self.locate_original else None
+    
+    def versioned_url(self, url, path):
+        """url with the file's current version appended - served as immutable"""
+        info = self.file_index.lookup(path) if self.file_index else stat_info(path)
+        return f"{url}?v={version_token(info)}" if info else url
+    
+    def touch(self):
+        """Record a change in derived images - combined into the gallery ETag"""
+        self.change_token = f"{time.time_ns():x}"
+        self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
     
     def generate_thumbnail(self, filename):
-        """Generate thumbnail for image - mobile optimized"""
+        """Generate thumbnail for image synchronously - mobile optimized"""
         try:
-            source_path = self.output_dir / filename
             thumb_path = self.thumbs_dir / filename
             
             if thumb_path.exists():
                 return str(thumb_path)
             
-            if not source_path.exists():
-                raise FileNotFoundError(f"Source image not found: {filename}")
-            
-            # Open and process image
-            with Image.open(source_path) as img:
-                # Convert to RGB if needed
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    if img.mode == 'P':
-                        img = img.convert('RGBA')
-                    background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                    img = background
-                
-                # Generate thumbnail with smart cropping
-                thumbnail = ImageOps.fit(
-                    img, 
-                    self.thumb_size, 
-                    Image.Resampling.LANCZOS,
-                    centering=(0.5, 0.5)
-                )
-                
-                # Save optimized thumbnail
-                thumbnail.save(
-                    thumb_path,
-                    'JPEG',
-                    quality=85,
-                    optimize=True,
-                    progressive=True
-                )
-                
-                return str(thumb_path)
+            return render_thumbnail(self.output_dir / filename, thumb_path, self.thumb_size)
                 
         except Exception as e:
             print(f"Error generating thumbnail for {filename}: {e}")
             return None
     
-    def get_thumbnail_url(self, filename):
-        """Get URL for thumbnail, generate if needed"""
+    def derivative_path(self, size_name, filename, fmt):
+        """On-disk cache location of one derivative"""
+        return self.derivatives_dir / size_name / f"{Path(filename).stem}.{fmt}"
+    
+    def _missing_work(self, filename):
+        """Thumbnail path (or None) and derivative targets that still need rendering"""
         thumb_path = self.thumbs_dir / filename
+        targets = [
+            (self.derivative_path(size_name, filename, fmt), spec['max_edge'], spec['crop'], fmt, self.derivative_quality)
+            for size_name, spec in self.derivative_sizes.items()
+            for fmt in self.derivative_formats
+            if not self._exists(self.derivative_path(size_name, filename, fmt))
+        ]
+        return (None if self._exists(thumb_path) else thumb_path), targets
+    
+    def needs_renders(self, filename):
+        """Whether the thumbnail or any derivative of filename still has to be rendered"""
+        thumb_path, targets = self._missing_work(filename)
+        return bool(thumb_path or targets)
+    
+    def schedule_renders(self, filename):
+        """Queue the thumbnail and derivatives for background rendering; returns True while pending"""
+        with self._lock:
+            if filename in self._pending:
+                return True
+            if filename in self._failed:
+                return False
+            thumb_path, targets = self._missing_work(filename)
+            if thumb_path is None and not targets:
+                return False
+            source_path = self._source_path(filename)
+            if source_path is None:
+                return False
+            if self._pool is None:
+                self._pool = process_pool(self.thumbnail_workers)
+            self._pending[filename] = time.perf_counter()
+            try:
+                future = self._pool.submit(render_image_set, source_path, thumb_path, self.thumb_size, targets)
+            except BrokenProcessPool:
+                # A worker died and took the pool with it - start a fresh one
+                self._pool = process_pool(self.thumbnail_workers)
+                future = self._pool.submit(render_image_set, source_path, thumb_path, self.thumb_size, targets)
+        
+        future.add_done_callback(lambda done: self._render_done(filename, done))
+        return True
+    
+    def _render_done(self, filename, future):
+        with self._lock:
+            started = self._pending.pop(filename, None)
+            # A source moved between tiers mid-render is retried from its new place, and
+            # a render lost with a dead worker is retried on the replacement pool
+            if future.exception() and not isinstance(future.exception(), (FileNotFoundError, BrokenProcessPool)):
+                self._failed.add(filename)
+        if self.file_index:
+            # Workers wrote in another process - index what now exists
+            self.file_index.record(self.thumbs_dir / filename)
+            for size_name in self.derivative_sizes:
+                for fmt in self.derivative_formats:
+                    self.file_index.record(self.derivative_path(size_name, filename, fmt))
+        if future.exception():
+            print(f"Error generating thumbnail for {filename}: {future.exception()}")
+        else:
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage='thumbnail')
+            self.touch()
+    
+    def get_thumbnail(self, filename):
+        """Get thumbnail URL and pending flag without blocking on Pillow work"""
+        if self._exists(self.thumbs_dir / filename):
+            thumbnail_url = self.versioned_url(f"/thumbs/{filename}", self.thumbs_dir / filename)
+            return {'thumbnail_url': thumbnail_url, 'thumbnail_pending': False}
         
-        if not thumb_path.exists():
-            self.generate_thumbnail(filename)
+        # Not rendered yet - serve the original until the pipeline catches up
+        pending = self.schedule_renders(filename)
+        return {'thumbnail_url': f"/images/{filename}", 'thumbnail_pending': pending}
+    
+    def get_thumbnail_url(self, filename):
+        """Get URL for thumbnail, queueing generation if needed"""
+        return self.get_thumbnail(filename)['thumbnail_url']
+    
+    def get_variants(self, filename, size=None):
+        """Advertise cached derivatives: per-size URLs by format, plus srcset strings for the
+        non-cropped sizes. size is the original 'WxH', used for the srcset width descriptors."""
+        width, height = (int(part) for part in size.lower().split('x')) if size else (None, None)
+        variants = {}
+        srcset = {}
+        missing = False
+        
+        for size_name, spec in self.derivative_sizes.items():
+            for fmt in self.derivative_formats:
+                path = self.derivative_path(size_name, filename, fmt)
+                if not self._exists(path):
+                    missing = True
+                    continue
+                url = self.versioned_url(f"/derivatives/{size_name}/{path.name}", path)
+                variants.setdefault(size_name, {})[fmt] = url
+                
+                if not spec['crop'] and width:
+                    scaled_width = min(width, round(width * spec['max_edge'] / max(width, height)))
+                    entries = srcset.setdefault(fmt, {})
+                    # Small originals make several sizes identical - keep the first
+                    entries.setdefault(scaled_width, f"{url} {scaled_width}w")
+        
+        if missing:
+            self.schedule_renders(filename)
+        
+        return {
+            'variants': variants,
+            'srcset': {fmt: ', '.join(entries.values()) for fmt, entries in srcset.items()}
+        }
+    
+    def negotiate_derivative(self, size_name, filename, accept_mimetypes):
+        """Pick the best cached derivative the client accepts - (path, mimetype) or None"""
+        if size_name not in self.derivative_sizes:
+            return None
+        
+        # Prefer the smallest encodings first
+        for fmt in ('avif', 'webp'):
+            if fmt not in self.derivative_formats:
+                continue
+            mimetype = DERIVATIVE_FORMATS[fmt][1]
+            path = self.derivative_path(size_name, filename, fmt)
+            # Explicit match only - */* from older browsers must not select AVIF
+            if mimetype in set(accept_mimetypes.values()) and self._exists(path):
+                return path, mimetype
+        return None
+    
+    def backfill_thumbnails(self, filenames, workers=None):
+        """Render every missing thumbnail and derivative using all cores -
+        yields (filename, error) as each finishes"""
+        jobs = []
+        for filename in filenames:
+            thumb_path, targets = self._missing_work(filename)
+            source_path = self._source_path(filename)
+            if source_path and (thumb_path or targets):
+                jobs.append((filename, source_path, thumb_path, self.thumb_size, targets))
+        if not jobs:
+            return
         
-        if thumb_path.exists():
-            return f"/thumbs/{filename}"
+        with process_pool(workers or os.cpu_count()) as pool:
+            yield from pool.map(_backfill_one, jobs, chunksize=8)
+        self.touch()
+    
+    def record_hashes(self, filename):
+        """Hash a newly saved image into the index - returns an existing near-identical
+        file, if there is one"""
+        if not self.hash_index:
+            return None
+        try:
+            hashes = hash_file(self.output_dir / filename)
+        except Exception as e:
+            print(f"Error hashing {filename}: {e}")
+            return None
+        self.hash_index.add(filename, hashes)
+        return self.hash_index.find_duplicate(filename, hashes)
+    
+    def find_similar(self, filename, max_distance=None, limit=None, hash_name='phash'):
+        """[(filename, distance)] of images that look like filename, or None if it is not indexed"""
+        hashes = self.hash_index.get(filename) if self.hash_index else None
+        if hashes is None:
+            return None
+        return self.hash_index.similar(hashes, max_distance, limit, hash_name, exclude=filename)
+    
+    def backfill_hashes(self, filenames, workers=None):
+        """Hash every unindexed image using all cores - yields (filename, error) as each finishes"""
+        paths = [self.output_dir / filename for filename in filenames if filename not in self.hash_index]
+        if not paths:
+            return
         
-        # Fallback to original image
-        return f"/images/{filename}"
+        hashed = []
+        with process_pool(workers or os.cpu_count()) as pool:
+            for filename, hashes, error in pool.map(hash_for_backfill, paths, chunksize=16):
+                if hashes:
+                    hashed.append((filename, hashes))
+                yield filename, error
+        self.hash_index.add_many(hashed)
     
     def get_image_info(self, filename):
         """Get image dimensions and file size"""
@@ -110,7 +458,12 @@ class ImageService:
         return removed
     
     def get_directory_size(self, directory):
-        """Get total size of directory in bytes"""
+        """Get total size of directory in bytes - from the file index when it is watched"""
+        if self.file_index:
+            indexed = self.file_index.directory_size(directory)
+            if indexed is not None:
+                return indexed
+        
         total_size = 0
         directory_path = Path(directory)
         
@@ -0,0 +1,264 @@
+"""
+Job store for generation jobs
+Pluggable backends: in-process memory (single worker) or SQLite (shared by every
+web worker on the host, survives restarts). Finished jobs expire after a TTL;
+queued or running jobs whose owning process stops heartbeating are handed back
+for recovery.
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class JobStatus:
+    PENDING = "pending"
+    PROCESSING = "processing"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    ACTIVE = (PENDING, PROCESSING)
+    FINISHED = (COMPLETED, FAILED, CANCELLED)
+
+
+def open_job_store(config):
+    """Create the job store selected by config['jobs']['backend']"""
+    backend = config['jobs']['backend']
+    if backend == 'sqlite':
+        return SQLiteJobStore(config)
+    if backend == 'memory':
+        return MemoryJobStore(config)
+    raise ValueError(f"Unknown job store backend: {backend}")
+
+
+class BaseJobStore:
+    """Maintenance loop shared by every job store"""
+
+    def __init__(self, config):
+        self.config = config
+        jobs_config = config['jobs']
+        self.ttl_seconds = jobs_config['ttl_seconds']
+        self.heartbeat_seconds = jobs_config['heartbeat_seconds']
+        self.owner_timeout_seconds = jobs_config['owner_timeout_seconds']
+        # Identifies this process as the owner of the jobs it creates
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.on_recover = None
+        self._expired = 0
+
+    def start(self, on_recover=None):
+        """Start heartbeating, expiring finished jobs and recovering orphans
+
+        on_recover(jobs) receives jobs taken over from processes that went away.
+        """
+        self.on_recover = on_recover
+        self.maintain()
+        worker = threading.Thread(target=self._maintenance_loop, name='job-store-maintenance')
+        worker.daemon = True
+        worker.start()
+
+    def maintain(self):
+        self.heartbeat()
+        expired = self.expire()
+        if expired:
+            self._expired += expired
+            logger.info(f"Expired {expired} finished job(s)")
+        orphans = self.claim_orphans()
+        if orphans:
+            logger.warning(f"Recovering {len(orphans)} job(s) from stopped workers")
+            if self.on_recover:
+                self.on_recover(orphans)
+
+    def _maintenance_loop(self):
+        while True:
+            time.sleep(self.heartbeat_seconds)
+            try:
+                self.maintain()
+            except Exception:
+                logger.exception('Job store maintenance failed')
+
+    def heartbeat(self):
+        """Mark this process as alive - nothing to do for a single-process store"""
+
+    def claim_orphans(self):
+        """Take over active jobs whose owner stopped heartbeating"""
+        return []
+
+
+class MemoryJobStore(BaseJobStore):
+    """Jobs live in this process only - lost on restart, invisible to other workers"""
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job):
+        with self._lock:
+            self._jobs[job['id']] = dict(job, updated_at=time.time())
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def update(self, job_id, updates):
+        """Apply updates, returning the new job state or None if the job is unknown"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job['status'] == JobStatus.CANCELLED:
+                # Cancelled is final - late progress from a running call must not revive it
+                return dict(job)
+            job.update(updates, updated_at=time.time())
+            return dict(job)
+
+    def remove(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def find_batch(self, batch_id):
+        """Every job of a batch, in no particular order"""
+        with self._lock:
+            return [dict(job) for job in self._jobs.values() if job.get('batch_id') == batch_id]
+
+    def expire(self):
+        """Drop finished jobs older than the TTL, returning how many were removed"""
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            stale = [job_id for job_id, job in self._jobs.items()
+                     if job['status'] in JobStatus.FINISHED and job['updated_at'] < cutoff]
+            for job_id in stale:
+                del self._jobs[job_id]
+        return len(stale)
+
+    def get_stats(self):
+        with self._lock:
+            by_status = {}
+            for job in self._jobs.values():
+                by_status[job['status']] = by_status.get(job['status'], 0) + 1
+        return {'backend': 'memory', 'jobs': by_status, 'expired': self._expired}
+
+
+class SQLiteJobStore(BaseJobStore):
+    """Jobs in a shared SQLite file - every web worker sees every job, and active jobs
+    of a stopped worker are recovered by the survivors (or by the restarted process)"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, updated_at);
+        CREATE TABLE IF NOT EXISTS job_owners (
+            owner TEXT PRIMARY KEY,
+            heartbeat REAL NOT NULL
+        );
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.db_path = config['jobs']['sqlite_file']
+        self._local = threading.local()
+        # Serialises read-modify-write updates within this process
+        self._write_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        """One connection per thread; WAL lets status reads proceed during updates"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def create(self, job):
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT INTO jobs (id, status, owner, updated_at, data) VALUES (?, ?, ?, ?, ?)',
+                         (job['id'], job['status'], self.owner, time.time(), json.dumps(job)))
+
+    def get(self, job_id):
+        row = self._connect().execute('SELECT data FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, job_id, updates):
+        """Apply updates, returning the new job state or None if the job is unknown"""
+        conn = self._connect()
+        with self._write_lock, conn:
+            # Take the write lock before reading, so an update from another process
+            # (say, a cancel) cannot land between this read and the write
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT data FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = json.loads(row[0])
+            if job['status'] == JobStatus.CANCELLED:
+                # Cancelled is final - late progress from a running call must not revive it
+                return job
+            job.update(updates)
+            conn.execute('UPDATE jobs SET status = ?, updated_at = ?, data = ? WHERE id = ?',
+                         (job['status'], time.time(), json.dumps(job), job_id))
+            return job
+
+    def remove(self, job_id):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def find_batch(self, batch_id):
+        """Every job of a batch, in no particular order - a scan, only used to recover batches"""
+        rows = self._connect().execute("SELECT data FROM jobs WHERE json_extract(data, '$.batch_id') = ?", (batch_id,))
+        return [json.loads(data) for data, in rows.fetchall()]
+
+    def expire(self):
+        """Drop finished jobs older than the TTL, returning how many were removed"""
+        cutoff = time.time() - self.ttl_seconds
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                f"DELETE FROM jobs WHERE status IN ({', '.join('?' * len(JobStatus.FINISHED))}) AND updated_at < ?",
+                (*JobStatus.FINISHED, cutoff)
+            )
+        return cursor.rowcount
+
+    def heartbeat(self):
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO job_owners (owner, heartbeat) VALUES (?, ?)', (self.owner, time.time()))
+
+    def claim_orphans(self):
+        """Take over active jobs whose owner stopped heartbeating - each job is claimed
+        by exactly one surviving process"""
+        cutoff = time.time() - self.owner_timeout_seconds
+        conn = self._connect()
+        claimed = []
+        with conn:
+            rows = conn.execute(
+                f"SELECT id, owner FROM jobs WHERE status IN ({', '.join('?' * len(JobStatus.ACTIVE))}) "
+                'AND owner NOT IN (SELECT owner FROM job_owners WHERE heartbeat >= ?)',
+                (*JobStatus.ACTIVE, cutoff)
+            ).fetchall()
+            for job_id, previous_owner in rows:
+                cursor = conn.execute('UPDATE jobs SET owner = ? WHERE id = ? AND owner = ?',
+                                      (self.owner, job_id, previous_owner))
+                if cursor.rowcount:
+                    claimed.append(job_id)
+            conn.execute('DELETE FROM job_owners WHERE heartbeat < ?', (cutoff,))
+        return [job for job in map(self.get, claimed) if job]
+
+    def get_stats(self):
+        rows = self._connect().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+        return {'backend': 'sqlite', 'jobs': dict(rows.fetchall()), 'expired': self._expired}
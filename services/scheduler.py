@@ -0,0 +1,279 @@
+"""
+Job scheduler for SD backend work
+Fixed worker pool sized to backend capacity, bounded fair queue with admission control
+and coalescing of compatible queued jobs into one batched backend call. A job is only
+dispatched while its model has a free backend slot, so work for an idle model never
+waits behind work for a busy one.
+"""
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+
+from services.metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when a job cannot be admitted to the queue"""
+
+
+QueueEntry = namedtuple('QueueEntry', 'priority client_id batch_key model address')
+
+
+class JobScheduler:
+    # Weight of the newest job duration in the running ETA average
+    ETA_SMOOTHING = 0.2
+    # sd.cpp clamps n to 1-8 per request
+    SERVER_MAX_BATCH = 8
+
+    def __init__(self, config, handler, worker_count, on_queue_change=None, model_capacity=None):
+        self.config = config
+        scheduler_config = config['scheduler']
+        # One worker per concurrent generation the backends can run ...
+        self.worker_count = worker_count
+        # ... and at most model_capacity[model] of them on one model (unlisted models are not limited)
+        self.model_capacity = model_capacity or {}
+        self.max_queue_size = scheduler_config['max_queue_size']
+        self.max_queued_per_client = scheduler_config['max_queued_per_client']
+        self.default_priority = scheduler_config['default_priority']
+        self.max_batch_size = min(scheduler_config['max_batch_size'], self.SERVER_MAX_BATCH)
+        # handler(job_ids) runs one backend call for a batch of compatible jobs
+        self.handler = handler
+        # on_queue_change() is called whenever queue positions may have moved
+        self.on_queue_change = on_queue_change
+
+        self._cond = threading.Condition()
+        # priority -> OrderedDict(client_id -> deque of job ids), lower priority runs first.
+        # Clients are served round-robin within a priority so one heavy user cannot starve others.
+        self._queues = {}
+        self._entries = {}  # job_id -> QueueEntry
+        self._enqueued_at = {}  # job_id -> monotonic submit time, for queue wait spans
+        self._workers = []
+        self._active = 0
+        self._active_by_model = {}
+        self._avg_duration = float(scheduler_config['initial_eta_seconds'])
+        self._completed = 0
+        self._rejected = 0
+        self._cancelled = 0
+        # Coalescing metrics
+        self._dispatches = 0
+        self._batched_dispatches = 0
+        self._batched_jobs = 0
+        self._largest_batch = 0
+        self._single_seconds = 0.0
+        self._single_count = 0
+        self._batched_seconds = 0.0
+
+    def start(self):
+        """Start the fixed-size worker pool"""
+        for index in range(self.worker_count):
+            worker = threading.Thread(target=self._worker_loop, name=f"sd-worker-{index + 1}")
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        logger.info(f"Scheduler started with {self.worker_count} worker(s), queue limit {self.max_queue_size}")
+
+    def submit(self, job_id, client_id, priority=None, batch_key=None, model=None, address=None):
+        """Queue a job for model, raising QueueFullError when admission control rejects it
+
+        Jobs sharing a non-None batch_key may be coalesced into one backend call. client_id
+        picks the round-robin lane; the per-client cap counts every job from the same
+        address (the client's network address - client_id when not given), so a caller
+        cannot get around it by sending new client ids.
+        """
+        if priority is None:
+            priority = self.default_priority
+
+        with self._cond:
+            if len(self._entries) >= self.max_queue_size:
+                self._rejected += 1
+                raise QueueFullError('Generation queue is full, please retry shortly')
+
+            address = address or client_id
+            queued_for_client = sum(1 for entry in self._entries.values() if entry.address == address)
+            if queued_for_client >= self.max_queued_per_client:
+                self._rejected += 1
+                raise QueueFullError('Too many queued generations for this client')
+
+            clients = self._queues.setdefault(priority, OrderedDict())
+            clients.setdefault(client_id, deque()).append(job_id)
+            self._entries[job_id] = QueueEntry(priority, client_id, batch_key, model, address)
+            self._enqueued_at[job_id] = time.monotonic()
+            self._cond.notify()
+        self._notify_queue_change()
+
+    def cancel(self, job_id):
+        """Remove a job that is still queued - returns False once a worker has taken it"""
+        with self._cond:
+            if job_id not in self._entries:
+                return False
+            self._remove(job_id)
+            self._enqueued_at.pop(job_id, None)
+            self._prune()
+            self._cancelled += 1
+        self._notify_queue_change()
+        return True
+
+    def queued_jobs(self, client_id):
+        """Ids of a client's jobs still waiting in the queue"""
+        with self._cond:
+            return [job_id for job_id, entry in self._entries.items() if entry.client_id == client_id]
+
+    def get_position(self, job_id):
+        """Get 1-based queue position and estimated seconds until completion"""
+        return self.get_positions([job_id]).get(job_id)
+
+    def get_positions(self, job_ids):
+        """Queue position and ETA for many jobs at once - job_id -> info, queued jobs only"""
+        with self._cond:
+            order = self._dispatch_order()
+            wanted = set(job_ids)
+            positions = {}
+            for index, job_id in enumerate(order):
+                if job_id in wanted:
+                    waves = math.ceil((index + 1) / self.worker_count)
+                    positions[job_id] = {
+                        'queue_position': index + 1,
+                        'eta_seconds': round(waves * self._avg_duration + self._avg_duration)
+                    }
+            return positions
+
+    def retry_after_seconds(self):
+        """Rough wait estimate for rejected clients"""
+        with self._cond:
+            return max(1, round(self._avg_duration))
+
+    def get_stats(self):
+        """Get queue depth, worker utilisation, timing estimates and batching savings"""
+        with self._cond:
+            avg_single = self._single_seconds / self._single_count if self._single_count else None
+            seconds_saved = None
+            if avg_single is not None:
+                seconds_saved = round(self._batched_jobs * avg_single - self._batched_seconds, 2)
+
+            return {
+                'workers': self.worker_count,
+                'active': self._active,
+                'active_by_model': {model: count for model, count in self._active_by_model.items() if count},
+                'queued': len(self._entries),
+                'max_queue_size': self.max_queue_size,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'cancelled': self._cancelled,
+                'avg_job_seconds': round(self._avg_duration, 2),
+                'batching': {
+                    'max_batch_size': self.max_batch_size,
+                    'backend_calls': self._dispatches,
+                    'batched_calls': self._batched_dispatches,
+                    'batched_jobs': self._batched_jobs,
+                    'largest_batch': self._largest_batch,
+                    'backend_calls_saved': self._batched_jobs - self._batched_dispatches,
+                    'estimated_seconds_saved': seconds_saved
+                }
+            }
+
+    def _dispatch_order(self):
+        """Queued job ids in the order workers will pick them up"""
+        order = []
+        for priority in sorted(self._queues):
+            lanes = list(self._queues[priority].values())
+            for depth in range(max(len(lane) for lane in lanes)):
+                order.extend(lane[depth] for lane in lanes if depth < len(lane))
+        return order
+
+    def _model_free(self, model):
+        capacity = self.model_capacity.get(model)
+        return capacity is None or self._active_by_model.get(model, 0) < capacity
+
+    def _pop_next(self):
+        """Take the next batch: best priority first, round-robin across clients, skipping
+        jobs whose model has no free backend - plus any queued jobs sharing the chosen
+        job's batch key. Returns (model, job ids), or None while nothing can run."""
+        job_id = next((job_id for job_id in self._dispatch_order() if self._model_free(self._entries[job_id].model)), None)
+        if job_id is None:
+            return None
+        entry = self._entries[job_id]
+        self._remove(job_id)
+        self._queues[entry.priority].move_to_end(entry.client_id)
+
+        batch = [job_id]
+        if entry.batch_key is not None:
+            for candidate in self._dispatch_order():
+                if len(batch) >= self.max_batch_size:
+                    break
+                if self._entries[candidate].batch_key == entry.batch_key:
+                    self._remove(candidate)
+                    batch.append(candidate)
+
+        self._prune()
+        return entry.model, batch
+
+    def _remove(self, job_id):
+        """Drop a queued job from its lane"""
+        entry = self._entries.pop(job_id)
+        self._queues[entry.priority][entry.client_id].remove(job_id)
+
+    def _prune(self):
+        """Drop empty client lanes and priority levels"""
+        for priority in list(self._queues):
+            clients = self._queues[priority]
+            for client_id in [owner for owner, lane in clients.items() if not lane]:
+                del clients[client_id]
+            if not clients:
+                del self._queues[priority]
+
+    def _notify_queue_change(self):
+        if self.on_queue_change is None:
+            return
+        try:
+            self.on_queue_change()
+        except Exception:
+            logger.exception('Queue change listener failed')
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    batch = self._pop_next() if self._queues else None
+                    if batch:
+                        break
+                    self._cond.wait()
+                model, job_ids = batch
+                self._active += 1
+                self._active_by_model[model] = self._active_by_model.get(model, 0) + 1
+                dispatched = time.monotonic()
+                waits = [dispatched - self._enqueued_at.pop(job_id, dispatched) for job_id in job_ids]
+            self._notify_queue_change()
+            for wait in waits:
+                STAGE_SECONDS.observe(wait, stage='queue_wait')
+
+            if len(job_ids) > 1:
+                logger.info(f"Coalesced {len(job_ids)} jobs into one backend call")
+
+            started = time.monotonic()
+            try:
+                self.handler(job_ids)
+            except Exception:
+                logger.exception(f"Worker failed while handling jobs {job_ids}")
+            finally:
+                duration = time.monotonic() - started
+                STAGE_SECONDS.observe(duration, stage='total')
+                with self._cond:
+                    self._active -= 1
+                    self._active_by_model[model] -= 1
+                    # A backend slot for model is free - idle workers may now take its queued jobs
+                    self._cond.notify_all()
+                    self._completed += len(job_ids)
+                    self._dispatches += 1
+                    self._avg_duration += self.ETA_SMOOTHING * (duration - self._avg_duration)
+                    if len(job_ids) > 1:
+                        self._batched_dispatches += 1
+                        self._batched_jobs += len(job_ids)
+                        self._batched_seconds += duration
+                        self._largest_batch = max(self._largest_batch, len(job_ids))
+                    else:
+                        self._single_count += 1
+                        self._single_seconds += duration
@@ -0,0 +1,225 @@
+"""
+HTTP client for the sd.cpp server
+Pooled keep-alive session, connect/read timeouts, bounded retries with jitter
+and a circuit breaker that fast-fails work while the backend is down
+"""
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from services.metrics import STAGE_SECONDS
+from services.streaming import MultipartFileBody, decode_image_stream
+
+logger = logging.getLogger(__name__)
+
+
+class SDBackendError(Exception):
+    """The SD backend call failed"""
+
+
+class SDRequestError(SDBackendError):
+    """The SD backend rejected the request (4xx) - retrying elsewhere will not help"""
+
+
+class BackendUnavailableError(SDBackendError):
+    """The circuit breaker is open - the backend is considered down"""
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def is_open(self):
+        """True while calls would be rejected - does not consume the half-open trial"""
+        with self._lock:
+            return self._state == self.OPEN and time.monotonic() - self._opened_at < self.reset_seconds
+
+    def retry_after_seconds(self):
+        with self._lock:
+            remaining = self.reset_seconds - (time.monotonic() - self._opened_at)
+            return max(1, round(remaining))
+
+    def allow(self):
+        """Whether a call may go ahead; after the reset period one trial call is let through"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning(f"SD backend circuit opened after {self._failures} failure(s)")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class BaseSDClient:
+    """Settings, breaker and counters shared by the blocking and asyncio clients"""
+
+    def __init__(self, config, url, breaker=None):
+        self.config = config
+        sd_config = config['sd_api']
+        self.url = url
+        # /v1/images/generations -> /v1/models, used for health probes
+        self.models_url = url.rsplit('/images/', 1)[0] + '/models'
+        # ... and -> /v1/images/edits for edits of an existing image
+        self.edits_url = url.rsplit('/images/', 1)[0] + '/images/edits'
+        self.connect_timeout = sd_config['connect_timeout_seconds']
+        self.read_timeout = sd_config['timeout_seconds']
+        self.pool_size = sd_config['pool_size']
+        self.max_retries = sd_config['max_retries']
+        self.retry_backoff = sd_config['retry_backoff_seconds']
+        self.chunk_size = sd_config['stream_chunk_bytes']
+        self.breaker = breaker or CircuitBreaker(sd_config['breaker_failure_threshold'], sd_config['breaker_reset_seconds'])
+
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._failures = 0
+        self._retries = 0
+
+    def edit_body(self, payload, reference_image):
+        """Multipart body for /v1/images/edits - payload fields plus the reference image"""
+        return MultipartFileBody(payload, 'image[]', reference_image, self.chunk_size)
+
+    def _record_call(self):
+        with self._lock:
+            self._calls += 1
+
+    def _record_failure(self):
+        self.breaker.record_failure()
+        with self._lock:
+            self._failures += 1
+
+    def _next_retry_delay(self, attempt, error):
+        """Count a retry and pick its delay - exponential backoff with full jitter"""
+        with self._lock:
+            self._retries += 1
+        delay = random.uniform(0, self.retry_backoff * 2 ** attempt)
+        logger.warning(f"SD API attempt {attempt} failed ({error}), retrying in {delay:.2f}s")
+        return delay
+
+    def get_stats(self):
+        """Call counters and breaker state"""
+        with self._lock:
+            return {
+                'url': self.url,
+                'calls': self._calls,
+                'failures': self._failures,
+                'retries': self._retries,
+                'circuit': self.breaker.state
+            }
+
+
+class SDClient(BaseSDClient):
+    def __init__(self, config, url, breaker=None):
+        super().__init__(config, url, breaker)
+        self.timeout = (self.connect_timeout, self.read_timeout)
+
+        # One keep-alive connection pool shared by all worker threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def generate(self, payload, target_dir, reference_image=None):
+        """POST a generation request and stream the images into temp files in target_dir
+
+        With a reference_image path the call is an edit against /v1/images/edits, the
+        image streamed from disk as multipart.
+        """
+        started = time.perf_counter()
+
+        def consume(response):
+            # sd.cpp sends headers once the images are done - the rest is transfer and decode
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage='backend_call')
+            with STAGE_SECONDS.time(stage='decode'):
+                return decode_image_stream(response.iter_content(chunk_size=self.chunk_size), target_dir)
+
+        if reference_image is None:
+            return self._call(consume, self.url, json=payload, headers={'Content-Type': 'application/json'})
+        with self.edit_body(payload, reference_image) as body:
+            return self._call(consume, self.edits_url, data=body, headers=body.headers())
+
+    def _call(self, consume, url, **request_args):
+        """Run one backend call with retries, feeding the streamed response to consume()"""
+        if not self.breaker.allow():
+            raise BackendUnavailableError('SD backend unavailable, try again shortly')
+
+        self._record_call()
+
+        attempt = 0
+        while True:
+            try:
+                with self.session.post(url, timeout=self.timeout, stream=True, **request_args) as response:
+                    if response.status_code >= 500 and attempt < self.max_retries:
+                        raise _RetryableStatus(response.status_code)
+                    response.raise_for_status()
+                    result = consume(response)
+                self.breaker.record_success()
+                return result
+
+            except (requests.ConnectionError, _RetryableStatus) as e:
+                if attempt >= self.max_retries:
+                    self._record_failure()
+                    raise SDBackendError(f"SD API Error: {e}")
+                attempt += 1
+                time.sleep(self._next_retry_delay(attempt, e))
+
+            except requests.HTTPError as e:
+                # 4xx means the backend is alive but rejected the request
+                if e.response is not None and e.response.status_code < 500:
+                    self.breaker.record_success()
+                    raise SDRequestError(f"SD API Error: {e}")
+                self._record_failure()
+                raise SDBackendError(f"SD API Error: {e}")
+
+            except requests.RequestException as e:
+                self._record_failure()
+                raise SDBackendError(f"SD API Error: {e}")
+
+            except Exception:
+                # Malformed body - count it against the backend
+                self._record_failure()
+                raise
+
+
+class _RetryableStatus(Exception):
+    """Internal marker for 5xx responses that should be retried"""
+
+    def __init__(self, status_code):
+        super().__init__(f"server returned {status_code}")
+        self.status_code = status_code
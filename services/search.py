@@ -0,0 +1,97 @@
+"""
+Prompt search helpers
+Tokenising shared by both gallery backends, the FTS5 query builder for SQLite and
+an in-process inverted index for TinyDB (prefix matching over a sorted vocabulary).
+"""
+import bisect
+import re
+from collections import Counter, defaultdict
+
+FACETS = ('model', 'size', 'quality')
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Lowercase word tokens - the same split FTS5's unicode61 tokenizer makes"""
+    return _WORD.findall((text or '').lower())
+
+
+def fts_query(text):
+    """Safe FTS5 MATCH expression: every term must match, as a prefix"""
+    return ' '.join(f'"{term}"*' for term in tokenize(text))
+
+
+def date_bounds(filters):
+    """(from, to) ISO timestamp bounds; a bare 'to' date includes that whole day"""
+    date_from = filters.get('date_from') or None
+    date_to = filters.get('date_to') or None
+    if date_to and len(date_to) == 10:
+        date_to += 'T23:59:59.999999'
+    return date_from, date_to
+
+
+def matches_filters(record, filters):
+    """Facet and date-range filter for in-memory records"""
+    for facet in FACETS:
+        if filters.get(facet) and record.get(facet) != filters[facet]:
+            return False
+    timestamp = record.get('generation_timestamp', '')
+    date_from, date_to = date_bounds(filters)
+    if date_from and timestamp < date_from:
+        return False
+    if date_to and timestamp > date_to:
+        return False
+    return True
+
+
+def facet_counts(records):
+    """{facet: {value: count}} over a result set, most common first"""
+    return {facet: dict(Counter(record[facet] for record in records if record.get(facet)).most_common())
+            for facet in FACETS}
+
+
+class PromptIndex:
+    """Inverted index over prompt words - doc id sets per token"""
+
+    def __init__(self):
+        self._postings = defaultdict(set)
+        self._tokens = {}  # doc id -> tokens, for removal
+        self._vocabulary = None  # sorted tokens, rebuilt lazily after changes
+
+    def add(self, doc_id, prompt):
+        tokens = set(tokenize(prompt))
+        self._tokens[doc_id] = tokens
+        for token in tokens:
+            if token not in self._postings:
+                self._vocabulary = None
+            self._postings[token].add(doc_id)
+
+    def remove(self, doc_ids):
+        for doc_id in doc_ids:
+            for token in self._tokens.pop(doc_id, ()):
+                postings = self._postings[token]
+                postings.discard(doc_id)
+                if not postings:
+                    del self._postings[token]
+                    self._vocabulary = None
+
+    def search(self, text):
+        """Doc ids whose prompt has a word starting with every query term"""
+        result = None
+        for term in tokenize(text):
+            matched = self._prefix_postings(term)
+            result = matched if result is None else result & matched
+            if not result:
+                return set()
+        return result if result is not None else set(self._tokens)
+
+    def _prefix_postings(self, term):
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        vocabulary = self._vocabulary
+        matched = set()
+        position = bisect.bisect_left(vocabulary, term)
+        while position < len(vocabulary) and vocabulary[position].startswith(term):
+            matched |= self._postings[vocabulary[position]]
+            position += 1
+        return matched
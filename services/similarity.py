@@ -0,0 +1,234 @@
+"""
+Perceptual hashes and near-duplicate lookup
+64-bit pHash (DCT of a 32x32 greyscale) and dHash (9x8 gradient) computed with NumPy.
+The index keeps every hash in one uint64 array so a Hamming-distance query is a
+single vectorised XOR + popcount over the whole gallery. It is persisted as an
+append-only log that is compacted on load.
+"""
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+HASHES = ('phash', 'dhash')
+_POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+_BIT_WEIGHTS = np.left_shift(np.uint64(1), np.arange(63, -1, -1, dtype=np.uint64))
+
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II basis - rows are frequencies"""
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT32 = _dct_matrix(32)
+
+
+def _pack(bits):
+    """64 booleans -> one unsigned 64-bit int"""
+    return int(np.sum(_BIT_WEIGHTS[bits.ravel()], dtype=np.uint64))
+
+
+def _greyscale(img, size):
+    return np.asarray(img.convert('L').resize(size, Image.Resampling.LANCZOS), dtype=np.float64)
+
+
+def phash(img):
+    """DCT hash: low 8x8 frequencies compared against their median"""
+    pixels = _greyscale(img, (32, 32))
+    frequencies = (_DCT32 @ pixels @ _DCT32.T)[:8, :8]
+    # The DC term only carries overall brightness
+    return _pack(frequencies > np.median(frequencies.ravel()[1:]))
+
+
+def dhash(img):
+    """Gradient hash: is each pixel brighter than its right neighbour"""
+    pixels = _greyscale(img, (9, 8))
+    return _pack(pixels[:, 1:] > pixels[:, :-1])
+
+
+def hash_file(path):
+    """(phash, dhash) of an image file"""
+    with Image.open(path) as img:
+        img.load()
+        return phash(img), dhash(img)
+
+
+def hash_for_backfill(path):
+    """Process pool entry point for the bulk backfill - returns (filename, hashes, error)"""
+    try:
+        return Path(path).name, hash_file(path), None
+    except Exception as e:
+        return Path(path).name, None, str(e)
+
+
+def hamming(hashes, value):
+    """Bit distance from value to every entry of a uint64 array"""
+    differences = np.bitwise_xor(hashes, np.uint64(value))
+    if hasattr(np, 'bitwise_count'):  # NumPy 2 - hardware popcount
+        return np.bitwise_count(differences)
+    return _POPCOUNT[differences.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class HashIndex:
+    def __init__(self, config):
+        self.config = config
+        similarity_config = config['similarity']
+        self.index_file = Path(similarity_config['index_file'])
+        self.max_distance = similarity_config['max_distance']
+        self.duplicate_distance = similarity_config['duplicate_distance']
+
+        self._lock = threading.Lock()
+        self._hashes = np.zeros((0, len(HASHES)), dtype=np.uint64)  # rows past len(_filenames) are spare
+        self._filenames = []
+        self._rows = {}  # filename -> row in _hashes
+        self._load()
+
+    def _load(self):
+        """Replay the log, then rewrite it without superseded lines"""
+        entries = {}
+        lines = 0
+        if self.index_file.exists():
+            with open(self.index_file) as f:
+                for line in f:
+                    lines += 1
+                    parts = line.split()
+                    if len(parts) == 1 + len(HASHES):
+                        entries[parts[0]] = tuple(int(value, 16) for value in parts[1:])
+                    elif len(parts) == 2 and parts[0] == '-':
+                        entries.pop(parts[1], None)
+        self._replace(entries)
+        if lines > len(entries):
+            self._rewrite()
+
+    def _replace(self, entries):
+        self._filenames = list(entries)
+        self._rows = {filename: row for row, filename in enumerate(self._filenames)}
+        self._hashes = np.array(list(entries.values()), dtype=np.uint64).reshape(-1, len(HASHES))
+
+    def _active(self):
+        return self._hashes[:len(self._filenames)]
+
+    def _rewrite(self):
+        temp_path = self.index_file.with_name(f".{self.index_file.name}.{os.getpid()}.tmp")
+        with open(temp_path, 'w') as f:
+            for filename, row in zip(self._filenames, self._active()):
+                f.write(self._format(filename, row))
+        os.replace(temp_path, self.index_file)
+
+    @staticmethod
+    def _format(filename, hashes):
+        return ' '.join([filename] + [f"{int(value):016x}" for value in hashes]) + '\n'
+
+    def _append(self, line):
+        with open(self.index_file, 'a') as f:
+            f.write(line)
+
+    def add(self, filename, hashes):
+        """Store the (phash, dhash) of one file, replacing any earlier entry"""
+        with self._lock:
+            row = self._rows.get(filename)
+            if row is None:
+                row = len(self._filenames)
+                if row == len(self._hashes):
+                    # Grow geometrically so adds stay amortised O(1)
+                    grown = np.zeros((max(64, row * 2), len(HASHES)), dtype=np.uint64)
+                    grown[:row] = self._hashes
+                    self._hashes = grown
+                self._rows[filename] = row
+                self._filenames.append(filename)
+            self._hashes[row] = hashes
+            self._append(self._format(filename, hashes))
+
+    def add_many(self, items):
+        """Bulk add (filename, hashes) pairs with one rewrite of the log"""
+        with self._lock:
+            entries = dict(zip(self._filenames, map(tuple, self._active())))
+            entries.update(items)
+            self._replace(entries)
+            self._rewrite()
+
+    def remove(self, filename):
+        with self._lock:
+            row = self._rows.pop(filename, None)
+            if row is None:
+                return
+            # Move the last entry into the freed row
+            last = len(self._filenames) - 1
+            if row != last:
+                self._filenames[row] = self._filenames[last]
+                self._hashes[row] = self._hashes[last]
+                self._rows[self._filenames[row]] = row
+            self._filenames.pop()
+            self._append(f"- {filename}\n")
+
+    def __contains__(self, filename):
+        return filename in self._rows
+
+    def get(self, filename):
+        """(phash, dhash) of a file, or None if it is not indexed"""
+        with self._lock:
+            row = self._rows.get(filename)
+            return None if row is None else tuple(int(value) for value in self._hashes[row])
+
+    def similar(self, hashes, max_distance=None, limit=None, hash_name='phash', exclude=None):
+        """[(filename, distance)] within max_distance bits of hashes, closest first"""
+        if max_distance is None:
+            max_distance = self.max_distance
+        column = HASHES.index(hash_name)
+        with self._lock:
+            distances = hamming(self._active()[:, column], hashes[column])
+            candidates = np.flatnonzero(distances <= max_distance)
+            order = candidates[np.argsort(distances[candidates], kind='stable')]
+            matches = [(self._filenames[row], int(distances[row])) for row in order
+                       if self._filenames[row] != exclude]
+        return matches[:limit] if limit else matches
+
+    def find_duplicate(self, filename, hashes):
+        """Another file within duplicate_distance on both hashes, or None"""
+        with self._lock:
+            active = self._active()
+            close = np.ones(len(active), dtype=bool)
+            for column, value in enumerate(hashes):
+                close &= hamming(active[:, column], value) <= self.duplicate_distance
+            for row in np.flatnonzero(close):
+                if self._filenames[row] != filename:
+                    return self._filenames[row]
+        return None
+
+    def duplicate_groups(self, max_distance=None, hash_name='phash'):
+        """Groups of files that are all within max_distance of another member"""
+        if max_distance is None:
+            max_distance = self.duplicate_distance
+        column = HASHES.index(hash_name)
+        with self._lock:
+            hashes = self._active()[:, column].copy()
+            filenames = list(self._filenames)
+
+        # Union-find over every close pair, one vectorised row at a time
+        parent = list(range(len(filenames)))
+
+        def root(row):
+            while parent[row] != row:
+                parent[row] = parent[parent[row]]
+                row = parent[row]
+            return row
+
+        for row in range(len(filenames) - 1):
+            close = np.flatnonzero(hamming(hashes[row + 1:], hashes[row]) <= max_distance) + row + 1
+            for other in close:
+                parent[root(int(other))] = root(row)
+
+        groups = {}
+        for row, filename in enumerate(filenames):
+            groups.setdefault(root(row), []).append(filename)
+        return sorted((sorted(group) for group in groups.values() if len(group) > 1), key=len, reverse=True)
+
+    def get_stats(self):
+        with self._lock:
+            return {'indexed': len(self._filenames)}
@@ -0,0 +1,114 @@
+"""
+Incrementally maintained gallery statistics
+Counters are updated on every add/delete and periodically rebuilt from storage to
+pick up drift (files removed by hand, other web workers writing), so the stats
+endpoint never scans the gallery itself.
+"""
+import threading
+from datetime import datetime
+
+BYTES_PER_MB = 1024 * 1024
+
+
+class GalleryStats:
+    # Record fields with a per-value breakdown
+    BREAKDOWNS = (('by_model', 'model'), ('by_size', 'size'), ('by_quality', 'quality'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # record key -> (model, size, quality, file bytes or None)
+        self._journal = None  # changes seen while a rebuild is scanning
+        self.reconciled_at = None
+        self._reset()
+
+    def _reset(self):
+        self._total = 0
+        self._valid_files = 0
+        self._total_size = 0
+        self._breakdowns = {name: {} for name, _ in self.BREAKDOWNS}
+
+    def _apply(self, entry, sign):
+        *values, file_size = entry
+        self._total += sign
+        if file_size is not None:
+            self._valid_files += sign
+            self._total_size += sign * file_size
+        for (name, _), value in zip(self.BREAKDOWNS, values):
+            bucket = self._breakdowns[name].setdefault(value or 'unknown', {'count': 0, 'size': 0})
+            bucket['count'] += sign
+            bucket['size'] += sign * (file_size or 0)
+            if not bucket['count']:
+                del self._breakdowns[name][value or 'unknown']
+
+    def _add(self, key, entry):
+        if key in self._entries:
+            return
+        self._entries[key] = entry
+        self._apply(entry, 1)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._apply(entry, -1)
+
+    @staticmethod
+    def make_entry(record, file_size):
+        return tuple(record.get(field) for _, field in GalleryStats.BREAKDOWNS) + (file_size,)
+
+    def record_added(self, key, record, file_size):
+        """A record was stored - file_size is None when the image file is missing"""
+        entry = self.make_entry(record, file_size)
+        with self._lock:
+            self._add(key, entry)
+            if self._journal is not None:
+                self._journal.append(('add', key, entry))
+
+    def record_removed(self, keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+                if self._journal is not None:
+                    self._journal.append(('remove', key, None))
+
+    def begin_rebuild(self):
+        """Start journaling changes so the scan result can be brought up to date"""
+        with self._lock:
+            self._journal = []
+
+    def finish_rebuild(self, entries):
+        """Replace the counters with a fresh scan - entries is (key, record, file_size) -
+        replaying changes made while it ran. Returns True if anything drifted."""
+        with self._lock:
+            before = self._summary()
+            journal, self._journal = self._journal or [], None
+            self._entries = {}
+            self._reset()
+            for key, record, file_size in entries:
+                self._add(key, self.make_entry(record, file_size))
+            for action, key, entry in journal:
+                if action == 'add':
+                    self._add(key, entry)
+                else:
+                    self._remove(key)
+            self.reconciled_at = datetime.now().isoformat()
+            return self._summary() != before
+
+    def _summary(self):
+        return (self._total, self._valid_files, self._total_size)
+
+    def snapshot(self):
+        """Current stats - O(number of distinct models/sizes/qualities)"""
+        with self._lock:
+            if not self._total:
+                return {'total': 0, 'total_size': 0}
+            stats = {
+                'total': self._total,
+                'valid_files': self._valid_files,  # Files that still exist
+                'total_size': self._total_size,
+                'total_size_mb': round(self._total_size / BYTES_PER_MB, 2),
+                'reconciled_at': self.reconciled_at
+            }
+            for name, buckets in self._breakdowns.items():
+                stats[name] = {value: {'count': bucket['count'], 'size_mb': round(bucket['size'] / BYTES_PER_MB, 2)}
+                               for value, bucket in sorted(buckets.items())}
+            return stats
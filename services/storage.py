@@ -0,0 +1,421 @@
+"""
+Tiered storage for generated images
+Hot originals in output_dir are recompressed losslessly in the background. Images
+nobody has requested for archive_after_days move to archive_dir, as PNG or lossless
+WebP, and are promoted back the first time they are served again. Thumbnails and
+derivatives are kept under a size quota by evicting the least recently served -
+the render pipeline recreates them on demand. Every web worker records what it
+served in a shared SQLite state file; one of them at a time runs the passes.
+"""
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from PIL import Image, PngImagePlugin
+
+from services.images import process_pool
+
+logger = logging.getLogger(__name__)
+
+BYTES_PER_MB = 1024 * 1024
+ARCHIVE_FORMATS = ('png', 'webp')
+# The pass lease outlives this many intervals - another worker takes over after that
+LEASE_INTERVALS = 3
+
+
+def _temp_path(path):
+    return path.with_name(f".{path.name}.{os.getpid()}.tmp")
+
+
+def _save_png(img, path, source_stat):
+    """Maximum-effort PNG keeping text chunks and the original timestamps"""
+    pnginfo = PngImagePlugin.PngInfo()
+    for key, value in getattr(img, 'text', {}).items():
+        pnginfo.add_text(key, value)
+    img.save(path, format='PNG', optimize=True, pnginfo=pnginfo)
+    os.utime(path, (source_stat.st_atime, source_stat.st_mtime))
+
+
+def recompress_original(path):
+    """Losslessly re-encode one PNG in place - returns bytes saved. Module level so it
+    can run in a worker process; the file is only replaced when the result is smaller."""
+    path = Path(path)
+    before = path.stat()
+    temp_path = _temp_path(path)
+    with Image.open(path) as img:
+        img.load()
+        _save_png(img, temp_path, before)
+    saved = before.st_size - temp_path.stat().st_size
+    # Keep the original if it is already as small, or was rewritten while we worked
+    if saved <= 0 or path.stat().st_mtime != before.st_mtime:
+        temp_path.unlink()
+        return 0
+    os.replace(temp_path, path)
+    return saved
+
+
+def encode_archive(source_path, target_path):
+    """Write a lossless WebP copy of an original to target_path - runs in a worker process"""
+    source_path, target_path = Path(source_path), Path(target_path)
+    before = source_path.stat()
+    with Image.open(source_path) as img:
+        img.save(target_path, format='WEBP', lossless=True, quality=100, method=6)
+    os.utime(target_path, (before.st_atime, before.st_mtime))
+    return str(target_path)
+
+
+class StorageTiers:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS last_access (
+            path TEXT PRIMARY KEY,
+            served REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS recompressed (
+            filename TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS pass_lease (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            owner TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+    """
+
+    def __init__(self, config, file_index, image_service):
+        self.config = config
+        storage_config = config['storage']
+        self.enabled = storage_config['enabled']
+        self.output_dir = Path(config['files']['output_dir'])
+        self.archive_dir = Path(storage_config['archive_dir'])
+        self.archive_format = storage_config['archive_format']
+        if self.archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive format: {self.archive_format}")
+        self.archive_after_seconds = storage_config['archive_after_days'] * 86400
+        self.recompress_after_seconds = storage_config['recompress_after_seconds']
+        self.quota_bytes = storage_config['derivative_quota_mb'] * BYTES_PER_MB
+        self.interval_seconds = storage_config['interval_seconds']
+        self.workers = storage_config['workers']
+        self.state_db = storage_config['state_db']
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+        self.file_index = file_index
+        self.image_service = image_service
+        self.derivative_dirs = image_service.derivative_dirs()
+        # Evicted derivatives of archived originals are re-rendered from the archive copy
+        image_service.locate_original = self.source_path
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._accessed = {}  # path -> last time this process served it, not yet in state_db
+        self._last_access = {}  # path -> last time any worker served it, as of this pass
+        self._recompressed = set()  # originals already at their smallest lossless size
+        self._restoring = {}  # filename -> Event set once its restore from the archive is done
+        self._counters = {'recompressed': 0, 'bytes_saved': 0, 'archived': 0, 'restored': 0, 'evicted': 0}
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        file_index.watch(self.archive_dir)
+
+    def _connect(self):
+        """One connection per thread; WAL so the pass reads while other workers flush"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.state_db, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _flush_access(self):
+        """Write this process's access times to the shared state - the newest time wins"""
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        if not accessed:
+            return
+        conn = self._connect()
+        with conn:
+            conn.executemany('INSERT INTO last_access (path, served) VALUES (?, ?) '
+                             'ON CONFLICT (path) DO UPDATE SET served = MAX(served, excluded.served)', accessed.items())
+
+    def _load_state(self):
+        """Snapshot what every worker has flushed, for this pass"""
+        conn = self._connect()
+        last_access = dict(conn.execute('SELECT path, served FROM last_access').fetchall())
+        recompressed = {filename for filename, in conn.execute('SELECT filename FROM recompressed')}
+        with self._lock:
+            self._last_access = last_access
+            self._recompressed = recompressed
+
+    def _mark_recompressed(self, filenames):
+        conn = self._connect()
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO recompressed (filename) VALUES (?)', [(name,) for name in filenames])
+
+    def _forget(self, paths):
+        """Drop the access times of files that were moved or deleted"""
+        paths = [str(path) for path in paths]
+        with self._lock:
+            for path in paths:
+                self._last_access.pop(path, None)
+                self._accessed.pop(path, None)
+        conn = self._connect()
+        with conn:
+            conn.executemany('DELETE FROM last_access WHERE path = ?', [(path,) for path in paths])
+
+    def _claim_pass(self):
+        """Take or renew the lease on tiering passes - True if this process runs them.
+        Workers share the originals, so only one may move them at a time."""
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                'INSERT INTO pass_lease (id, owner, expires) VALUES (1, ?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET owner = excluded.owner, expires = excluded.expires '
+                'WHERE pass_lease.owner = excluded.owner OR pass_lease.expires < ?',
+                (self.owner, now + LEASE_INTERVALS * self.interval_seconds, now)
+            )
+        return cursor.rowcount == 1
+
+    def start(self):
+        """Start the background tiering loop"""
+        if not self.enabled:
+            return
+        worker = threading.Thread(target=self._tier_loop, name='storage-tiers')
+        worker.daemon = True
+        worker.start()
+
+    def _tier_loop(self):
+        while True:
+            time.sleep(self.interval_seconds)
+            try:
+                self._flush_access()
+                if self._claim_pass():
+                    self.run_once()
+            except Exception:
+                logger.exception('Storage tiering pass failed')
+
+    def run_once(self):
+        """One pass: recompress new originals, archive cold ones, enforce the derivative quota"""
+        self._flush_access()
+        self._load_state()
+        with process_pool(self.workers) as pool:
+            self._recompress(pool)
+            self._archive_cold(pool)
+        self._enforce_quota()
+        # Forget files that are gone - also drops entries recorded by older versions for any name
+        self._forget([path for path in self._last_access if not self.file_index.exists(Path(path))])
+
+    def record_access(self, path):
+        """Note that a file was served - drives archiving and LRU eviction. Only indexed
+        files count, so requests for made-up names cannot grow the map. Kept in memory
+        and flushed to the shared state each interval."""
+        if not self.file_index.exists(path):
+            return
+        with self._lock:
+            self._accessed[str(path)] = time.time()
+
+    def _hot_path(self, filename):
+        return self.output_dir / filename
+
+    def _archive_path(self, filename):
+        return self.archive_dir / (Path(filename).stem + '.webp' if self.archive_format == 'webp' else filename)
+
+    def _archived(self, filename):
+        """Where an archived original lives - either format, so changing the setting is safe"""
+        for path in (self.archive_dir / filename, self.archive_dir / (Path(filename).stem + '.webp')):
+            if self.file_index.exists(path):
+                return path
+        return None
+
+    def lookup(self, filename):
+        """FileInfo of an original in whichever tier holds it, or None"""
+        info = self.file_index.lookup(self._hot_path(filename))
+        if info is None:
+            archived = self._archived(filename)
+            info = self.file_index.lookup(archived) if archived else None
+        return info
+
+    def exists(self, filename):
+        return self.lookup(filename) is not None
+
+    def source_path(self, filename):
+        """Path of an original in whichever tier holds it, or None"""
+        hot_path = self._hot_path(filename)
+        return hot_path if self.file_index.exists(hot_path) else self._archived(filename)
+
+    def original_sizes(self):
+        """{filename: bytes} of every original across both tiers - no filesystem scan"""
+        sizes = {}
+        for name, info in (self.file_index.list(self.archive_dir) or {}).items():
+            sizes[name if name.endswith('.png') else Path(name).stem + '.png'] = info.size
+        for name, info in (self.file_index.list(self.output_dir) or {}).items():
+            sizes[name] = info.size
+        return sizes
+
+    def ensure_hot(self, filename):
+        """Promote an archived original back into output_dir; returns False if there is none"""
+        if Path(filename).name != filename or filename.startswith('.'):
+            return False
+        hot_path = self._hot_path(filename)
+        if self.file_index.exists(hot_path):
+            return True
+        with self._lock:
+            archived = self._archived(filename)
+            if archived is None:
+                return self.file_index.exists(hot_path)
+            restoring = self._restoring.get(filename)
+            if restoring is None:
+                restoring = self._restoring[filename] = threading.Event()
+                restorer = True
+            else:
+                restorer = False
+        if not restorer:
+            # Another request is already restoring it
+            restoring.wait()
+            return self.file_index.exists(hot_path)
+
+        try:
+            self._restore(filename, archived, hot_path)
+        finally:
+            with self._lock:
+                del self._restoring[filename]
+            restoring.set()
+        self.image_service.touch()
+        logger.info(f"Restored {filename} from the archive tier")
+        return True
+
+    def _restore(self, filename, archived, hot_path):
+        temp_path = None
+        if archived.suffix == '.webp':
+            # Decode and encode outside the lock - record_access is on every image request
+            temp_path = _temp_path(hot_path)
+            try:
+                with Image.open(archived) as img:
+                    _save_png(img, temp_path, archived.stat())
+            except Exception:
+                temp_path.unlink(missing_ok=True)
+                raise
+        with self._lock:
+            if temp_path:
+                os.replace(temp_path, hot_path)
+                archived.unlink()
+            else:
+                shutil.move(archived, hot_path)
+            self._accessed[str(hot_path)] = time.time()
+            self._counters['restored'] += 1
+            self.file_index.record(hot_path)
+            self.file_index.discard(archived)
+        self._mark_recompressed([filename])
+
+    def _hot_files(self):
+        return (self.file_index.list(self.output_dir) or {}).items()
+
+    def _recompress(self, pool):
+        cutoff = time.time() - self.recompress_after_seconds
+        paths = [self._hot_path(name) for name, info in self._hot_files()
+                 if name.endswith('.png') and name not in self._recompressed and info.mtime < cutoff]
+        if not paths:
+            return
+        for path, saved in zip(paths, pool.map(recompress_original, paths, chunksize=4)):
+            self.file_index.record(path)
+            with self._lock:
+                self._recompressed.add(path.name)
+                self._counters['recompressed'] += 1
+                self._counters['bytes_saved'] += saved
+        self._mark_recompressed([path.name for path in paths])
+        # Recompressed files have new versions - refresh gallery URLs
+        self.image_service.touch()
+        logger.info(f"Recompressed {len(paths)} originals")
+
+    def _last_used(self, path, info):
+        key = str(path)
+        return max(self._accessed.get(key, 0), self._last_access.get(key, info.mtime))
+
+    def _archive_cold(self, pool):
+        cutoff = time.time() - self.archive_after_seconds
+        cold = [name for name, info in self._hot_files()
+                if name.endswith('.png') and self._last_used(self._hot_path(name), info) < cutoff]
+        if not cold:
+            return
+
+        encoded = {}
+        if self.archive_format == 'webp':
+            sources = [self._hot_path(name) for name in cold]
+            temps = [_temp_path(self._archive_path(name)) for name in cold]
+            for name, temp_path in zip(cold, pool.map(encode_archive, sources, temps)):
+                encoded[name] = Path(temp_path)
+            # Pick up what other workers served while we were encoding
+            self._load_state()
+
+        archived = []
+        for name in cold:
+            hot_path, archive_path = self._hot_path(name), self._archive_path(name)
+            with self._lock:
+                # Served while we were encoding - it is not cold any more
+                info = self.file_index.lookup(hot_path)
+                if info is None or self._last_used(hot_path, info) >= cutoff:
+                    if name in encoded:
+                        encoded[name].unlink(missing_ok=True)
+                    continue
+                if name in encoded:
+                    os.replace(encoded[name], archive_path)
+                    hot_path.unlink()
+                else:
+                    shutil.move(hot_path, archive_path)
+                self._counters['archived'] += 1
+                # Inside the lock so ensure_hot never sees a half-moved file
+                self.file_index.discard(hot_path)
+                self.file_index.record(archive_path)
+            archived.append(hot_path)
+        if archived:
+            self._forget(archived)
+            self.image_service.touch()
+        logger.info(f"Archived {len(archived)} cold originals")
+
+    def _derivative_entries(self):
+        for directory in self.derivative_dirs:
+            for name, info in (self.file_index.list(directory) or {}).items():
+                yield directory / name, info
+
+    def _enforce_quota(self):
+        """Delete least recently served derivatives until they fit in the quota"""
+        entries = [(self._last_used(path, info), info.size, path) for path, info in self._derivative_entries()]
+        total = sum(size for _, size, _ in entries)
+        if total <= self.quota_bytes:
+            return
+
+        entries.sort(key=lambda entry: entry[0])
+        evicted = []
+        for _, size, path in entries:
+            if total <= self.quota_bytes:
+                break
+            path.unlink(missing_ok=True)
+            self.file_index.discard(path)
+            total -= size
+            evicted.append(path)
+        self._forget(evicted)
+        with self._lock:
+            self._counters['evicted'] += len(evicted)
+        self.image_service.touch()
+        logger.info(f"Evicted {len(evicted)} derivatives to stay under the {self.quota_bytes // BYTES_PER_MB} MB quota")
+
+    def get_stats(self):
+        hot = self.file_index.list(self.output_dir) or {}
+        archived = self.file_index.list(self.archive_dir) or {}
+        derivative_bytes = sum(info.size for _, info in self._derivative_entries())
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            'hot_files': len(hot),
+            'hot_size_mb': round(sum(info.size for info in hot.values()) / BYTES_PER_MB, 2),
+            'archived_files': len(archived),
+            'archived_size_mb': round(sum(info.size for info in archived.values()) / BYTES_PER_MB, 2),
+            'derivative_size_mb': round(derivative_bytes / BYTES_PER_MB, 2),
+            'derivative_quota_mb': self.quota_bytes // BYTES_PER_MB,
+            **counters
+        }
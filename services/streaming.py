@@ -0,0 +1,213 @@
+"""
+Streaming bodies for SD API calls
+Responses: scans the JSON body incrementally and base64-decodes every "b64_json"
+value straight into a temp file, so peak memory stays bounded by the chunk size
+no matter how large the image or the batch is.
+Uploads: multipart/form-data bodies that read the init image from disk chunk by chunk.
+"""
+import asyncio
+import binascii
+import os
+import tempfile
+import uuid
+from pathlib import Path
+
+
+class B64ImageStreamDecoder:
+    KEY = b'"b64_json"'
+    # Decode base64 in multiples of 4 characters
+    QUANTUM = 4
+
+    def __init__(self, target_dir):
+        self.target_dir = Path(target_dir)
+        self.paths = []
+        self._buffer = b''         # Unscanned bytes while looking for the next key
+        self._state = 'search'    # search -> value (before opening quote) -> string
+        self._pending = b''       # Base64 characters not yet decoded
+        self._escape = False
+        self._file = None
+
+    def feed(self, chunk):
+        """Consume the next chunk of the response body"""
+        data = self._buffer + chunk
+        self._buffer = b''
+        position = 0
+
+        while position < len(data):
+            if self._state == 'search':
+                found = data.find(self.KEY, position)
+                if found == -1:
+                    # Keep a tail in case the key straddles two chunks
+                    self._buffer = data[max(position, len(data) - len(self.KEY) + 1):]
+                    return
+                position = found + len(self.KEY)
+                self._state = 'value'
+
+            elif self._state == 'value':
+                byte = data[position:position + 1]
+                position += 1
+                if byte == b'"':
+                    self._open_image()
+                    self._state = 'string'
+                elif byte not in (b':', b' ', b'\t', b'\r', b'\n'):
+                    raise ValueError('Malformed response: b64_json is not a string')
+
+            else:
+                position = self._consume_string(data, position)
+
+    def close(self):
+        """Finish decoding, returning the temp file paths in response order"""
+        if self._state != 'search':
+            self.abort()
+            raise ValueError('Truncated response: image data ended early')
+        return self.paths
+
+    def abort(self):
+        """Remove every temp file written so far"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        for path in self.paths:
+            Path(path).unlink(missing_ok=True)
+        self.paths = []
+
+    def _open_image(self):
+        handle, path = tempfile.mkstemp(dir=self.target_dir, prefix='.incoming-', suffix='.part')
+        self._file = os.fdopen(handle, 'wb')
+        self.paths.append(Path(path))
+        self._pending = b''
+        self._escape = False
+
+    def _consume_string(self, data, position):
+        """Decode base64 characters up to the closing quote; returns the next scan position"""
+        end = len(data)
+        collected = []
+
+        while position < end:
+            if self._escape:
+                # Encoders may write '/' as '\/' - every other escape is foreign to base64
+                if data[position] != ord('/'):
+                    raise ValueError('Malformed response: unexpected escape in b64_json')
+                collected.append(b'/')
+                self._escape = False
+                position += 1
+                continue
+
+            # Jump to the next quote or backslash instead of walking byte by byte
+            quote = data.find(b'"', position)
+            backslash = data.find(b'\\', position, quote if quote != -1 else end)
+            if backslash != -1:
+                collected.append(data[position:backslash])
+                self._escape = True
+                position = backslash + 1
+            elif quote != -1:
+                collected.append(data[position:quote])
+                self._write(b''.join(collected), final=True)
+                self._file.close()
+                self._file = None
+                self._state = 'search'
+                return quote + 1
+            else:
+                collected.append(data[position:])
+                position = end
+
+        self._write(b''.join(collected), final=False)
+        return position
+
+    def _write(self, characters, final):
+        self._pending += characters
+        if final:
+            usable = len(self._pending)
+        else:
+            usable = len(self._pending) - len(self._pending) % self.QUANTUM
+        if usable:
+            self._file.write(binascii.a2b_base64(self._pending[:usable]))
+            self._pending = self._pending[usable:]
+
+
+def decode_image_stream(chunks, target_dir):
+    """Decode every b64_json image in a streamed response body into temp files in target_dir"""
+    decoder = B64ImageStreamDecoder(target_dir)
+    try:
+        for chunk in chunks:
+            decoder.feed(chunk)
+        return decoder.close()
+    except Exception:
+        decoder.abort()
+        raise
+
+
+class MultipartFileBody:
+    """multipart/form-data request body streaming one file from disk
+
+    The file is opened once, so a rename or rewrite of the path while the request is
+    in flight does not change what is sent. Each iteration starts again from the top,
+    which lets retries re-send the body without it ever being held in memory. len()
+    is exact, so the request goes out with a Content-Length rather than chunked.
+    """
+
+    def __init__(self, fields, file_field, file_path, chunk_size, content_type='image/png'):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self.chunk_size = chunk_size
+        file_path = Path(file_path)
+        parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+                 for name, value in fields.items()]
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                     f'filename="{file_path.name}"\r\nContent-Type: {content_type}\r\n\r\n')
+        self._head = ''.join(parts).encode('utf-8')
+        self._tail = f'\r\n--{boundary}--\r\n'.encode('ascii')
+        self._file = open(file_path, 'rb')
+        self._file_size = os.fstat(self._file.fileno()).st_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def headers(self):
+        return {'Content-Type': self.content_type, 'Content-Length': str(len(self))}
+
+    def __len__(self):
+        return len(self._head) + self._file_size + len(self._tail)
+
+    def __iter__(self):
+        yield self._head
+        self._file.seek(0)
+        remaining = self._file_size
+        while remaining > 0:
+            chunk = self._file.read(min(self.chunk_size, remaining))
+            if not chunk:
+                raise ValueError('Upload file shrank while it was being sent')
+            remaining -= len(chunk)
+            yield chunk
+        yield self._tail
+
+    async def _aiter_chunks(self):
+        yield self._head
+        self._file.seek(0)
+        remaining = self._file_size
+        while remaining > 0:
+            # Disk reads off the event loop
+            chunk = await asyncio.to_thread(self._file.read, min(self.chunk_size, remaining))
+            if not chunk:
+                raise ValueError('Upload file shrank while it was being sent')
+            remaining -= len(chunk)
+            yield chunk
+        yield self._tail
+
+    def async_stream(self):
+        """Async-only view for httpx, which would otherwise pick the blocking iterator"""
+        return _AsyncBodyStream(self)
+
+
+class _AsyncBodyStream:
+    def __init__(self, body):
+        self._body = body
+
+    def __aiter__(self):
+        return self._body._aiter_chunks()
@@ -9,6 +9,10 @@ class ImageGenerator {
         this.resultArea = document.getElementById('resultArea');
         this.imageContainer = document.getElementById('imageContainer');
         this.errorMessage = document.getElementById('errorMessage');
+        // Refinement job whose result should replace the draft on screen
+        this.refinementId = null;
+        // Per-browser id the server queues fairly by - the address alone is shared behind a proxy
+        this.clientId = this.getClientId();
         
         this.init();
         console.log('ImageGenerator initialized');
@@ -30,6 +34,15 @@ class ImageGenerator {
         this.updateCharCount();
     }
     
+    getClientId() {
+        let clientId = localStorage.getItem('clientId');
+        if (!clientId) {
+            clientId = crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+            localStorage.setItem('clientId', clientId);
+        }
+        return clientId;
+    }
+    
     updateCharCount() {
         const count = this.promptInput.value.length;
         this.charCount.textContent = count;
@@ -58,6 +71,8 @@ class ImageGenerator {
         
         this.setLoading(true);
         this.hideError();
+        // A new request supersedes any refinement still on its way (the server cancels it too)
+        this.refinementId = null;
         
         try {
             // Get selected size and quality
@@ -83,11 +98,17 @@ class ImageGenerator {
                 payload.seed = seed;
             }
             
+            const progressiveInput = document.getElementById('progressiveInput');
+            if (progressiveInput && progressiveInput.checked) {
+                payload.progressive = true;
+            }
+            
             // Start generation job
             const response = await fetch('/generate', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'X-Client-Id': this.clientId
                 },
                 body: JSON.stringify(payload)
             });
@@ -102,8 +123,22 @@ class ImageGenerator {
                 throw new Error('No job ID received from server');
             }
             
-            // Start polling for job status
-            this.pollJobStatus(data.job_id, prompt);
+            // Progressive mode: follow the refinement once the draft is on screen
+            const onFinished = (status) => {
+                this.finishJob(status);
+                if (data.refinement_job_id && status.status === 'completed') {
+                    this.watchRefinement(data.refinement_job_id);
+                }
+            };
+            
+            // Cached results come back already completed
+            if (data.status === 'completed' && data.result) {
+                onFinished(data);
+                return;
+            }
+            
+            // Follow progress over the event stream, polling only as a fallback
+            this.watchJob(data.job_id, onFinished);
             
         } catch (error) {
             this.showError(error.message);
@@ -111,7 +146,85 @@ class ImageGenerator {
         }
     }
     
-    async pollJobStatus(jobId, originalPrompt) {
+    isFinished(status) {
+        return ['completed', 'failed', 'cancelled'].includes(status.status);
+    }
+    
+    finishJob(status) {
+        if (status.status === 'completed') {
+            this.displayImage(status.result);
+        } else if (status.status === 'failed') {
+            this.showError(status.error || 'Generation failed');
+        } else {
+            this.showError(status.message || 'Generation cancelled');
+        }
+        this.setLoading(false);
+    }
+    
+    watchJob(jobId, onFinished, onStatus = (status) => this.showStatus(status)) {
+        if (!window.EventSource) {
+            this.pollJobStatus(jobId, onFinished, onStatus);
+            return;
+        }
+        
+        console.log(`Opening event stream for job: ${jobId}`);
+        const source = new EventSource(`/generate/events/${jobId}`);
+        let received = false;
+        
+        source.onmessage = (event) => {
+            received = true;
+            const status = JSON.parse(event.data);
+            onStatus(status);
+            
+            if (this.isFinished(status)) {
+                source.close();
+                onFinished(status);
+            }
+        };
+        
+        source.onerror = () => {
+            // EventSource reconnects on its own once a stream has worked;
+            // if it never opened, the push channel is unavailable - poll instead
+            if (!received) {
+                source.close();
+                this.pollJobStatus(jobId, onFinished, onStatus);
+            }
+        };
+    }
+    
+    watchRefinement(jobId) {
+        // The draft stays usable - a new request may be submitted right away
+        this.refinementId = jobId;
+        const note = document.createElement('div');
+        note.className = 'image-info refinement-note';
+        note.textContent = 'Refining...';
+        this.imageContainer.appendChild(note);
+        
+        this.watchJob(jobId, (status) => {
+            if (this.refinementId !== jobId) return;
+            this.refinementId = null;
+            if (status.status === 'completed') {
+                this.displayImage(status.result);
+            } else {
+                note.remove();
+            }
+        }, (status) => {
+            if (this.refinementId !== jobId) return;
+            note.textContent = status.queue_position
+                ? `Refining - queued #${status.queue_position} (~${status.eta_seconds}s)`
+                : `Refining - ${status.message} (${status.progress}%)`;
+        });
+    }
+    
+    showStatus(status) {
+        if (status.queue_position) {
+            this.updateProgress(status.progress, `Queued #${status.queue_position} (~${status.eta_seconds}s)`);
+        } else {
+            this.updateProgress(status.progress, status.message);
+        }
+    }
+    
+    async pollJobStatus(jobId, onFinished, onStatus) {
         console.log(`Starting polling for job: ${jobId}`);
         const startTime = Date.now();
         let retryCount = 0;
@@ -132,13 +245,10 @@ class ImageGenerator {
                 }
                 
                 retryCount = 0;
-                this.updateProgress(status.progress, status.message);
+                onStatus(status);
                 
-                if (status.status === 'completed') {
-                    this.displayImage(status.result);
-                    this.setLoading(false);
-                } else if (status.status === 'failed') {
-                    throw new Error(status.error || 'Generation failed');
+                if (this.isFinished(status)) {
+                    onFinished(status);
                 } else {
                     setTimeout(poll, window.APP_CONFIG.polling.intervalMs);
                 }
@@ -184,7 +294,7 @@ class ImageGenerator {
             <strong>Prompt:</strong> ${data.prompt}<br>
             <strong>Size:</strong> ${data.size} • <strong>Quality:</strong> ${data.quality}<br>
             <strong>Seed:</strong> ${seedInfo}<br>
-            <strong>Filename:</strong> ${data.filename}
+            ${data.draft ? '<strong>Draft preview</strong> - not saved to the gallery' : `<strong>Filename:</strong> ${data.filename}`}
         `;
         
         // Clear and populate container
@@ -3,6 +3,7 @@
 class Gallery {
     constructor() {
         this.currentPage = 1;
+        this.nextCursor = '';
         this.loading = false;
         this.hasMore = true;
         this.images = [];
@@ -24,6 +25,8 @@ class Gallery {
         // Modal elements
         this.modal = document.getElementById('imageModal');
         this.modalImage = document.getElementById('modalImage');
+        this.modalSourceAvif = document.getElementById('modalSourceAvif');
+        this.modalSourceWebp = document.getElementById('modalSourceWebp');
         this.modalClose = document.getElementById('modalClose');
         this.modalBackdrop = document.getElementById('modalBackdrop');
         this.modalPrev = document.getElementById('modalPrev');
@@ -90,7 +93,8 @@ class Gallery {
         this.showLoading();
         
         try {
-            const response = await fetch(`/api/gallery?page=${this.currentPage}`);
+            // Keyset pagination - deep pages cost the same as the first one
+            const response = await fetch(`/api/gallery?after=${encodeURIComponent(this.nextCursor)}`);
             const data = await response.json();
             
             if (this.currentPage === 1) {
@@ -102,6 +106,7 @@ class Gallery {
             }
             
             this.hasMore = data.has_next;
+            this.nextCursor = data.next_cursor || '';
             this.updateLoadMoreButton();
             
             if (data.total === 0) {
@@ -162,11 +167,21 @@ class Gallery {
             ? image.prompt.substring(0, 60) + '...' 
             : image.prompt;
         
+        // Prefer compact WebP/AVIF thumbnails when the server has them cached
+        const thumbVariants = (image.variants && image.variants.thumb) || {};
+        const thumbSources = ['avif', 'webp']
+            .filter((format) => thumbVariants[format])
+            .map((format) => `<source type="image/${format}" srcset="${thumbVariants[format]}">`)
+            .join('');
+        
         item.innerHTML = `
-            <img class="gallery-thumbnail" 
-                 src="${image.thumbnail_url}" 
-                 alt="${image.prompt}"
-                 loading="lazy">
+            <picture>
+                ${thumbSources}
+                <img class="gallery-thumbnail" 
+                     src="${image.thumbnail_url}" 
+                     alt="${image.prompt}"
+                     loading="lazy">
+            </picture>
             <div class="gallery-info">
                 <div class="gallery-prompt">${shortPrompt}</div>
                 <div class="gallery-meta">
@@ -209,6 +224,10 @@ class Gallery {
         
         if (!image) return;
         
+        // Responsive sources - phones pick the medium derivative instead of the full PNG
+        const srcset = image.srcset || {};
+        this.modalSourceAvif.srcset = srcset.avif || '';
+        this.modalSourceWebp.srcset = srcset.webp || '';
         this.modalImage.src = image.image_url;
         this.modalImage.alt = image.prompt;
         